@@ -0,0 +1,63 @@
+"""Micro-benchmark of the input files selection, over a synthetic folder of 100k files.
+
+Run from the project root: `poetry run python -m benchmarks.bench_scan [count]`
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+from flaked.services.config import config_service
+from flaked.services.scan import ScanService, select_files
+
+
+def legacy_select(source: Path, regex: str, skip: int) -> list:
+    """The selection as it was: iterdir, is_file, match and stat in the sort key."""
+    pattern = re.compile(regex)
+    files = sorted(
+        [f for f in source.iterdir() if f.is_file() and pattern.match(f.name)],
+        key=lambda f: f.stat().st_mtime,
+        reverse=True
+    )
+    return files[skip:]
+
+
+def timed(label: str, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - start:8.3f} s")
+    return result
+
+
+def main(count: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'data'
+        source.mkdir()
+        for i in range(count):
+            path = source / f"{i:08d}.csv"
+            path.touch()
+            os.utime(path, ns=(i * 1_000_000, i * 1_000_000))
+        os.utime(source, ns=(0, 0))
+        config_service.get_settings().state = str(Path(tmp) / 'state')
+        regex = r'.*\.csv'
+        print(f"Selecting among {count} files")
+
+        legacy = timed("legacy iterdir + sorted(stat)",
+                       lambda: legacy_select(source, regex, 1))
+        service = ScanService()
+        entries = timed("scandir, cold index",
+                        lambda: service.scan('bench', source, regex))
+        timed("scandir, index reloaded from disk",
+              lambda: ScanService().scan('bench', source, regex))
+        entries = timed("unchanged folder",
+                        lambda: service.scan('bench', source, regex))
+        selected = timed("top-k selection (skip 1)",
+                         lambda: select_files(entries, 1))
+        timed("top-k selection (skip 1, max 1000)",
+              lambda: select_files(entries, 1, 1000))
+        assert sorted(selected) == sorted(f.name for f in legacy)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,42 @@
+"""Micro-benchmark of the log tail, over synthetic log files of growing size.
+
+Run from the project root: `poetry run python -m benchmarks.bench_tail [lines]`
+"""
+import sys
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+from flaked.services.log import tail_files
+
+LINE = b'"2025-01-01 00:00:00,000","INFO","instrument1","instrument1:cron","UPLOAD_FILES","Uploaded files","12"\n'
+
+
+def legacy_tail(path: Path, lines: int) -> list:
+    """The tail as it was: the whole file read through a deque."""
+    with open(path, "rb") as file:
+        return list(deque(file, maxlen=lines))
+
+
+def timed(label: str, func, repeat: int = 20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    print(f"{label:<40} {(time.perf_counter() - start) / repeat * 1000:8.3f} ms")
+    return result
+
+
+def main(lines: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [1, 10, 100]:
+            path = Path(tmp) / f"{size}.log"
+            with open(path, "wb") as file:
+                file.write(LINE * (size * 1000000 // len(LINE)))
+            print(f"Tailing {lines} lines of a {size} MB file")
+            legacy = timed("legacy deque", lambda: legacy_tail(path, lines))
+            tail = timed("reverse seek", lambda: tail_files([path], lines))
+            assert tail == legacy
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -1,10 +1,13 @@
 from fastapi import FastAPI, status, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from logging import basicConfig, INFO, DEBUG
 from pydantic import BaseModel
 from .views.scheduler import router as scheduler_router
 from .views.config import router as config_router
 from .views.logs import router as logs_router
+from .views.uploads import router as uploads_router
+from .services.metrics import metrics_service
 
 basicConfig(level=DEBUG)
 
@@ -42,6 +45,20 @@ async def get_health(
     """
     return HealthCheck(status="OK")
 
+
+@app.get(
+    "/metrics",
+    tags=["Healthcheck"],
+    summary="Get the metrics",
+    response_class=PlainTextResponse,
+)
+async def get_metrics() -> str:
+    """
+    Endpoint to collect the job, upload, scan and scheduler metrics, in the
+    Prometheus text exposition format.
+    """
+    return PlainTextResponse(metrics_service.render(), media_type="text/plain; version=0.0.4")
+
 app.include_router(
     scheduler_router,
     prefix="/scheduler",
@@ -59,3 +76,9 @@ app.include_router(
     prefix="/logs",
     tags=["Logs"],
 )
+
+app.include_router(
+    uploads_router,
+    prefix="/uploads",
+    tags=["Uploads"],
+)
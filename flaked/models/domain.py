@@ -1,6 +1,28 @@
-from typing import List, Optional
-from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field, model_validator
 from enum import Enum
+import importlib.util
+
+# Range of the compression levels, by compression format
+COMPRESS_LEVELS = {
+    'gzip': (1, 9),
+    'zstd': (1, 22),
+}
+
+
+class PoolConfig(BaseModel):
+    """SFTP connections pooling
+    """
+    # Max number of connections (idle or leased) per SFTP endpoint
+    max_size: int = Field(default=4)
+    # Seconds after which an unused connection is closed
+    idle_timeout: int = Field(default=300)
+    # Seconds between SSH keepalive packets, 0 to disable
+    keepalive: int = Field(default=30)
+    # Seconds to wait for a connection when the pool is exhausted
+    timeout: int = Field(default=60)
+    # Seconds during which a remote folder known to exist is not checked again, 0 to disable
+    dir_ttl: int = Field(default=300)
 
 
 class SFTPConfig(BaseModel):
@@ -12,6 +34,7 @@ class SFTPConfig(BaseModel):
     prefix: str = Field(default='data')
     username: str
     password: str
+    pool: PoolConfig = Field(default=PoolConfig())
 
 
 class IOConfig(BaseModel):
@@ -27,6 +50,49 @@ class LogsConfig(IOConfig):
     level: str = Field(default='INFO')
 
 
+class UploadConfig(BaseModel):
+    """Files upload settings
+    """
+    # Max number of files uploaded in parallel for an instrument
+    concurrency: int = Field(default=1)
+    # Max number of files uploaded in parallel, all instruments together
+    max_concurrency: int = Field(default=8)
+    # Size in bytes above which a partially uploaded file is resumed instead of restarted, 0 to disable
+    resume_size: int = Field(default=1048576)
+    # Number of files hashed in parallel, to find the ones already uploaded
+    hash_workers: int = Field(default=4)
+    # Days after which an uploaded file is forgotten by the ledger
+    ledger_days: int = Field(default=30)
+    # Max upload throughput in bytes per second, all instruments together, 0 for no limit
+    rate: int = Field(default=0)
+    # Max number of bytes sent at once above the rate, defaults to one second at the rate
+    burst: Optional[int] = Field(default=None)
+
+
+class BreakerConfig(BaseModel):
+    """Circuit breaker of the SFTP destination
+    """
+    # Number of consecutive failures after which the uploads are suspended
+    threshold: int = Field(default=5)
+    # Seconds after which an upload is tried again
+    reset: int = Field(default=60)
+
+
+class SchedulerConfig(BaseModel):
+    """Scheduler executor and job defaults
+    """
+    # Number of threads running the jobs
+    pool_size: int = Field(default=10)
+    # Seconds of waiting for a thread worth one priority point, 0 to disable
+    aging: int = Field(default=60)
+    # Max number of concurrently running instances of a job
+    max_instances: int = Field(default=1)
+    # Run a job once instead of several times when several runs are due
+    coalesce: bool = Field(default=True)
+    # Seconds after the scheduled time during which a late run is still allowed
+    misfire_grace_time: int = Field(default=60)
+
+
 class SystemConfig(BaseModel):
     """General system configuration
     """
@@ -34,8 +100,15 @@ class SystemConfig(BaseModel):
     logs: LogsConfig
     input: Optional[str] = Field(default=None)   # Input folder prefix
     output: Optional[str] = Field(default=None)  # Output folder prefix
+    state: str = Field(default='state')  # Runtime state folder (file indexes...)
     attempts: int = Field(default=3)
     wait: int = Field(default=5)
+    max_wait: int = Field(default=300)
+    # Number of days the job runs are kept in the run history, 0 to keep them forever
+    history_days: int = Field(default=90)
+    breaker: BreakerConfig = Field(default=BreakerConfig())
+    scheduler: SchedulerConfig = Field(default=SchedulerConfig())
+    upload: UploadConfig = Field(default=UploadConfig())
 
 # Enum for time unit
 
@@ -47,16 +120,36 @@ class Interval(BaseModel):
     unit: str  # minutes, hours, days, weeks
 
 
+class WatchConfig(BaseModel):
+    """Input folder watching, to trigger the job when files are written
+    """
+    # Seconds without new events before the job is triggered
+    debounce: float = Field(default=2)
+    # Seconds between two folder listings, when inotify is not available
+    poll: int = Field(default=10)
+    # Seconds between two runs without any event, as a safety net
+    interval: int = Field(default=3600)
+
+
 class ScheduleConfig(BaseModel):
-    """Scheduler triggering settings, cron and/or interval based"""
+    """Scheduler triggering settings, cron, interval and/or input folder watch based"""
     cron: Optional[str] = Field(default=None)
     interval: Optional[Interval] = Field(default=None)
+    watch: Optional[WatchConfig] = Field(default=None)
+    # Job settings, override the system scheduler settings
+    max_instances: Optional[int] = Field(default=None)
+    coalesce: Optional[bool] = Field(default=None)
+    misfire_grace_time: Optional[int] = Field(default=None)
 
 
 class CommandConfig(BaseModel):
     """A command to be executed"""
     command: str
     args: List[str] = Field(default=[])
+    # Seconds after which the command is killed
+    timeout: Optional[int] = Field(default=None)
+    # Max number of bytes of each output stream written to the logs
+    max_output: int = Field(default=65536)
 
 
 class FileFilter(BaseModel):
@@ -66,28 +159,85 @@ class FileFilter(BaseModel):
     skip: Optional[int] = Field(default=0)
 
 
+class StableConfig(BaseModel):
+    """When a file is considered completely written
+    """
+    # Seconds during which the file size and mtime must not change
+    quiet: int = Field(default=10)
+    # Suffix of the lock file which presence indicates the file is being written, e.g. ".lock"
+    lock: Optional[str] = Field(default=None)
+    # Suffix of the sentinel file which presence indicates the file is complete, e.g. ".done"
+    sentinel: Optional[str] = Field(default=None)
+
+
 class InputConfig(IOConfig):
     """Source folder, where the instrument files are located.
     """
     filter: Optional[FileFilter] = Field(default=None)
+    stable: Optional[StableConfig] = Field(default=None)
+    # Max number of files handled per run, the oldest first
+    max_files: Optional[int] = Field(default=None)
+
+
+class CompressConfig(BaseModel):
+    """Compression of the files while they are uploaded
+    """
+    format: Literal['gzip', 'zstd'] = Field(default='gzip')
+    # Compression level, 1 (fast) to 9 for gzip, 1 to 22 for zstd, defaults to the format default
+    level: Optional[int] = Field(default=None)
+
+    @model_validator(mode='after')
+    def check_format(self) -> 'CompressConfig':
+        low, high = COMPRESS_LEVELS[self.format]
+        if self.level is not None and not low <= self.level <= high:
+            raise ValueError(
+                f"The {self.format} compression level must be from {low} to {high}")
+        if self.format == 'zstd' and importlib.util.find_spec('zstandard') is None:
+            raise ValueError(
+                "The zstd compression requires the zstandard package, e.g. pip install flaked[zstd]")
+        return self
 
 
 class OutputConfig(IOConfig):
     """Destination folder, after the instrument files have been uploaded.
     """
-    pass
+    # Max number of files uploaded in parallel, overrides the system setting
+    concurrency: Optional[int] = Field(default=None)
+    compress: Optional[CompressConfig] = Field(default=None)
+    # Pack the files of a run in a single tar archive, compressed as a whole if compress is set
+    bundle: bool = Field(default=False)
+    # Remote subfolder pattern from the file modification date, e.g. "%Y/%m/%d"
+    partition: Optional[str] = Field(default=None)
+    # Skip the files which same content was already uploaded to the same remote path
+    dedup: bool = Field(default=False)
+    # Check the remote file after upload, by its size or by its size and checksum (read back)
+    verify: Optional[Literal['size', 'checksum']] = Field(default=None)
+    # Max upload throughput in bytes per second for the instrument
+    rate: Optional[int] = Field(default=None)
+
+
+class PipelineConfig(BaseModel):
+    """Streaming of the input files through the upload and move stages, batch by batch
+    """
+    # Number of files per batch
+    batch: int = Field(default=100)
+    # Max number of batches waiting for each stage
+    queue: int = Field(default=2)
 
 
 class InstrumentConfig(BaseModel):
     """Instrument configuration, scheduling and folders
     """
     name: str
+    # The instruments with the highest priority are served first when the uploads are throttled
+    priority: int = Field(default=0)
     schedule: ScheduleConfig
     preprocess: Optional[CommandConfig] = Field(default=None)
     postprocess: Optional[CommandConfig] = Field(default=None)
     input: InputConfig
     output: OutputConfig
     logs: Optional[LogsConfig] = Field(default=None)
+    pipeline: Optional[PipelineConfig] = Field(default=None)
 
 
 class Config(BaseModel):
@@ -1,4 +1,6 @@
 
+from typing import Optional
+from datetime import datetime
 from pydantic import BaseModel, Field
 from enum import Enum
 
@@ -24,3 +26,26 @@ class Status(BaseModel):
     """Status of the scheduler or of a scheduled job
     """
     status: StatusValue
+
+
+class RunStatus(str, Enum):
+    """Status of an on-demand job run
+    """
+    pending = "pending"
+    running = "running"
+    success = "success"
+    failure = "failure"
+
+
+class Run(BaseModel):
+    """An on-demand job run
+    """
+    id: str
+    job_id: str
+    status: RunStatus = Field(default=RunStatus.pending)
+    submitted: datetime
+    started: Optional[datetime] = Field(default=None)
+    finished: Optional[datetime] = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    # Number of files read, uploaded and moved
+    result: Optional[dict] = Field(default=None)
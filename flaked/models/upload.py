@@ -0,0 +1,49 @@
+from typing import List, Optional
+from pathlib import Path
+from pydantic import BaseModel, Field
+from enum import Enum
+
+
+class UploadState(str, Enum):
+    """Upload state of a file
+    """
+    pending = "pending"
+    in_flight = "in_flight"
+    done = "done"
+    failed = "failed"
+
+
+class UploadResult(BaseModel):
+    """Outcome of the upload of a single file, updated over the attempts
+    """
+    path: Path
+    remote_path: str
+    state: UploadState = Field(default=UploadState.pending)
+    error: Optional[str] = Field(default=None)
+    # Number of upload attempts
+    attempts: int = Field(default=0)
+    # Local file size, and modification time in nanoseconds
+    size: int = Field(default=0)
+    mtime: int = Field(default=0)
+    # Digest of the local file content, and of the remote file content (differs when compressed), computed while uploading
+    digest: Optional[str] = Field(default=None)
+    remote_digest: Optional[str] = Field(default=None)
+    # Whether the remote file was checked after upload
+    verified: bool = Field(default=False)
+    # Whether the upload was skipped, as the same content is already on the remote
+    duplicate: bool = Field(default=False)
+    # Bytes already on the remote when the last attempt started
+    offset: int = Field(default=0)
+    # Bytes sent over the wire, all attempts together
+    sent: int = Field(default=0)
+    # Compression format, and size of the compressed file
+    compression: Optional[str] = Field(default=None)
+    compressed: Optional[int] = Field(default=None)
+    # CPU seconds spent compressing
+    cpu: float = Field(default=0)
+    # Local files packed in the uploaded archive, if it is a bundle
+    members: List[Path] = Field(default=[])
+
+    @property
+    def success(self) -> bool:
+        return self.state == UploadState.done
@@ -0,0 +1,103 @@
+from typing import Callable, IO, List
+import logging
+import subprocess
+import threading
+import time
+
+# Max number of characters read at once, a longer line is passed on in pieces
+MAX_LINE = 8192
+
+# Marker logged in place of the output lines beyond the size cap
+TRUNCATED = "[output truncated]"
+
+
+class OutputReader:
+    """Reads a pipe line by line in a background thread, passing the lines on until a size cap is reached,
+    and draining the rest so that the process never blocks on a full pipe.
+    """
+
+    def __init__(self, pipe: IO[str], on_line: Callable[[str], None], max_bytes: int):
+        self.pipe = pipe
+        self.on_line = on_line
+        self.max_bytes = max_bytes
+        # Number of bytes read, and passed on
+        self.size = 0
+        self.logged = 0
+        self.truncated = False
+        self.failed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start reading, in a background thread."""
+        self.thread.start()
+
+    def join(self, timeout: float = None):
+        """Wait until the pipe is closed."""
+        self.thread.join(timeout)
+
+    def _run(self):
+        try:
+            for line in iter(lambda: self.pipe.readline(MAX_LINE), ""):
+                length = len(line.encode(errors="replace"))
+                self.size += length
+                if self.truncated:
+                    continue
+                if self.max_bytes and self.logged + length > self.max_bytes:
+                    self.truncated = True
+                    self._pass_on(TRUNCATED)
+                    continue
+                self.logged += length
+                self._pass_on(line.rstrip("\r\n"))
+        finally:
+            self.pipe.close()
+
+    def _pass_on(self, line: str):
+        # the pipe must be drained whatever the callback does
+        try:
+            self.on_line(line)
+        except Exception as e:
+            if not self.failed:
+                self.failed = True
+                logging.error(f"Handling command output failed: {e}")
+
+
+def run_command(args: List[str], on_stdout: Callable[[str], None], on_stderr: Callable[[str], None],
+                timeout: float = None, max_output: int = None) -> dict:
+    """Run a command, passing its output on line by line while it runs.
+
+    Args:
+        args (List[str]): The command and its arguments
+        on_stdout (Callable[[str], None]): Called with each line of the standard output
+        on_stderr (Callable[[str], None]): Called with each line of the standard error
+        timeout (float, optional): Seconds after which the command is killed. Defaults to None (no limit).
+        max_output (int, optional): Max number of bytes passed on per stream, the rest is dropped. Defaults to None (no limit).
+
+    Returns:
+        dict: The `returncode`, the `duration` in seconds, whether the command `timed_out`,
+        the `stdout` and `stderr` sizes in bytes and whether they were `truncated`
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.DEVNULL, text=True, errors="replace")
+    readers = [OutputReader(process.stdout, on_stdout, max_output),
+               OutputReader(process.stderr, on_stderr, max_output)]
+    for reader in readers:
+        reader.start()
+    timed_out = False
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        process.kill()
+        process.wait()
+    # the pipes may be held open by a child of the killed process
+    for reader in readers:
+        reader.join(1 if timed_out else None)
+    return {
+        'returncode': process.returncode,
+        'duration': time.monotonic() - start,
+        'timed_out': timed_out,
+        'stdout': readers[0].size,
+        'stderr': readers[1].size,
+        'truncated': readers[0].truncated or readers[1].truncated,
+    }
@@ -1,4 +1,5 @@
 import logging
+import os
 import yaml
 from pathlib import Path
 from platformdirs import PlatformDirs
@@ -46,6 +47,32 @@ class ConfigService:
                 return inst
         return None
 
+    def get_input_path(self, path: str) -> Path:
+        """Resolve an instrument input folder path
+
+        Args:
+            path (str): The input folder path, absolute or relative to the input folder prefix
+
+        Returns:
+            Path: The input folder path
+        """
+        if Path(path).is_absolute():
+            return Path(path)
+        return Path(self.config.settings.input if self.config.settings.input else os.getcwd()) / path
+
+    def get_output_path(self, path: str) -> Path:
+        """Resolve an instrument output folder path
+
+        Args:
+            path (str): The output folder path, absolute or relative to the output folder prefix
+
+        Returns:
+            Path: The output folder path
+        """
+        if Path(path).is_absolute():
+            return Path(path)
+        return Path(self.config.settings.output if self.config.settings.output else os.getcwd()) / path
+
     def update_config(self, config: Config):
         with open(self.config_file, 'w') as f:
             config_dict = config.model_dump()
@@ -0,0 +1,148 @@
+from typing import Callable, List
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import sys
+import threading
+import time
+from apscheduler.events import JobExecutionEvent, EVENT_JOB_MISSED
+from apscheduler.executors.base import BaseExecutor, run_job
+
+
+class PriorityExecutor(BaseExecutor):
+    """Runs the jobs in a pool of threads, dispatching the waiting jobs by priority and age.
+
+    A waiting job gains one priority point per `aging` seconds, so that a low priority job is not
+    delayed forever by a stream of higher priority ones.
+    """
+
+    def __init__(self, max_workers: int = 10, get_priority: Callable[[object], int] = None, aging: float = 60):
+        """
+        Args:
+            max_workers (int, optional): The number of threads. Defaults to 10.
+            get_priority (Callable, optional): Gives the priority of a job, the highest first. Defaults to None (all equal).
+            aging (float, optional): The seconds of waiting worth one priority point, 0 to disable. Defaults to 60.
+        """
+        super().__init__()
+        self.max_workers = max(1, int(max_workers))
+        self.get_priority = get_priority
+        self.aging = aging
+        self.condition = threading.Condition()
+        # (sort key, sequence, job, run times, priority, submitted time)
+        self.queue: List[tuple] = []
+        self.counter = itertools.count()
+        self.active = 0
+        self.stopped = False
+        self.workers: List[threading.Thread] = []
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.stopped = False
+        self.workers = [threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+                        for i in range(self.max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.stopped = True
+            dropped = self.queue
+            self.queue = []
+            self.condition.notify_all()
+        # the waiting jobs will not run, as if they missed their run times
+        for _, _, job, run_times, _, _ in dropped:
+            with self._lock:
+                self._instances[job.id] -= 1
+                if self._instances[job.id] == 0:
+                    del self._instances[job.id]
+            for run_time in run_times:
+                self._scheduler._dispatch_event(JobExecutionEvent(
+                    EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def get_queue(self) -> List[dict]:
+        """Get the jobs waiting for a thread, in dispatch order
+
+        Returns:
+            List[dict]: The job id, priority, position (starting at 1) and seconds waited of each waiting job
+        """
+        now = time.monotonic()
+        with self.condition:
+            entries = sorted(self.queue)
+        return [{
+            'id': entry[2].id,
+            'priority': entry[4],
+            'position': position + 1,
+            'waited': round(now - entry[5], 3),
+        } for position, entry in enumerate(entries)]
+
+    def get_instances(self, job_id: str) -> int:
+        """Get the number of instances of a job waiting for a thread or running
+
+        Args:
+            job_id (str): The job id
+
+        Returns:
+            int: The number of instances submitted and not completed yet
+        """
+        with self._lock:
+            return self._instances.get(job_id, 0)
+
+    def get_active(self) -> int:
+        """Get the number of jobs running
+
+        Returns:
+            int: The number of busy threads
+        """
+        with self.condition:
+            return self.active
+
+    def _do_submit_job(self, job, run_times):
+        # the misfire grace time is checked now rather than once a thread is free, so that a job waiting
+        # for its priority to age is not missed because of that wait
+        if job.misfire_grace_time is not None:
+            now = datetime.now(timezone.utc)
+            grace_time = timedelta(seconds=job.misfire_grace_time)
+            for run_time in run_times:
+                if now - run_time > grace_time:
+                    self._logger.warning(f"Run time of job {job.id} was missed by {now - run_time}")
+                    self._scheduler._dispatch_event(JobExecutionEvent(
+                        EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+            run_times = [run_time for run_time in run_times if now - run_time <= grace_time]
+        priority = 0
+        if self.get_priority:
+            try:
+                priority = self.get_priority(job)
+            except Exception as e:
+                self._logger.warning(f"Cannot get the priority of job {job.id}: {e}")
+        submitted = time.monotonic()
+        # the aging is the same for all the waiting jobs, so their order does not change while they wait
+        key = -priority + (submitted / self.aging if self.aging > 0 else 0)
+        with self.condition:
+            heapq.heappush(self.queue, (key, next(self.counter),
+                           job, run_times, priority, submitted))
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                _, _, job, run_times, _, submitted = heapq.heappop(self.queue)
+                self.active += 1
+            # shifted by the wait for a thread, so that run_job checks the misfire as of the submission
+            waited = timedelta(seconds=time.monotonic() - submitted)
+            try:
+                events = run_job(job, job._jobstore_alias,
+                                 [run_time + waited for run_time in run_times], self._logger.name)
+            except BaseException:
+                self._run_job_error(job.id, *sys.exc_info()[1:])
+            else:
+                self._run_job_success(job.id, events)
+            finally:
+                with self.condition:
+                    self.active -= 1
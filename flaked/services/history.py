@@ -0,0 +1,193 @@
+from typing import List
+from datetime import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from .config import config_service
+
+# Seconds between two removals of the expired runs
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    instrument TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    error TEXT,
+    files INTEGER NOT NULL DEFAULT 0,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    moved INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    stages TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_instrument_started ON runs (instrument, started);
+CREATE INDEX IF NOT EXISTS runs_job_started ON runs (job_id, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+"""
+
+COLUMNS = ["id", "instrument", "job_id", "started", "duration", "outcome", "error",
+           "files", "uploaded", "moved", "bytes", "sent", "stages"]
+
+
+class HistoryService:
+    """Records the job runs in an SQLite database, in the state folder.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.path = None
+        self.pruned = None
+
+    def record(self, run: dict):
+        """Record a job run, and remove the expired runs from time to time.
+        Failures are logged, as recording must not fail the job.
+
+        Args:
+            run (dict): The run `instrument`, `job_id`, `started` (epoch seconds), `duration`, `outcome`, `error`,
+            file counts (`files`, `uploaded`, `moved`), `bytes` uploaded, `sent` over the network, and `stages` durations
+        """
+        try:
+            values = [run.get(column) for column in COLUMNS[1:]]
+            values[-1] = json.dumps(run.get('stages') or {})
+            with self.lock:
+                connection = self._get_connection()
+                with connection:
+                    connection.execute(
+                        f"INSERT INTO runs ({', '.join(COLUMNS[1:])}) VALUES ({', '.join('?' * len(values))})", values)
+                if self.pruned is None or time.monotonic() - self.pruned > PRUNE_INTERVAL:
+                    self._prune(connection)
+        except Exception as e:
+            logging.error(f"Cannot record the run of job {run.get('job_id')}: {e}")
+
+    def get_runs(self, instrument: str, job_id: str = None, start: datetime = None, end: datetime = None,
+                 offset: int = 0, limit: int = 50) -> dict:
+        """Get the runs of an instrument, the most recent first
+
+        Args:
+            instrument (str): The instrument name
+            job_id (str, optional): The job id, to filter by. Defaults to None (all the instrument jobs).
+            start (datetime, optional): The earliest start time. Defaults to None.
+            end (datetime, optional): The latest start time (excluded). Defaults to None.
+            offset (int, optional): The number of runs to skip. Defaults to 0.
+            limit (int, optional): The max number of runs. Defaults to 50.
+
+        Returns:
+            dict: The `total` number of runs matching, the `offset`, the `limit` and the `runs`
+        """
+        where, params = self._get_filter(instrument, job_id, start, end)
+        with self.lock:
+            connection = self._get_connection()
+            total = connection.execute(
+                f"SELECT COUNT(*) FROM runs WHERE {where}", params).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM runs WHERE {where} ORDER BY started DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]).fetchall()
+        return {
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'runs': [self._row_to_dict(row) for row in rows],
+        }
+
+    def get_summary(self, instrument: str, job_id: str = None, start: datetime = None, end: datetime = None) -> List[dict]:
+        """Get the daily totals of the runs of an instrument, the most recent day first
+
+        Args:
+            instrument (str): The instrument name
+            job_id (str, optional): The job id, to filter by. Defaults to None (all the instrument jobs).
+            start (datetime, optional): The earliest start time. Defaults to None.
+            end (datetime, optional): The latest start time (excluded). Defaults to None.
+
+        Returns:
+            List[dict]: The number of runs and failures, the mean and max duration, the files and bytes of each day
+        """
+        where, params = self._get_filter(instrument, job_id, start, end)
+        with self.lock:
+            connection = self._get_connection()
+            rows = connection.execute(
+                f"""SELECT date(started, 'unixepoch', 'localtime') AS day, COUNT(*),
+                SUM(outcome != 'success'), AVG(duration), MAX(duration), SUM(files), SUM(uploaded), SUM(bytes), SUM(sent)
+                FROM runs WHERE {where} GROUP BY day ORDER BY day DESC""", params).fetchall()
+        return [{
+            'day': row[0],
+            'runs': row[1],
+            'failures': row[2],
+            'mean_duration': row[3],
+            'max_duration': row[4],
+            'files': row[5],
+            'uploaded': row[6],
+            'bytes': row[7],
+            'sent': row[8],
+        } for row in rows]
+
+    def close(self):
+        """Close the database, it is opened again when needed."""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def _get_filter(self, instrument: str, job_id: str, start: datetime, end: datetime):
+        where = ["instrument = ?"]
+        params = [instrument]
+        if job_id:
+            where.append("job_id = ?")
+            params.append(job_id)
+        if start:
+            where.append("started >= ?")
+            params.append(start.timestamp())
+        if end:
+            where.append("started < ?")
+            params.append(end.timestamp())
+        return " AND ".join(where), params
+
+    def _row_to_dict(self, row: tuple) -> dict:
+        run = dict(zip(COLUMNS, row))
+        run['started'] = datetime.fromtimestamp(
+            run['started']).astimezone().isoformat()
+        run['stages'] = json.loads(run['stages']) if run['stages'] else {}
+        return run
+
+    def _prune(self, connection: sqlite3.Connection):
+        """Remove the runs older than the retention period, and give the space back. Must be called with the lock held."""
+        self.pruned = time.monotonic()
+        days = config_service.get_settings().history_days
+        if days <= 0:
+            return
+        with connection:
+            deleted = connection.execute(
+                "DELETE FROM runs WHERE started < ?", [time.time() - days * 86400]).rowcount
+        if deleted > 0:
+            connection.execute("PRAGMA incremental_vacuum")
+            logging.info(f"Removed {deleted} runs from the history")
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Open the database if needed, the state folder may have changed. Must be called with the lock held."""
+        path = Path(config_service.get_settings().state) / "history.db"
+        if self.connection is not None and self.path == path:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(path, check_same_thread=False)
+        # set before the tables are created, to be able to shrink the file
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # readers do not block the writer, and a commit does not sync the whole database
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.executescript(SCHEMA)
+        self.connection = connection
+        self.path = path
+        self.pruned = None
+        return connection
+
+
+history_service = HistoryService()
@@ -1,23 +1,57 @@
-from typing import List
+from typing import Callable, Dict, List
+from contextlib import contextmanager
 import logging
-import subprocess
+import json
+import queue
+import threading
 import time
 from pathlib import Path
-import os
-import re
 from .config import config_service
 from .log import log_service
+from .command import run_command
 from .upload import UploadService
+from .retry import CircuitBreaker, breaker_service, get_backoff
+from .scan import scan_service, filter_stable, select_files
+from .ledger import ledger_service
+from .rate import rate_service
+from .history import history_service
+from .metrics import JOB_SECONDS, STAGE_SECONDS, RETRIES, UPLOADED_FILES, FAILED_FILES, SKIPPED_FILES, SENT_BYTES, MOVED_FILES
 from ..models.domain import CommandConfig
+from ..models.upload import UploadResult
+
+
+# Instruments which files are being uploaded, so that a retry and a scheduled run do not upload the same files
+_uploading = set()
+_uploading_lock = threading.Lock()
 
 
 class JobProcessor:
 
-    def __init__(self, job_id: str):
+    def __init__(self, job_id: str, attempt: int = 0, on_retry: Callable[[str, List[Path], int, float], None] = None):
+        """
+        Args:
+            job_id (str): The job id
+            attempt (int, optional): The number of failed upload attempts before this run. Defaults to 0.
+            on_retry (Callable, optional): Called with the job id, the files, the attempt number and a delay in seconds, to schedule the retry of failed uploads. Defaults to None (no retry).
+        """
         self.job_id = job_id
         self.instrument_name = job_id.split(':')[0]
+        self.attempt = attempt
+        self.on_retry = on_retry
+        self.logger = None
+        # Number of input files left aside because they were not stable yet
+        self.unstable = 0
+        # Number of files read, uploaded and moved
+        self.result = {'files': 0, 'uploaded': 0, 'moved': 0}
+        # Number of bytes of the files uploaded, and sent over the network
+        self.bytes = 0
+        self.sent = 0
+        # Seconds spent in each stage
+        self.stages: Dict[str, float] = {}
 
     def process(self):
+        started = time.time()
+        start = time.perf_counter()
         try:
             logging.info(f"Processing data for job {self.job_id}")
             self.config = config_service.get_config()
@@ -29,29 +63,153 @@ class JobProcessor:
             if self.instrument.preprocess:
                 self.pre_process()
 
-            input_files = self.read_input_files()
-            if len(input_files) > 0:
-                uploaded_files = self.upload_files(input_files)
-                if len(uploaded_files) > 0:
-                    self.move_files(uploaded_files)
+            if self.instrument.pipeline:
+                self.run_pipeline()
+            else:
+                with self._stage("scan"):
+                    input_files = self.read_input_files()
+                self.result['files'] = len(input_files)
+                if len(input_files) > 0:
+                    with self._stage("upload"):
+                        uploaded_files = self.upload_files(input_files)
+                    if len(uploaded_files) > 0:
+                        with self._stage("move"):
+                            self.move_files(uploaded_files)
 
             if self.instrument.postprocess:
                 self.post_process()
 
             self.logger.debug([self.job_id, "PROCESS_SUCCESS"])
+            duration = time.perf_counter() - start
+            JOB_SECONDS.observe(
+                duration, instrument=self.instrument_name, outcome="success")
+            self._record(started, duration, "success")
         except Exception as e:
             if self.logger:
                 self.logger.debug([self.job_id, "PROCESS_FAILURE", str(e)])
             logging.error("Pipeline failed", exc_info=True)
+            duration = time.perf_counter() - start
+            JOB_SECONDS.observe(
+                duration, instrument=self.instrument_name, outcome="failure")
+            self._record(started, duration, "failure", str(e))
+            raise
+
+    def retry(self, files: List[Path]):
+        """Upload again the files which upload failed, and move them.
+
+        Args:
+            files (List[Path]): The files to upload
+        """
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            logging.info(f"Retrying upload for job {self.job_id}")
+            self.config = config_service.get_config()
+            self.instrument = config_service.get_instrument_config(
+                self.instrument_name)
+            self.logger = log_service.for_instrument(self.instrument)
+            # some files may have been handled by a scheduled run meanwhile
+            files = [file for file in files if file.exists()]
+            self.logger.debug(
+                [self.job_id, "RETRY_START", f"Attempt {self.attempt + 1}", len(files)])
+            self.result['files'] = len(files)
+            if len(files) > 0:
+                with self._stage("upload"):
+                    uploaded_files = self.upload_files(files)
+                if len(uploaded_files) > 0:
+                    with self._stage("move"):
+                        self.move_files(uploaded_files)
+            self._record(started, time.perf_counter() - start, "success")
+        except Exception as e:
+            if self.logger:
+                self.logger.debug([self.job_id, "RETRY_FAILURE", str(e)])
+            logging.error("Retry failed", exc_info=True)
+            self._record(started, time.perf_counter() - start, "failure", str(e))
             raise
 
+    def run_pipeline(self):
+        """Stream the input files batch by batch: the folder is scanned once, then a batch is moved
+        while the next one is uploaded, through bounded queues.
+
+        Stops when all the files found are handled, or as soon as a batch could not be fully uploaded
+        (its failed files are retried later, the others are left to the next run).
+        """
+        config = self.instrument.pipeline
+        uploads = queue.Queue(maxsize=max(1, config.queue))
+        moves = queue.Queue(maxsize=max(1, config.queue))
+        stop = threading.Event()
+        errors = []
+
+        def upload_stage():
+            while (batch := uploads.get()) is not None:
+                if stop.is_set():
+                    continue
+                try:
+                    with self._stage("upload"):
+                        uploaded = self.upload_files(batch)
+                    if len(uploaded) > 0:
+                        moves.put(uploaded)
+                    if len(uploaded) < len(batch):
+                        stop.set()
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+            moves.put(None)
+
+        def move_stage():
+            failed = False
+            while (batch := moves.get()) is not None:
+                # the uploaded files are moved even when the pipeline stops, unless moving fails
+                if failed:
+                    continue
+                try:
+                    with self._stage("move"):
+                        self.move_files(batch)
+                except Exception as e:
+                    errors.append(e)
+                    failed = True
+                    stop.set()
+
+        stages = [threading.Thread(target=upload_stage, name=f"{self.instrument_name}-upload", daemon=True),
+                  threading.Thread(target=move_stage, name=f"{self.instrument_name}-move", daemon=True)]
+        for stage in stages:
+            stage.start()
+        try:
+            with self._stage("scan"):
+                files = self.read_input_files(ordered=True)
+            size = max(1, config.batch)
+            for i in range(0, len(files), size):
+                if stop.is_set():
+                    break
+                batch = files[i:i + size]
+                self.result['files'] += len(batch)
+                uploads.put(batch)
+        finally:
+            uploads.put(None)
+            for stage in stages:
+                stage.join()
+        self.logger.info(
+            [self.job_id, "PIPELINE", "Pipeline drained", json.dumps(self.result)])
+        if errors:
+            raise errors[0]
+
     def pre_process(self):
-        self._do_process("PRE_PROCESS", self.instrument.preprocess)
+        with self._stage("preprocess"):
+            self._do_process("PRE_PROCESS", self.instrument.preprocess)
 
     def post_process(self):
-        self._do_process("POST_PROCESS", self.instrument.postprocess)
+        with self._stage("postprocess"):
+            self._do_process("POST_PROCESS", self.instrument.postprocess)
 
-    def read_input_files(self) -> List[Path]:
+    def read_input_files(self, ordered: bool = False) -> List[Path]:
+        """Get the input files to handle, the stable ones that are not skipped.
+
+        Args:
+            ordered (bool, optional): Whether to sort the files, the oldest first. Defaults to False.
+
+        Returns:
+            List[Path]: The input files
+        """
         self.logger.debug([self.job_id, "READ_INPUT_FILES",
                           self.instrument.input.path])
 
@@ -67,54 +225,137 @@ class JobProcessor:
             return []
 
         # Define regex pattern (e.g., match .log files starting with "error")
-        pattern = re.compile(
-            self.instrument.input.filter.regex) if self.instrument.input.filter else re.compile('.*')
+        regex = (self.instrument.input.filter.regex if self.instrument.input.filter else None) or '.*'
+
+        # Get filtered files, from the index of the files already seen
+        stable = self.instrument.input.stable
+        quiet = stable.quiet if stable else 0
+        entries = scan_service.scan(self.instrument.name, source, regex, quiet)
+        stats = scan_service.get_stats(self.instrument.name)[self.instrument.name]
+        self.logger.debug(
+            [self.job_id, "READ_INPUT_FILES", f"Scanned in {stats['duration']:.3f} seconds", json.dumps(stats)])
 
-        # Get filtered and sorted files
-        files = sorted(
-            [f for f in source.iterdir() if f.is_file()
-             and pattern.match(f.name)],
-            key=lambda f: f.stat().st_mtime,  # Sort by last modification time
-            reverse=True  # Newest files first
-        )
+        # Leave aside the files that are still being written
+        self.unstable = 0
+        if stable:
+            markers = tuple(
+                suffix for suffix in [stable.lock, stable.sentinel] if suffix)
+            if markers:
+                entries = {name: entry for name, entry in entries.items() if not name.endswith(markers)}
+            ready = filter_stable(entries, quiet)
+            self.unstable = len(entries) - len(ready)
+            entries = ready
 
-        # Skip files if needed
-        if self.instrument.input.filter and self.instrument.input.filter.skip > 0:
-            files = files[self.instrument.input.filter.skip:]
+        # Skip the latest files if needed, and limit the batch size
+        skip = self.instrument.input.filter.skip if self.instrument.input.filter else 0
+        names = select_files(entries, skip, self.instrument.input.max_files)
+        if ordered:
+            names.sort(key=lambda name: entries[name]['mtime'])
+        files = [source / name for name in names]
+        if stable and (stable.lock or stable.sentinel):
+            complete = [file for file in files if self._is_complete(file)]
+            self.unstable += len(files) - len(complete)
+            files = complete
+        if self.unstable > 0:
+            self.logger.debug(
+                [self.job_id, "READ_INPUT_FILES", "Files not stable yet", self.unstable])
 
         self.logger.info(
             [self.job_id, "READ_INPUT_FILES", "Source files count", len(files)])
         return files
 
     def upload_files(self, files: List[Path]) -> List[Path]:
+        endpoint = f"{self.config.settings.sftp.username}@{self.config.settings.sftp.host}:{self.config.settings.sftp.prefix}/{self.instrument.name}"
         self.logger.debug(
-            [self.job_id, "UPLOAD_FILES", "Files to upload", f"{self.config.settings.sftp.username}@{self.config.settings.sftp.host}:{self.config.settings.sftp.prefix}/{self.instrument.name}"])
+            [self.job_id, "UPLOAD_FILES", "Files to upload", endpoint])
         if len(files) == 0:
             return []
 
-        # Upload files
-        upload_service = UploadService()
-        attemps = 0
-        uploaded = []
-        max_attemps = self.config.settings.attempts
-        wait_seconds = self.config.settings.wait
-        while attemps < max_attemps and len(uploaded) == 0:
-            try:
-                uploaded = upload_service.upload_files(
-                    files, self.instrument.name)
-            except Exception as e:
-                attemps += 1
+        with _uploading_lock:
+            if self.instrument.name in _uploading:
+                self.logger.info(
+                    [self.job_id, "UPLOAD_FILES", "Upload already in progress, skipping", endpoint])
+                return []
+            _uploading.add(self.instrument.name)
+        try:
+            return self._upload_files(files, endpoint)
+        finally:
+            with _uploading_lock:
+                _uploading.discard(self.instrument.name)
+
+    def _upload_files(self, files: List[Path], endpoint: str) -> List[Path]:
+        settings = self.config.settings
+        breaker = breaker_service.for_endpoint(settings.sftp, settings.breaker)
+        if not breaker.allow():
+            # do not count an attempt, the endpoint is known to be down
+            delay = max(breaker.get_remaining(), get_backoff(
+                self.attempt + 1, settings.wait, settings.max_wait))
+            self.logger.info(
+                [self.job_id, "UPLOAD_FILES", f"Circuit open, retrying in {delay:.0f} seconds", endpoint])
+            self._schedule_retry(files, self.attempt, delay)
+            return []
+        try:
+            return self._upload_allowed(files, endpoint, breaker)
+        finally:
+            # a probe interrupted by an error must not leave the circuit half open
+            breaker.release()
+
+    def _upload_allowed(self, files: List[Path], endpoint: str, breaker: CircuitBreaker) -> List[Path]:
+        settings = self.config.settings
+        # Single attempt, the failed files are handed back to the scheduler
+        upload_service = UploadService(rate_service.for_instrument(
+            self.instrument.name, self.instrument.output.rate, self.instrument.priority))
+        compress = self.instrument.output.compress
+        if self.instrument.output.bundle:
+            results = [upload_service.make_bundle(
+                files, self.instrument.name, self.instrument.name, compress, self.instrument.output.partition)]
+        else:
+            results = upload_service.make_results(
+                files, self.instrument.name, compress, self.instrument.output.partition)
+            if self.instrument.output.dedup:
+                skipped = ledger_service.skip_uploaded(
+                    self.instrument.name, results, settings.upload.hash_workers)
+                if skipped > 0:
+                    self.logger.info(
+                        [self.job_id, "UPLOAD_FILES", "Skipped files already uploaded", skipped])
+        error = None
+        try:
+            upload_service.upload(
+                results, self.instrument.output.concurrency, compress, self.instrument.output.verify)
+        except Exception as e:
+            error = str(e)
+        if self.instrument.output.dedup and not self.instrument.output.bundle:
+            ledger_service.record(self.instrument.name, results,
+                                  settings.upload.ledger_days * 86400, settings.upload.hash_workers)
+        uploaded = self._get_uploaded(results)
+        self.result['uploaded'] += len(uploaded)
+        self._count_uploads(results)
+        stats = self._get_transfer_stats(results)
+        self.bytes += stats['bytes']
+        self.sent += stats['sent']
+        failed = [result for result in results if not result.success]
+        # the duplicates were not sent, they tell nothing about the endpoint
+        transferred = [result for result in results if not result.duplicate]
+        if any(result.success for result in transferred):
+            breaker.record_success()
+        elif len(transferred) > 0:
+            breaker.record_failure()
+
+        if len(failed) > 0:
+            attempt = self.attempt + 1
+            if attempt < settings.attempts:
+                delay = get_backoff(attempt, settings.wait, settings.max_wait)
                 self.logger.debug(
-                    [self.job_id, "UPLOAD_FILES", f"Failed to upload files, attempt {attemps}, retrying in {wait_seconds} seconds", str(e)])
-                time.sleep(wait_seconds)
+                    [self.job_id, "UPLOAD_FILES", f"Failed to upload {len(failed)} files, attempt {attempt}, retrying in {delay:.0f} seconds", error if error else failed[0].error])
+                self._schedule_retry(
+                    [file for result in failed for file in self._get_files(result)], attempt, delay)
+            else:
+                self.logger.error(
+                    [self.job_id, "UPLOAD_FILES", f"Failed to upload {len(failed)} files after {attempt} attempts", endpoint])
         if len(uploaded) == 0:
-            self.logger.error(
-                [self.job_id, "UPLOAD_FILES", "Failed to upload files", f"{self.config.settings.sftp.username}@{self.config.settings.sftp.host}:{self.config.settings.sftp.prefix}/{self.instrument.name}"])
             return []
-        uploaded = upload_service.upload_files(
-            files, self.instrument.name)
         self.logger.info(
-            [self.job_id, "UPLOAD_FILES", "Uploaded files", len(uploaded)])
+            [self.job_id, "UPLOAD_FILES", "Uploaded files", len(uploaded), json.dumps(stats)])
         return uploaded
 
     def move_files(self, files: List[Path]):
@@ -128,22 +369,112 @@ class JobProcessor:
 
         if not destination.exists():
             destination.mkdir(parents=True)
+        stable = self.instrument.input.stable
         for file in files:
             file.rename(destination / file.name)
+            if stable and stable.sentinel:
+                sentinel = file.with_name(file.name + stable.sentinel)
+                if sentinel.exists():
+                    sentinel.rename(destination / sentinel.name)
+            self.result['moved'] += 1
+            MOVED_FILES.inc(instrument=self.instrument_name)
         self.logger.info([self.job_id, "MOVE_FILES",
                          "Files moved", len(files)])
 
+    def _is_complete(self, file: Path) -> bool:
+        """Check the lock and sentinel files of an input file, if any are expected."""
+        stable = self.instrument.input.stable
+        if stable.lock and file.with_name(file.name + stable.lock).exists():
+            return False
+        if stable.sentinel and not file.with_name(file.name + stable.sentinel).exists():
+            return False
+        return True
+
+    def _schedule_retry(self, files: List[Path], attempt: int, delay: float):
+        if self.on_retry:
+            RETRIES.inc(instrument=self.instrument_name)
+            self.on_retry(self.job_id, files, attempt, delay)
+
+    @contextmanager
+    def _stage(self, stage: str):
+        """Measure the duration of a job stage, in a `with` block, adding up the durations of the stages run several times"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            STAGE_SECONDS.observe(
+                duration, instrument=self.instrument_name, stage=stage)
+            self.stages[stage] = self.stages.get(stage, 0) + duration
+
+    def _record(self, started: float, duration: float, outcome: str, error: str = None):
+        """Record the run in the run history"""
+        history_service.record({
+            'instrument': self.instrument_name,
+            'job_id': self.job_id,
+            'started': started,
+            'duration': duration,
+            'outcome': outcome,
+            'error': error,
+            **self.result,
+            'bytes': self.bytes,
+            'sent': self.sent,
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+        })
+
+    def _count_uploads(self, results: List[UploadResult]):
+        for result in results:
+            files = len(self._get_files(result))
+            if result.duplicate:
+                SKIPPED_FILES.inc(files, instrument=self.instrument_name)
+            elif result.success:
+                UPLOADED_FILES.inc(files, instrument=self.instrument_name)
+            else:
+                FAILED_FILES.inc(files, instrument=self.instrument_name)
+            SENT_BYTES.inc(result.sent, instrument=self.instrument_name)
+
+    def _get_uploaded(self, results: List[UploadResult]) -> List[Path]:
+        """Keep only the files that actually landed on the remote, log the others."""
+        for result in results:
+            if not result.success:
+                self.logger.error(
+                    [self.job_id, "UPLOAD_FILES", "Failed to upload file", result.path.name, result.error])
+        return [file for result in results if result.success for file in self._get_files(result)]
+
+    def _get_files(self, result: UploadResult) -> List[Path]:
+        """Get the local files of an upload, the members of a bundle or the uploaded file."""
+        return result.members if result.members else [result.path]
+
+    def _get_transfer_stats(self, results: List[UploadResult]) -> dict:
+        """Sum up the bytes of the uploaded files and the bytes actually sent over the wire."""
+        stats = {
+            'bytes': sum(result.size for result in results if result.success and not result.duplicate),
+            'sent': sum(result.sent for result in results),
+            'resumed': sum(result.offset for result in results if result.success),
+            # bytes sent more than once (restarted writes) or for files that did not make it
+            'wasted': sum(max(0, result.sent - self._get_stored_size(result)) if result.success else result.sent for result in results),
+        }
+        verified = sum(1 for result in results if result.verified)
+        if verified:
+            stats['verified'] = verified
+        duplicates = sum(1 for result in results if result.duplicate)
+        if duplicates:
+            stats['duplicates'] = duplicates
+        compressed = [result for result in results if result.success and result.compressed is not None]
+        if compressed:
+            stats['compressed'] = sum(result.compressed for result in compressed)
+            stats['ratio'] = round(sum(result.size for result in compressed) / max(1, stats['compressed']), 2)
+            stats['cpu'] = round(sum(result.cpu for result in results), 3)
+        return stats
+
+    def _get_stored_size(self, result: UploadResult) -> int:
+        return result.compressed if result.compressed is not None else result.size
+
     def _get_source(self, file: str) -> Path:
-        path = Path(file)
-        if path.is_absolute():
-            return path
-        return Path(self.config.settings.input if self.config.settings.input else os.getcwd()) / file
+        return config_service.get_input_path(file)
 
     def _get_destination(self, file: str) -> Path:
-        path = Path(file)
-        if path.is_absolute():
-            return path
-        return Path(self.config.settings.output if self.config.settings.output else os.getcwd()) / file
+        return config_service.get_output_path(file)
 
     def _do_process(self, type: str, command_config: CommandConfig):
         if not command_config:
@@ -153,13 +484,15 @@ class JobProcessor:
             args.extend(command_config.args)
         self.logger.info(
             [self.job_id, type, "Executing command", " ".join(args)])
-        process = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        process.wait()
-        pstdout, pstderr = process.communicate()
-        if pstdout:
-            self.logger.info([self.job_id, type, pstdout])
-        if pstderr:
-            self.logger.error([self.job_id, type, pstderr])
-        self.logger.info(
-            [self.job_id, type, "Command executed with return code", process.returncode])
+        stats = run_command(args,
+                            lambda line: self.logger.info(
+                                [self.job_id, type, line]),
+                            lambda line: self.logger.error(
+                                [self.job_id, type, line]),
+                            command_config.timeout, command_config.max_output)
+        if stats['timed_out']:
+            self.logger.error(
+                [self.job_id, type, f"Command killed after {command_config.timeout} seconds", json.dumps(stats)])
+        else:
+            self.logger.info(
+                [self.job_id, type, f"Command executed with return code {stats['returncode']}", json.dumps(stats)])
@@ -0,0 +1,201 @@
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from .config import config_service
+from ..models.upload import UploadResult, UploadState
+
+# Size of the blocks read to compute a digest
+HASH_CHUNK_SIZE = 1048576
+
+
+def new_digest():
+    """Get a new content digest, BLAKE2b which is faster than SHA-256 on 64-bit platforms."""
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path: Path) -> str:
+    """Compute the digest of a file, reading it block by block.
+
+    Args:
+        path (Path): The file path
+
+    Returns:
+        str: The hexadecimal digest
+    """
+    digest = new_digest()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Ledger:
+    """Files uploaded to the remote (size, mtime, digest) by remote path, persisted across restarts.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Remote path -> {'size', 'mtime', 'digest', 'time'}, mtime in nanoseconds, time in seconds
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+
+    def load(self):
+        """Load the ledger from its file, if any."""
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.loads(f.read())['entries']
+        except Exception as e:
+            logging.warning(f"Ignoring invalid ledger {self.path}: {e}")
+
+    def save(self):
+        """Write the ledger to its file, if modified since last saved."""
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'entries': self.entries}))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def prune(self, max_age: float):
+        """Forget the entries recorded more than `max_age` seconds ago."""
+        limit = time.time() - max_age
+        entries = {key: entry for key, entry in self.entries.items()
+                   if entry['time'] >= limit}
+        if len(entries) != len(self.entries):
+            self.entries = entries
+            self.dirty = True
+
+
+class LedgerService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ledgers: Dict[str, Ledger] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+
+    def skip_uploaded(self, name: str, results: List[UploadResult], workers: int = 4) -> int:
+        """Mark as done the files which identical content was already uploaded to the same remote path.
+
+        A file which size and mtime match the recorded ones is not read, the others are hashed in parallel.
+
+        Args:
+            name (str): The instrument name
+            results (List[UploadResult]): The pending uploads
+            workers (int, optional): The number of files hashed in parallel. Defaults to 4.
+
+        Returns:
+            int: The number of files skipped
+        """
+        with self._get_lock(name):
+            ledger = self._get_ledger(name)
+            entries = ledger.entries
+        candidates = []
+        skipped = 0
+        for result in results:
+            entry = entries.get(result.remote_path)
+            if result.success or entry is None:
+                continue
+            stat = result.path.stat()
+            if stat.st_size != entry['size']:
+                continue
+            if stat.st_mtime_ns == entry['mtime']:
+                self._skip(result, entry)
+                skipped += 1
+            else:
+                candidates.append((result, entry))
+        if candidates:
+            with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hash") as executor:
+                digests = executor.map(
+                    lambda candidate: hash_file(candidate[0].path), candidates)
+                for (result, entry), digest in zip(candidates, digests):
+                    if digest == entry['digest']:
+                        self._skip(result, entry)
+                        skipped += 1
+        return skipped
+
+    def record(self, name: str, results: List[UploadResult], max_age: float = None, workers: int = 4):
+        """Record the files uploaded, with their digest.
+
+        Args:
+            name (str): The instrument name
+            results (List[UploadResult]): The uploads, only the successful ones not skipped are recorded
+            max_age (float, optional): The seconds after which the entries are forgotten. Defaults to None (kept forever).
+            workers (int, optional): The number of files hashed in parallel. Defaults to 4.
+        """
+        uploaded = [result for result in results
+                    if result.success and not result.duplicate and not result.members]
+        # the digest is normally computed while uploading
+        missing = [result for result in uploaded if not result.digest]
+        if missing:
+            with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hash") as executor:
+                for result, digest in zip(missing, executor.map(lambda result: hash_file(result.path), missing)):
+                    result.digest = digest
+        now = time.time()
+        with self._get_lock(name):
+            ledger = self._get_ledger(name)
+            if uploaded:
+                # replaced, never updated, as it may be read without the lock
+                entries = dict(ledger.entries)
+                for result in uploaded:
+                    entries[result.remote_path] = {
+                        'size': result.size,
+                        'mtime': result.mtime,
+                        'digest': result.digest,
+                        'time': now,
+                    }
+                ledger.entries = entries
+                ledger.dirty = True
+            if max_age:
+                ledger.prune(max_age)
+            ledger.save()
+
+    def clear(self, name: str):
+        """Forget the ledger of an instrument, and delete its file.
+
+        Args:
+            name (str): The instrument name
+        """
+        with self._get_lock(name):
+            ledger = self._get_ledger(name)
+            self.ledgers.pop(name, None)
+            if ledger.path.exists():
+                ledger.path.unlink()
+
+    def _skip(self, result: UploadResult, entry: dict):
+        result.state = UploadState.done
+        result.duplicate = True
+        result.size = entry['size']
+        result.mtime = entry['mtime']
+        result.digest = entry['digest']
+
+    def _get_lock(self, name: str) -> threading.Lock:
+        with self.lock:
+            if name not in self.locks:
+                self.locks[name] = threading.Lock()
+            return self.locks[name]
+
+    def _get_ledger(self, name: str) -> Ledger:
+        if name not in self.ledgers:
+            ledger = Ledger(self._get_state_path() / f"{name}.ledger.json")
+            ledger.load()
+            self.ledgers[name] = ledger
+        return self.ledgers[name]
+
+    def _get_state_path(self) -> Path:
+        return Path(config_service.get_settings().state)
+
+
+ledger_service = LedgerService()
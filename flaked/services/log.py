@@ -1,12 +1,20 @@
 
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+from datetime import datetime
+from itertools import groupby
+import asyncio
 import logging
 import csv
 import io
+import os
+import threading
+import time
+import zipfile
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 from ..models.domain import InstrumentConfig
 from .config import config_service
+from .search import search_service
 
 # Configure logging
 logging.basicConfig(
@@ -15,6 +23,101 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
 )
 
+# Number of rotated log files kept
+BACKUP_COUNT = 5
+# Size of the blocks read backwards to tail a log file
+TAIL_BLOCK_SIZE = 65536
+# Number of log lines waiting to be sent to a follower, the next ones are dropped
+FOLLOW_QUEUE_SIZE = 1000
+# Size of the blocks read from the log files to build a zip archive
+ZIP_CHUNK_SIZE = 65536
+
+
+def tail_files(paths: List[Path], lines: int, end: int = None) -> List[bytes]:
+    """Get the last lines of a set of rotated files, reading them backwards from their end, block by block,
+    so that the cost does not depend on the files size.
+
+    Args:
+        paths (List[Path]): The files, the newest first
+        lines (int): The number of lines
+        end (int, optional): The offset where to stop reading the newest file. Defaults to None (its end).
+
+    Returns:
+        List[bytes]: The lines, the oldest first
+    """
+    result = []
+    for i, path in enumerate(paths):
+        if len(result) >= lines:
+            break
+        try:
+            result = tail_file(path, lines - len(result), end if i == 0 else None) + result
+        except FileNotFoundError:
+            # rotated meanwhile
+            continue
+    return result
+
+
+def tail_file(path: Path, lines: int, end: int = None) -> List[bytes]:
+    """Get the last lines of a file, reading it backwards from its end, block by block.
+
+    Args:
+        path (Path): The file path
+        lines (int): The number of lines
+        end (int, optional): The offset where to stop reading. Defaults to None (the end of the file).
+
+    Returns:
+        List[bytes]: The lines, with their line ending
+    """
+    if lines <= 0:
+        return []
+    chunks = []
+    newlines = 0
+    with open(path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        if end is not None:
+            position = min(position, end)
+        # one more line ending than lines is needed, to be sure that the first line is complete
+        while position > 0 and newlines <= lines:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            file.seek(position)
+            chunk = file.read(size)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+    result = b''.join(reversed(chunks)).splitlines(keepends=True)
+    if position > 0:
+        # the first line may be partial
+        result = result[1:]
+    return result[-lines:]
+
+
+class PositionedFileHandler(RotatingFileHandler):
+    """Writes the log records to a rotating file, and tells on each record where it ends in the files:
+    the number of rotations so far and the offset in the file.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation = 0
+
+    def doRollover(self):
+        super().doRollover()
+        self.generation += 1
+
+    def emit(self, record):
+        super().emit(record)
+        if self.stream is not None:
+            record.log_position = (self.generation, self.stream.tell())
+
+    def get_position(self) -> Tuple[int, int]:
+        """Get the end of the records written so far.
+
+        Returns:
+            Tuple[int, int]: The number of rotations and the offset in the current file
+        """
+        with self.lock:
+            return self.generation, self.stream.tell() if self.stream is not None else 0
+
 
 class CSVFormatter(logging.Formatter):
     def __init__(self):
@@ -29,6 +132,223 @@ class CSVFormatter(logging.Formatter):
         return stringIO.getvalue().strip()
 
 
+def read_chunks(path: Path) -> Iterator[bytes]:
+    """Read a file block by block.
+
+    Args:
+        path (Path): The file path
+
+    Yields:
+        bytes: The blocks
+    """
+    with open(path, 'rb') as file:
+        while chunk := file.read(ZIP_CHUNK_SIZE):
+            yield chunk
+
+
+class _ZipBuffer(io.RawIOBase):
+    """An unseekable output collecting the bytes written by `ZipFile`, until taken.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(members: Iterable[Tuple[str, float, Iterable[bytes]]], compression: int = None) -> Iterator[bytes]:
+    """Generate a zip archive as it is built, without a temporary file: the entries sizes and checksums are
+    written after their data, so that the memory used does not depend on the size of the files.
+
+    Args:
+        members (Iterable[Tuple[str, float, Iterable[bytes]]]): The name in the archive, the modification time (epoch seconds) and the blocks of each entry
+        compression (int, optional): The compression level, from 0 (no compression) to 9. Defaults to None (the zlib default).
+
+    Yields:
+        bytes: The blocks of the archive
+    """
+    buffer = _ZipBuffer()
+    method = zipfile.ZIP_STORED if compression == 0 else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(buffer, 'w', method, compresslevel=compression) as archive:
+        for name, mtime, chunks in members:
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.compress_type = method
+            # ZipFile.open only applies the archive level to an entry opened by name, not to a ZipInfo
+            if hasattr(info, 'compress_level'):
+                info.compress_level = archive.compresslevel
+            else:
+                # before Python 3.13, the attribute is private
+                info._compresslevel = archive.compresslevel
+            with archive.open(info, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    if data := buffer.take():
+                        yield data
+            if data := buffer.take():
+                yield data
+    if data := buffer.take():
+        yield data
+
+
+class DroppedLines:
+    """Queued in place of the log lines dropped because a follower did not keep up.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+
+class LogSubscription:
+    """The log lines of an instrument to send to a follower, queued in its event loop.
+    """
+
+    def __init__(self, name: str, loop: asyncio.AbstractEventLoop, max_size: int = FOLLOW_QUEUE_SIZE):
+        self.name = name
+        self.loop = loop
+        self.max_size = max_size
+        # bounded by the number of lines, a drop marker always following a line
+        self.queue = asyncio.Queue()
+        self.lines = 0
+        # The drop marker last queued, as long as no line was queued after it
+        self.dropped: DroppedLines = None
+        # The lines ending at or before this log position were already sent, with the tail of the files
+        self.after: Tuple[int, int] = None
+
+    def publish(self, line: str, position: Tuple[int, int] = None):
+        """Queue a line, from any thread, without waiting.
+
+        Args:
+            line (str): The log line
+            position (Tuple[int, int], optional): Where the line ends in the log files. Defaults to None (unknown).
+        """
+        try:
+            self.loop.call_soon_threadsafe(self._put, line, position)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+
+    async def get(self, timeout: float = None) -> Union[str, DroppedLines]:
+        """Wait for the next line.
+
+        Args:
+            timeout (float, optional): The max seconds to wait. Defaults to None (no limit).
+
+        Raises:
+            asyncio.TimeoutError: If no line was published in time
+
+        Returns:
+            Union[str, DroppedLines]: The log line, or the number of lines dropped at this point
+        """
+        while True:
+            item = await asyncio.wait_for(self.queue.get(), timeout)
+            if item is self.dropped:
+                # later drops go to a new marker
+                self.dropped = None
+                return item
+            if isinstance(item, DroppedLines):
+                return item
+            self.lines -= 1
+            line, position = item
+            # queued before the tail was taken, and already in it
+            if position is None or self.after is None or position > self.after:
+                return line
+
+    def _put(self, line: str, position: Tuple[int, int] = None):
+        if self.lines < self.max_size:
+            self.lines += 1
+            self.dropped = None
+            self.queue.put_nowait((line, position))
+        else:
+            if self.dropped is None:
+                self.dropped = DroppedLines()
+                self.queue.put_nowait(self.dropped)
+            self.dropped.count += 1
+
+
+class LogBroker:
+    """Fans out the log lines of the instruments to their followers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions: Dict[str, Set[LogSubscription]] = {}
+
+    def subscribe(self, name: str, max_size: int = FOLLOW_QUEUE_SIZE) -> LogSubscription:
+        """Follow the log lines of an instrument, from the running event loop.
+
+        Args:
+            name (str): The instrument name
+            max_size (int, optional): The max number of lines waiting to be sent. Defaults to 1000.
+
+        Returns:
+            LogSubscription: The subscription, to unsubscribe when done
+        """
+        subscription = LogSubscription(
+            name, asyncio.get_running_loop(), max_size)
+        with self.lock:
+            self.subscriptions.setdefault(name, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: LogSubscription):
+        """Stop following the log lines.
+
+        Args:
+            subscription (LogSubscription): The subscription
+        """
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.name)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.name]
+
+    def publish(self, name: str, line: str, position: Tuple[int, int] = None):
+        """Send a log line to the followers of an instrument.
+
+        Args:
+            name (str): The instrument name
+            line (str): The log line
+            position (Tuple[int, int], optional): Where the line ends in the log files. Defaults to None (unknown).
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(name, ()))
+        for subscription in subscriptions:
+            subscription.publish(line, position)
+
+    def count(self, name: str) -> int:
+        """Get the number of followers of an instrument."""
+        with self.lock:
+            return len(self.subscriptions.get(name, ()))
+
+
+log_broker = LogBroker()
+
+
+class BroadcastHandler(logging.Handler):
+    """Publishes the formatted log records to the followers of the logger.
+    """
+
+    def emit(self, record):
+        if log_broker.count(record.name) == 0:
+            return
+        try:
+            log_broker.publish(record.name, self.format(record),
+                               getattr(record, 'log_position', None))
+        except Exception:
+            self.handleError(record)
+
+
 class InstrumentLogger:
 
     def __init__(self, inst_config: InstrumentConfig):
@@ -45,7 +365,7 @@ class InstrumentLogger:
             self.logger.setLevel(logging.INFO)
 
         # Log file path
-        self.log_path = f"{inst_config.name}.log"
+        self.log_path = Path(f"{inst_config.name}.log")
         if inst_config.logs:
             self.log_path = Path(inst_config.logs.path) / \
                 f"{inst_config.name}.log"
@@ -57,13 +377,17 @@ class InstrumentLogger:
             self.log_path.parent.mkdir(parents=True)
 
         print(f"Logging to {self.log_path}")
-        handler = RotatingFileHandler(
+        handler = PositionedFileHandler(
             self.log_path,         # Log file name
             maxBytes=1000000,  # 1 MB before rotation
-            backupCount=5      # Keep last 5 log files
+            backupCount=BACKUP_COUNT  # Keep last 5 log files
         )
         handler.setFormatter(CSVFormatter())
         self.logger.addHandler(handler)
+        broadcast = BroadcastHandler()
+        broadcast.setFormatter(CSVFormatter())
+        self.logger.addHandler(broadcast)
+        self.handlers = [handler, broadcast]
 
     def get_log_path(self) -> Path:
         """Get the log file path.
@@ -74,16 +398,44 @@ class InstrumentLogger:
         return self.log_path
 
     def get_log_paths(self) -> List[Path]:
-        """Get the log files path.
+        """Get the log files path, the current one then the rotated ones (`.log.1` to `.log.5`), the newest first.
 
         Returns:
-            Path: The log files path
+            List[Path]: The log files path
         """
         base_path = self.log_path
         files = [base_path] + \
-            [base_path.with_suffix(f".{i}.log") for i in range(1, 5)]
+            [Path(f"{base_path}.{i}") for i in range(1, BACKUP_COUNT + 1)]
         return [f for f in files if f.exists()]
 
+    def get_position(self) -> Tuple[int, int]:
+        """Get the end of the log lines written so far, to tail the logs up to it.
+
+        Returns:
+            Tuple[int, int]: The number of rotations and the offset in the current file
+        """
+        return self.handlers[0].get_position()
+
+    def tail(self, lines: int, position: Tuple[int, int] = None) -> List[bytes]:
+        """Get the last lines of the logs, spanning the rotated files if needed.
+
+        Args:
+            lines (int): The number of lines
+            position (Tuple[int, int], optional): Where to stop, from `get_position`. Defaults to None (the end).
+
+        Returns:
+            List[bytes]: The lines, the oldest first
+        """
+        if position is None:
+            return tail_files(self.get_log_paths(), lines)
+        generation, end = position
+        # the file current at that position was renamed by the rotations since
+        rotations = self.handlers[0].generation - generation
+        base_path = self.log_path
+        files = [base_path] + \
+            [Path(f"{base_path}.{i}") for i in range(1, BACKUP_COUNT + 1)]
+        return tail_files(files[rotations:], lines, end)
+
     def debug(self, message: str):
         """Output formatted debug message.
 
@@ -116,6 +468,12 @@ class InstrumentLogger:
         """
         return self.logger
 
+    def close(self):
+        """Detach and close the handlers of the wrapped logger."""
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+
     def _format(self, message: str) -> list:
         if isinstance(message, list):
             return message
@@ -141,14 +499,50 @@ class LogService:
         self.loggers[inst_config.name] = InstrumentLogger(inst_config)
         return self.loggers[inst_config.name]
 
+    def zip_logs(self, instruments: List[InstrumentConfig], start: datetime = None, end: datetime = None,
+                 compression: int = None, folders: bool = False) -> Iterator[bytes]:
+        """Generate a zip archive of the log files of instruments, as it is built.
+
+        Args:
+            instruments (List[InstrumentConfig]): The instruments configuration
+            start (datetime, optional): The earliest time of the log records to keep. Defaults to None.
+            end (datetime, optional): The latest time of the log records to keep (excluded). Defaults to None.
+            compression (int, optional): The compression level, from 0 (no compression) to 9. Defaults to None (the zlib default).
+            folders (bool, optional): Whether to put the log files of each instrument in a folder. Defaults to False.
+
+        Yields:
+            bytes: The blocks of the archive
+        """
+        def members():
+            for instrument in instruments:
+                prefix = f"{instrument.name}/" if folders else ""
+                paths = self.for_instrument(instrument).get_log_paths()
+                if start is None and end is None:
+                    for path in paths:
+                        try:
+                            mtime = path.stat().st_mtime
+                        except FileNotFoundError:
+                            # rotated meanwhile
+                            continue
+                        yield prefix + path.name, mtime, read_chunks(path)
+                else:
+                    # only the records in the time range, seeking the files with the log index
+                    records = search_service.iter_records(
+                        instrument.name, paths, start, end)
+                    for path, group in groupby(records, key=lambda record: record[0]):
+                        yield prefix + path.name, time.time(), (data for _, _, data in group)
+
+        return zip_stream(members(), compression)
+
     def clear(self, name: str):
-        """Clear registered logger by name.
+        """Clear registered logger by name, it is created again with the current configuration when needed.
 
         Args:
             name (str): The logger name
         """
-        if name in self.loggers:
-            self.loggers[name] = None
+        logger = self.loggers.pop(name, None)
+        if logger is not None:
+            logger.close()
 
 
 log_service = LogService()
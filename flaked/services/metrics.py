@@ -0,0 +1,219 @@
+from typing import Callable, Dict, Iterator, List, Tuple
+from contextlib import contextmanager
+import bisect
+import math
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """A named metric, with one value (or set of values) per combination of label values.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: List[str] = []):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def render(self) -> Iterator[str]:
+        """Get the lines of the text exposition format."""
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for key, value in self._collect():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+    def _collect(self) -> List[Tuple[Tuple[str, ...], float]]:
+        with self.lock:
+            return sorted(self.values.items())
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """Increment the counter.
+
+        Args:
+            amount (float, optional): The increment. Defaults to 1.
+            labels: The label values
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, either set or collected when rendered."""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: List[str] = [], collect: Callable[[], Dict[Tuple[str, ...], float]] = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        """Set the gauge value.
+
+        Args:
+            value (float): The value
+            labels: The label values
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _collect(self) -> List[Tuple[Tuple[str, ...], float]]:
+        if self.collect is not None:
+            return sorted(self.collect().items())
+        return super()._collect()
+
+
+class Histogram(Metric):
+    """Counts the observed values (e.g. durations) in buckets, with their sum."""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: List[str] = [], buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        """Record a value.
+
+        Args:
+            value (float): The value
+            labels: The label values
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Record the duration of a `with` block, in seconds, even if it raised.
+
+        Args:
+            labels: The label values
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        with self.lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labels, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, help: str, labels: List[str] = []) -> Counter:
+        """Get or create a counter"""
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: List[str] = [], collect: Callable[[], Dict[Tuple[str, ...], float]] = None) -> Gauge:
+        """Get or create a gauge, which values are collected by a function when rendered if provided"""
+        return self._register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: List[str] = [], buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Get or create a histogram"""
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Get all the metrics, in the Prometheus text exposition format
+
+        Returns:
+            str: The metrics
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name not in self.metrics:
+                self.metrics[metric.name] = metric
+            return self.metrics[metric.name]
+
+
+metrics_service = MetricsService()
+
+# Jobs
+JOB_SECONDS = metrics_service.histogram(
+    "flaked_job_seconds", "Duration of the instrument job runs", ["instrument", "outcome"])
+STAGE_SECONDS = metrics_service.histogram(
+    "flaked_job_stage_seconds", "Duration of the job stages: preprocess, scan, upload, move, postprocess", ["instrument", "stage"])
+RETRIES = metrics_service.counter(
+    "flaked_upload_retries_total", "Number of upload retries scheduled", ["instrument"])
+
+# Uploads
+UPLOADED_FILES = metrics_service.counter(
+    "flaked_uploaded_files_total", "Number of files uploaded", ["instrument"])
+FAILED_FILES = metrics_service.counter(
+    "flaked_upload_failures_total", "Number of file uploads failed", ["instrument"])
+SKIPPED_FILES = metrics_service.counter(
+    "flaked_upload_duplicates_total", "Number of file uploads skipped as already on the remote", ["instrument"])
+SENT_BYTES = metrics_service.counter(
+    "flaked_upload_sent_bytes_total", "Number of bytes sent over the network", ["instrument"])
+MOVED_FILES = metrics_service.counter(
+    "flaked_moved_files_total", "Number of files moved to the output folder", ["instrument"])
+TRANSFER_SECONDS = metrics_service.histogram(
+    "flaked_file_transfer_seconds", "Duration of the single file transfers", ["outcome"])
+CONNECT_SECONDS = metrics_service.histogram(
+    "flaked_sftp_connect_seconds", "Duration of the SFTP connection openings", ["endpoint", "outcome"])
+
+# Scheduler
+SCHEDULER_EVENTS = metrics_service.counter(
+    "flaked_scheduler_events_total", "Number of scheduler job events: submitted, skipped, missed, coalesced, executed, error", ["instrument", "event"])
@@ -0,0 +1,308 @@
+from typing import Dict, List, Tuple
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import paramiko
+from ..models.domain import SFTPConfig, PoolConfig
+from .metrics import metrics_service, CONNECT_SECONDS
+
+
+class PooledConnection:
+    """An SSH transport and its SFTP session, as held by the pool.
+    """
+
+    def __init__(self, client: paramiko.SSHClient, sftp: paramiko.SFTPClient):
+        self.client = client
+        self.sftp = sftp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        # Remote folders known to exist, with the time they were checked
+        self.dirs: Dict[str, float] = {}
+
+    def is_active(self) -> bool:
+        """Check that the underlying transport is still up (no round trip).
+
+        Returns:
+            bool: True if the transport is active
+        """
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def is_healthy(self) -> bool:
+        """Check that the SFTP session still answers (one round trip).
+
+        Returns:
+            bool: True if the connection can be used
+        """
+        if not self.is_active():
+            return False
+        try:
+            self.sftp.stat(".")
+        except Exception:
+            return False
+        return True
+
+    def has_dir(self, path: str, ttl: float) -> bool:
+        """Check whether a remote folder was recently seen on this connection (no round trip).
+
+        Args:
+            path (str): The remote folder
+            ttl (float): The number of seconds during which the folder is trusted to exist
+
+        Returns:
+            bool: True if the folder is known to exist
+        """
+        checked = self.dirs.get(path)
+        return checked is not None and time.monotonic() - checked < ttl
+
+    def add_dir(self, path: str):
+        """Remember that a remote folder exists."""
+        self.dirs[path] = time.monotonic()
+
+    def clear_dirs(self):
+        """Forget the remote folders, after an error that may be caused by a missing one."""
+        self.dirs = {}
+
+    def close(self):
+        """Close the SFTP session and the SSH transport, ignoring errors."""
+        try:
+            self.sftp.close()
+        except Exception:
+            pass
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SFTPPool:
+    """Process-wide pool of SFTP connections, keyed by endpoint (host, port, username).
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.idle: Dict[Tuple[str, int, str], List[PooledConnection]] = {}
+        self.leased: Dict[Tuple[str, int, str], int] = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'failed_checks': 0,
+            'discarded': 0,
+        }
+        self.idle_timeout = 300
+        self.reaper = None
+
+    @contextmanager
+    def lease(self, sftp_config: SFTPConfig):
+        """Lease a connection for the duration of a `with` block.
+
+        The connection is given back to the pool on exit, or closed if the
+        block raised, as its state cannot be trusted anymore.
+
+        Args:
+            sftp_config (SFTPConfig): The SFTP endpoint settings
+
+        Yields:
+            PooledConnection: The leased connection
+        """
+        conn = self.acquire(sftp_config)
+        try:
+            yield conn
+        except BaseException:
+            self.release(sftp_config, conn, discard=True)
+            raise
+        self.release(sftp_config, conn)
+
+    def acquire(self, sftp_config: SFTPConfig) -> PooledConnection:
+        """Take an idle healthy connection, or open a new one if the pool is not full.
+
+        Args:
+            sftp_config (SFTPConfig): The SFTP endpoint settings
+
+        Raises:
+            TimeoutError: If no connection became available in time
+
+        Returns:
+            PooledConnection: The connection, to be released afterwards
+        """
+        key = self._get_key(sftp_config)
+        pool_config = sftp_config.pool
+        self.idle_timeout = pool_config.idle_timeout
+        self._start_reaper()
+        deadline = time.monotonic() + pool_config.timeout
+        while True:
+            evicted = []
+            try:
+                with self.condition:
+                    conn = self._wait_idle_or_slot(key, pool_config, deadline, evicted)
+            finally:
+                # closed out of the lock, closing may wait on the network
+                for expired in evicted:
+                    expired.close()
+            if conn is None:
+                break
+            # a recently used connection is known to work, only probe the stale ones
+            stale = time.monotonic() - conn.last_used > pool_config.keepalive
+            if conn.is_active() and (not stale or conn.is_healthy()):
+                with self.condition:
+                    self.stats['hits'] += 1
+                return conn
+            with self.condition:
+                self.stats['failed_checks'] += 1
+                self.leased[key] -= 1
+                self.condition.notify()
+            conn.close()
+        try:
+            return self._connect(sftp_config)
+        except BaseException:
+            with self.condition:
+                self.leased[key] -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, sftp_config: SFTPConfig, conn: PooledConnection, discard: bool = False):
+        """Give back a leased connection.
+
+        Args:
+            sftp_config (SFTPConfig): The SFTP endpoint settings
+            conn (PooledConnection): The leased connection
+            discard (bool, optional): Close the connection instead of keeping it. Defaults to False.
+        """
+        key = self._get_key(sftp_config)
+        with self.condition:
+            self.leased[key] = max(0, self.leased.get(key, 0) - 1)
+            if discard or not conn.is_active():
+                self.stats['discarded'] += 1
+            else:
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(key, []).append(conn)
+                conn = None
+            self.condition.notify()
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        """Close all idle connections. Leased ones are closed when released."""
+        with self.condition:
+            conns = [conn for conns in self.idle.values() for conn in conns]
+            self.idle = {}
+            self.condition.notify_all()
+        for conn in conns:
+            conn.close()
+
+    def get_stats(self) -> dict:
+        """Get the pool statistics
+
+        Returns:
+            dict: The hit/miss counters and the connections per endpoint
+        """
+        with self.condition:
+            keys = set(self.idle.keys()) | set(self.leased.keys())
+            endpoints = {
+                self._format_key(key): {
+                    'idle': len(self.idle.get(key, [])),
+                    'leased': self.leased.get(key, 0),
+                } for key in keys}
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_ratio': self.stats['hits'] / lookups if lookups > 0 else None,
+                'endpoints': endpoints,
+            }
+
+    def _connect(self, sftp_config: SFTPConfig) -> PooledConnection:
+        endpoint = self._format_key(self._get_key(sftp_config))
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(
+            paramiko.AutoAddPolicy())  # Auto accept unknown host keys
+        start = time.perf_counter()
+        try:
+            client.connect(sftp_config.host, sftp_config.port,
+                           sftp_config.username, sftp_config.password)
+        except BaseException:
+            CONNECT_SECONDS.observe(
+                time.perf_counter() - start, endpoint=endpoint, outcome="failure")
+            raise
+        CONNECT_SECONDS.observe(time.perf_counter() - start,
+                                endpoint=endpoint, outcome="success")
+        if sftp_config.pool.keepalive > 0:
+            client.get_transport().set_keepalive(sftp_config.pool.keepalive)
+        try:
+            sftp = client.open_sftp()
+        except BaseException:
+            client.close()
+            raise
+        logging.info(f"Opened SFTP connection to {endpoint}")
+        return PooledConnection(client, sftp)
+
+    def _wait_idle_or_slot(self, key: Tuple[str, int, str], pool_config: PoolConfig, deadline: float,
+                           evicted: List[PooledConnection]) -> PooledConnection:
+        """Reserve either the most recently used idle connection, or a slot for a new one (None).
+        Must be called with the lock held, the expired idle connections are added to `evicted`, to be closed
+        once the lock is released.
+        """
+        while True:
+            evicted.extend(self._evict_idle())
+            conns = self.idle.get(key, [])
+            if conns or self._count(key) < pool_config.max_size:
+                self.leased[key] = self.leased.get(key, 0) + 1
+                if conns:
+                    return conns.pop()
+                self.stats['misses'] += 1
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"No SFTP connection available for {self._format_key(key)}")
+            self.condition.wait(remaining)
+
+    def _evict_idle(self) -> List[PooledConnection]:
+        """Remove from the pool the connections unused for longer than the idle timeout.
+        Must be called with the lock held.
+
+        Returns:
+            List[PooledConnection]: The evicted connections, to be closed once the lock is released
+        """
+        now = time.monotonic()
+        evicted = []
+        for key, conns in self.idle.items():
+            expired = [conn for conn in conns if now -
+                       conn.last_used > self.idle_timeout]
+            if expired:
+                self.idle[key] = [conn for conn in conns if conn not in expired]
+                self.stats['evictions'] += len(expired)
+                evicted.extend(expired)
+        return evicted
+
+    def _start_reaper(self):
+        if self.reaper is not None and self.reaper.is_alive():
+            return
+        self.reaper = threading.Thread(
+            target=self._reap, name="sftp-pool-reaper", daemon=True)
+        self.reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            with self.condition:
+                evicted = self._evict_idle()
+            for conn in evicted:
+                conn.close()
+
+    def _count(self, key: Tuple[str, int, str]) -> int:
+        return len(self.idle.get(key, [])) + self.leased.get(key, 0)
+
+    def _get_key(self, sftp_config: SFTPConfig) -> Tuple[str, int, str]:
+        return (sftp_config.host, sftp_config.port, sftp_config.username)
+
+    def _format_key(self, key: Tuple[str, int, str]) -> str:
+        return f"{key[2]}@{key[0]}:{key[1]}"
+
+
+sftp_pool = SFTPPool()
+
+metrics_service.gauge("flaked_sftp_connections", "Number of pooled SFTP connections, idle or leased", ["endpoint", "state"],
+                      lambda: {(endpoint, state): count for endpoint, counts in sftp_pool.get_stats()['endpoints'].items()
+                               for state, count in counts.items()})
@@ -0,0 +1,181 @@
+from typing import Dict, List, Tuple
+from collections import deque
+import heapq
+import itertools
+import threading
+import time
+from .config import config_service
+
+# Seconds over which the current throughput is measured
+WINDOW = 10
+
+
+class TokenBucket:
+    """Limits a byte rate, while allowing bursts up to the bucket capacity.
+
+    The waiters are served by priority, the highest first, then in arrival order. A request larger than
+    the tokens available is served as soon as the bucket is not in debt: the next requests wait longer.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.condition = threading.Condition()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.waiters: List[Tuple[int, int]] = []
+        self.counter = itertools.count()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: float = None):
+        """Change the rate limit.
+
+        Args:
+            rate (float): The bytes per second, 0 for no limit
+            burst (float, optional): The bucket capacity in bytes. Defaults to one second at the rate.
+        """
+        with self.condition:
+            self._refill()
+            self.rate = rate or 0
+            self.burst = burst if burst else self.rate
+            self.tokens = min(self.tokens, self.burst)
+            self.condition.notify_all()
+
+    def consume(self, size: int, priority: int = 0) -> float:
+        """Take tokens for `size` bytes, waiting for them if needed.
+
+        Args:
+            size (int): The number of bytes to send
+            priority (int, optional): The waiter priority, the highest is served first. Defaults to 0.
+
+        Returns:
+            float: The seconds waited
+        """
+        if self.rate <= 0:
+            return 0
+        start = time.monotonic()
+        with self.condition:
+            ticket = (-priority, next(self.counter))
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self.rate <= 0:
+                        break
+                    if self.waiters[0] == ticket and self.tokens >= 0:
+                        self.tokens -= size
+                        break
+                    timeout = -self.tokens / self.rate if self.waiters[0] == ticket else None
+                    self.condition.wait(timeout)
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+        return time.monotonic() - start
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class InstrumentLimiter:
+    """Throttles the uploads of an instrument, by its own cap and by the global limit, and accounts for them.
+    """
+
+    def __init__(self, name: str, global_bucket: TokenBucket):
+        self.name = name
+        self.global_bucket = global_bucket
+        self.bucket = TokenBucket(0)
+        self.priority = 0
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.waited = 0.0
+        self.recent = deque()
+
+    def consume(self, size: int):
+        """Wait until `size` bytes can be sent.
+
+        Args:
+            size (int): The number of bytes to send
+        """
+        waited = self.bucket.consume(size)
+        waited += self.global_bucket.consume(size, self.priority)
+        now = time.monotonic()
+        with self.lock:
+            self.bytes += size
+            self.waited += waited
+            self.recent.append((now, size))
+            self._prune(now)
+
+    def to_dict(self) -> dict:
+        """Convert the limiter to a dictionary
+
+        Returns:
+            dict: The limits, and the bytes sent, the seconds waited and the current throughput (bytes per second)
+        """
+        with self.lock:
+            self._prune(time.monotonic())
+            return {
+                'rate': self.bucket.rate or None,
+                'priority': self.priority,
+                'bytes': self.bytes,
+                'waited': round(self.waited, 3),
+                'throughput': sum(size for _, size in self.recent) / WINDOW,
+            }
+
+    def _prune(self, now: float):
+        while self.recent and now - self.recent[0][0] > WINDOW:
+            self.recent.popleft()
+
+
+class RateService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(0)
+        self.limiters: Dict[str, InstrumentLimiter] = {}
+
+    def for_instrument(self, name: str, rate: int = None, priority: int = 0) -> InstrumentLimiter:
+        """Get or create the rate limiter of an instrument, updated with the current settings.
+
+        Args:
+            name (str): The instrument name
+            rate (int, optional): The instrument cap in bytes per second. Defaults to None (no cap).
+            priority (int, optional): The instrument priority for the global limit. Defaults to 0.
+
+        Returns:
+            InstrumentLimiter: The rate limiter
+        """
+        upload_config = config_service.get_settings().upload
+        if (self.bucket.rate, self.bucket.burst) != (upload_config.rate, upload_config.burst or upload_config.rate):
+            self.bucket.configure(upload_config.rate, upload_config.burst)
+        with self.lock:
+            if name not in self.limiters:
+                self.limiters[name] = InstrumentLimiter(name, self.bucket)
+            limiter = self.limiters[name]
+        if limiter.bucket.rate != (rate or 0):
+            limiter.bucket.configure(rate or 0)
+        limiter.priority = priority
+        return limiter
+
+    def get_stats(self) -> dict:
+        """Get the rate limits and the transfer accounting
+
+        Returns:
+            dict: The global limit and the accounting of each instrument
+        """
+        with self.lock:
+            limiters = list(self.limiters.values())
+        instruments = {limiter.name: limiter.to_dict() for limiter in limiters}
+        return {
+            'rate': self.bucket.rate or None,
+            'burst': self.bucket.burst or None,
+            'throughput': sum(stats['throughput'] for stats in instruments.values()),
+            'instruments': instruments,
+        }
+
+
+rate_service = RateService()
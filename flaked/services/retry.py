@@ -0,0 +1,145 @@
+from typing import Dict
+import random
+import threading
+import time
+from ..models.domain import SFTPConfig, BreakerConfig
+
+
+def get_backoff(attempt: int, wait: float, max_wait: float) -> float:
+    """Get the delay before the next attempt: exponential backoff with jitter.
+
+    The delay doubles with each attempt, up to the max, and is then randomized
+    in its upper half so that the instruments failing together do not retry together.
+
+    Args:
+        attempt (int): The number of failed attempts so far, starting at 1
+        wait (float): The base delay in seconds
+        max_wait (float): The max delay in seconds
+
+    Returns:
+        float: The delay in seconds
+    """
+    delay = min(max_wait, wait * 2 ** max(0, attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """Stops the calls to an endpoint after consecutive failures, then lets a single call probe it after a while.
+
+    States: `closed` (calls allowed), `open` (calls rejected), `half_open` (one probe call allowed).
+    """
+
+    def __init__(self, name: str, config: BreakerConfig):
+        self.name = name
+        self.config = config
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        """Check whether a call can be made now
+
+        Returns:
+            bool: True if the call is allowed
+        """
+        with self.lock:
+            if self.state == "open" and self._get_remaining() <= 0:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        """Record a successful call, closes the circuit."""
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        """Record a failed call, opens the circuit when the threshold is reached or when the probe failed."""
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or self.failures >= self.config.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End a call, after its outcome was recorded or when it was interrupted: an interrupted probe
+        lets the next call probe the endpoint, instead of leaving the circuit half open forever."""
+        with self.lock:
+            self.probing = False
+
+    def get_remaining(self) -> float:
+        """Get the number of seconds before a call is allowed again
+
+        Returns:
+            float: The seconds, 0 if calls are allowed
+        """
+        with self.lock:
+            return self._get_remaining()
+
+    def to_dict(self) -> dict:
+        """Convert the breaker to a dictionary
+
+        Returns:
+            dict: The breaker state
+        """
+        with self.lock:
+            return {
+                'endpoint': self.name,
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': self._get_remaining(),
+            }
+
+    def _get_remaining(self) -> float:
+        if self.state != "open":
+            return 0
+        return max(0, self.opened_at + self.config.reset - time.monotonic())
+
+
+class BreakerService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def for_endpoint(self, sftp_config: SFTPConfig, breaker_config: BreakerConfig) -> CircuitBreaker:
+        """Get or create the circuit breaker of an SFTP endpoint
+
+        Args:
+            sftp_config (SFTPConfig): The SFTP endpoint settings
+            breaker_config (BreakerConfig): The circuit breaker settings
+
+        Returns:
+            CircuitBreaker: The circuit breaker
+        """
+        name = f"{sftp_config.username}@{sftp_config.host}:{sftp_config.port}"
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, breaker_config)
+            breaker = self.breakers[name]
+            breaker.config = breaker_config
+            return breaker
+
+    def get_breakers(self) -> list:
+        """Get the state of all the circuit breakers
+
+        Returns:
+            list: The breaker states
+        """
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return [breaker.to_dict() for breaker in breakers]
+
+
+breaker_service = BreakerService()
@@ -0,0 +1,271 @@
+from typing import Dict, List
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from .config import config_service
+
+# Directory mtime is only trusted to detect changes when it is older than this,
+# as a file created in the same clock tick as the previous scan would not bump it
+MTIME_MARGIN_NS = 2_000_000_000
+
+
+def filter_stable(entries: Dict[str, dict], quiet: float) -> Dict[str, dict]:
+    """Keep the files which size and mtime have not changed for a quiet period.
+
+    Args:
+        entries (Dict[str, dict]): The file entries by file name, as provided by the scan
+        quiet (float): The quiet period in seconds
+
+    Returns:
+        Dict[str, dict]: The entries of the stable files
+    """
+    if not quiet or quiet <= 0:
+        return entries
+    limit = time.time_ns() - int(quiet * 1_000_000_000)
+    return {name: entry for name, entry in entries.items() if entry.get('stable', entry['mtime']) <= limit}
+
+
+def select_files(entries: Dict[str, dict], skip: int = 0, max_files: int = None) -> List[str]:
+    """Select the files to handle, without sorting all of them.
+
+    The `skip` newest files are left aside (they may still be written), and at most `max_files`
+    of the oldest remaining files are selected: both are top-k selections, in O(n log k).
+
+    Args:
+        entries (Dict[str, dict]): The file entries by file name, as provided by the scan
+        skip (int, optional): The number of newest files to leave aside. Defaults to 0.
+        max_files (int, optional): The max number of files to select. Defaults to None (no limit).
+
+    Returns:
+        List[str]: The selected file names, oldest first if limited, in no particular order otherwise
+    """
+    names = entries.keys()
+    if skip and skip > 0:
+        if skip >= len(entries):
+            return []
+        newest = set(heapq.nlargest(
+            skip, names, key=lambda name: entries[name]['mtime']))
+        names = [name for name in names if name not in newest]
+    if max_files is not None and max_files < len(names):
+        return heapq.nsmallest(max_files, names, key=lambda name: entries[name]['mtime'])
+    return list(names)
+
+
+class FileIndex:
+    """Files already seen in an input folder (size, mtime, inode), persisted across restarts.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.source = None
+        self.regex = None
+        # Input folder mtime and time of the scan that produced the entries
+        self.folder_mtime = 0
+        self.scanned = 0
+        # File name -> {'size', 'mtime', 'inode'}, mtime in nanoseconds
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+
+    def load(self):
+        """Load the index from its file, if any."""
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.source = data['source']
+            self.regex = data['regex']
+            self.folder_mtime = data['folder_mtime']
+            self.scanned = data['scanned']
+            self.entries = data['entries']
+        except Exception as e:
+            logging.warning(f"Ignoring invalid file index {self.path}: {e}")
+
+    def save(self):
+        """Write the index to its file, if modified since last saved."""
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            # dumps is much faster than dump, which streams through the pure python encoder
+            f.write(json.dumps({
+                'source': self.source,
+                'regex': self.regex,
+                'folder_mtime': self.folder_mtime,
+                'scanned': self.scanned,
+                'entries': self.entries,
+            }))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def reset(self, source: str, regex: str):
+        """Forget all entries, for another folder or file name pattern."""
+        self.source = source
+        self.regex = regex
+        self.folder_mtime = 0
+        self.scanned = 0
+        self.entries = {}
+        self.dirty = True
+
+
+class ScanService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes: Dict[str, FileIndex] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+        self.stats: Dict[str, dict] = {}
+
+    def scan(self, name: str, source: Path, regex: str, quiet: float = 0) -> Dict[str, dict]:
+        """Get the files of an input folder which name matches a pattern.
+
+        The directory is listed only if it has changed since the last scan, and only the
+        new or replaced files are stat'ed: the others are taken from the index.
+        With a quiet period, the files that changed recently are stat'ed again, to
+        know since when their size and mtime are stable.
+
+        Args:
+            name (str): The instrument name
+            source (Path): The input folder
+            regex (str): The file name pattern
+            quiet (float, optional): The quiet period in seconds. Defaults to 0 (no stability tracking).
+
+        Returns:
+            Dict[str, dict]: The file entries by file name, with 'size', 'mtime', 'inode' and 'stable' (since when
+            size and mtime did not change), times in nanoseconds, not to be modified
+        """
+        with self._get_lock(name):
+            start = time.perf_counter()
+            index = self._get_index(name)
+            if index.source != str(source) or index.regex != regex:
+                index.reset(str(source), regex)
+            folder_mtime = os.stat(source).st_mtime_ns
+            examined = 0
+            stated = 0
+            fresh = set()
+            full_scan = folder_mtime != index.folder_mtime or index.scanned - \
+                folder_mtime < MTIME_MARGIN_NS
+            if full_scan:
+                scanned = time.time_ns()
+                pattern = re.compile(regex)
+                entries = {}
+                with os.scandir(source) as it:
+                    for entry in it:
+                        examined += 1
+                        if not pattern.match(entry.name) or not entry.is_file():
+                            continue
+                        known = index.entries.get(entry.name)
+                        if known is not None and known['inode'] == entry.inode():
+                            entries[entry.name] = known
+                            continue
+                        stat = entry.stat()
+                        stated += 1
+                        fresh.add(entry.name)
+                        entries[entry.name] = {
+                            'size': stat.st_size,
+                            'mtime': stat.st_mtime_ns,
+                            'inode': stat.st_ino,
+                            # first seen: trust the mtime
+                            'stable': stat.st_mtime_ns,
+                        }
+                # persist only when files came or went, a restart then costs a listing at worst
+                if stated > 0 or len(entries) != len(index.entries):
+                    index.dirty = True
+                index.entries = entries
+                index.folder_mtime = folder_mtime
+                index.scanned = scanned
+                index.save()
+            if quiet > 0:
+                stated += self._update_stability(index, source, quiet, fresh)
+            self.stats[name] = {
+                'time': time.time(),
+                'duration': time.perf_counter() - start,
+                'full_scan': full_scan,
+                'examined': examined,
+                'stated': stated,
+                'files': len(index.entries),
+            }
+            # the entries are replaced, never updated, by the next scans
+            return index.entries
+
+    def _update_stability(self, index: FileIndex, source: Path, quiet: float, fresh: set) -> int:
+        """Stat again the files that are not stable yet, and record when they last changed.
+
+        Returns:
+            int: The number of files stat'ed
+        """
+        now = time.time_ns()
+        limit = now - int(quiet * 1_000_000_000)
+        stated = 0
+        entries = None
+        for file_name, entry in index.entries.items():
+            if file_name in fresh or entry.get('stable', entry['mtime']) <= limit:
+                continue
+            try:
+                stat = os.stat(source / file_name)
+            except FileNotFoundError:
+                continue
+            stated += 1
+            if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime']:
+                if entries is None:
+                    entries = dict(index.entries)
+                entries[file_name] = {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                    'inode': stat.st_ino,
+                    'stable': now,
+                }
+        if entries is not None:
+            index.entries = entries
+            index.dirty = True
+            index.save()
+        return stated
+
+    def get_stats(self, name: str = None) -> dict:
+        """Get the statistics of the last scan of each instrument
+
+        Args:
+            name (str, optional): The instrument name to filter by. Defaults to None.
+
+        Returns:
+            dict: The scan statistics by instrument name
+        """
+        return {key: value for key, value in self.stats.items() if name is None or key == name}
+
+    def clear(self, name: str):
+        """Forget the index of an instrument, and delete its file.
+
+        Args:
+            name (str): The instrument name
+        """
+        with self._get_lock(name):
+            index = self._get_index(name)
+            self.indexes.pop(name, None)
+            self.stats.pop(name, None)
+            if index.path.exists():
+                index.path.unlink()
+
+    def _get_lock(self, name: str) -> threading.Lock:
+        with self.lock:
+            if name not in self.locks:
+                self.locks[name] = threading.Lock()
+            return self.locks[name]
+
+    def _get_index(self, name: str) -> FileIndex:
+        if name not in self.indexes:
+            index = FileIndex(self._get_state_path() / f"{name}.index.json")
+            index.load()
+            self.indexes[name] = index
+        return self.indexes[name]
+
+    def _get_state_path(self) -> Path:
+        return Path(config_service.get_settings().state)
+
+
+scan_service = ScanService()
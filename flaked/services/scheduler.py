@@ -1,31 +1,127 @@
+from typing import List
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Lock, Thread
+import uuid
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from .config import config_service
 from .job import JobProcessor
+from .watch import FolderWatcher
+from .executor import PriorityExecutor
+from .metrics import metrics_service, SCHEDULER_EVENTS
+from ..models.domain import InstrumentConfig
+from ..models.query import Run, RunStatus
 
+# Number of on-demand runs kept in memory
+MAX_RUNS = 100
 
-def process_data(job_id: str = None):
+
+def process_data(job_id: str = None) -> JobProcessor:
     """Launch the job processor
 
     Args:
         job_id (str): The job id is the instrument name with scheduling type
+
+    Returns:
+        JobProcessor: The job processor, after processing
     """
     if job_id:
-        processor = JobProcessor(job_id)
+        processor = JobProcessor(
+            job_id, on_retry=scheduler_service.schedule_retry)
         processor.process()
+        return processor
+
+
+def watch_data(job_id: str = None):
+    """Launch the job processor, again as long as files were written in the watched folder meanwhile
+
+    Args:
+        job_id (str): The watch job id is the instrument name postfixed by `:watch`
+    """
+    if job_id:
+        watcher = scheduler_service.watchers.get(job_id)
+        while True:
+            if watcher:
+                watcher.pending.clear()
+            processor = process_data(job_id)
+            if processor.unstable > 0 and processor.instrument.input.stable:
+                # no more events may come for the files being written, check them again later
+                scheduler_service.defer_job(
+                    job_id, processor.instrument.input.stable.quiet)
+            if watcher is None or not watcher.pending.is_set():
+                break
+
+
+def run_data(job_id: str = None, run_id: str = None):
+    """Launch the job processor on demand, and record the run outcome
+
+    Args:
+        job_id (str): The job id
+        run_id (str): The on-demand run id
+    """
+    with scheduler_service.runs_lock:
+        run = scheduler_service.runs.get(run_id)
+        if run is None or run.status != RunStatus.pending:
+            # given up meanwhile
+            return
+        run.status = RunStatus.running
+        run.started = datetime.now().astimezone()
+    try:
+        processor = process_data(job_id)
+        run.result = processor.result
+        run.status = RunStatus.success
+    except Exception as e:
+        run.error = str(e)
+        run.status = RunStatus.failure
+    finally:
+        run.finished = datetime.now().astimezone()
+
+
+def retry_data(job_id: str = None, files: List[str] = None, attempt: int = 0):
+    """Launch the job processor to upload again some files
+
+    Args:
+        job_id (str): The retry job id is the instrument name postfixed by `:retry`
+        files (List[str]): The paths of the files to upload
+        attempt (int): The number of failed attempts so far
+    """
+    if job_id:
+        processor = JobProcessor(
+            job_id, attempt=attempt, on_retry=scheduler_service.schedule_retry)
+        processor.retry([Path(file) for file in files or []])
 
 
 class SchedulerService:
 
     def __init__(self):
         self.status = "stopped"
-        self.scheduler = BackgroundScheduler()
+        self.scheduler = None
+        # The executor of the scheduler
+        self.executor: PriorityExecutor = None
+        self.watchers = {}
+        # Run counters by job id
+        self.stats = {}
+        self.stats_lock = Lock()
+        # On-demand runs by run id, the most recent last
+        self.runs = OrderedDict()
+        self.runs_lock = Lock()
+        # Id of the last on-demand run submitted, by run job id
+        self.live_runs = {}
+        self.submit_lock = Lock()
+        self.retry_lock = Lock()
         self.start()
 
     # Schedule the pipeline
     def start(self):
         """Start the scheduler"""
+        if self.status == "stopped":
+            # (re)create the scheduler with the current settings
+            self.scheduler = self._make_scheduler()
         self.scheduler.start()
         for instrument in config_service.get_config().instruments:
             self.add_job(instrument.name)
@@ -34,8 +130,13 @@ class SchedulerService:
     def stop(self):
         """Stop the scheduler"""
         if self.status != "stopped":
+            for job_id in list(self.watchers.keys()):
+                self._stop_watcher(job_id)
             self.scheduler.shutdown()
-            self.scheduler = BackgroundScheduler()  # Reset the scheduler
+            # the on-demand runs not started yet never will be
+            for job_id in list(self.live_runs.keys()):
+                self._cancel_run(job_id, "Scheduler stopped")
+            self.scheduler = self._make_scheduler()  # Reset the scheduler
             self.status = "stopped"
 
     def pause(self):
@@ -64,7 +165,10 @@ class SchedulerService:
         Args:
             job_id (str): The job id
         """
+        self._stop_watcher(job_id)
         self.scheduler.remove_job(job_id)
+        if job_id.endswith(':run'):
+            self._cancel_run(job_id, "Job removed")
 
     def pause_job(self, job_id: str):
         """Pause the job
@@ -92,15 +196,113 @@ class SchedulerService:
             self.add_job(job_id)
         self.scheduler.resume_job(job_id)
 
-    def run_job(self, job_id: str):
-        """Run the job immediately (ensure it exists first)
+    def submit_run(self, job_id: str) -> Run:
+        """Submit an on-demand run of the job to the executor, without waiting for its completion.
+
+        If a run of the instrument is already pending or running, that one is returned instead.
 
         Args:
             job_id (str): The job id
+
+        Returns:
+            Run: The run, to be polled by its id
         """
-        if self.scheduler.get_job(job_id) is None:
-            self.add_job(job_id)
-        process_data(job_id)
+        name = self.get_instrument_name(job_id)
+        run_job_id = f"{name}:run"
+        with self.submit_lock:
+            for run in self.get_runs(name):
+                if run.status in (RunStatus.pending, RunStatus.running):
+                    if self._is_live(run_job_id, run):
+                        return run
+                    self._cancel_run(run_job_id, "Run lost", run.id)
+            run = Run(id=str(uuid.uuid4()), job_id=job_id,
+                      submitted=datetime.now().astimezone())
+            with self.runs_lock:
+                self.runs[run.id] = run
+                self.live_runs[run_job_id] = run.id
+                # the oldest finished runs are forgotten first, the others may still be polled
+                finished = [run_id for run_id, other in self.runs.items() if other.finished is not None]
+                for run_id in finished[:max(0, len(self.runs) - MAX_RUNS)]:
+                    del self.runs[run_id]
+            if self.scheduler.get_job(job_id) is None:
+                self.add_job(job_id)
+            if self.status == "running":
+                self.scheduler.add_job(run_data, id=run_job_id, name=name, kwargs={
+                                       "job_id": job_id, "run_id": run.id}, misfire_grace_time=None, max_instances=1, replace_existing=True)
+            else:
+                # no executor to submit to, run in the background anyway
+                Thread(target=run_data, kwargs={
+                       "job_id": job_id, "run_id": run.id}, daemon=True).start()
+        return run
+
+    def get_run(self, run_id: str) -> Run:
+        """Get an on-demand run
+
+        Args:
+            run_id (str): The run id
+
+        Returns:
+            Run: The run, None if not found
+        """
+        return self.runs.get(run_id)
+
+    def get_runs(self, name: str = None) -> List[Run]:
+        """Get the on-demand runs, the most recent first
+
+        Args:
+            name (str, optional): The name of the instrument to filter the runs
+
+        Returns:
+            List[Run]: The runs
+        """
+        with self.runs_lock:
+            runs = list(reversed(self.runs.values()))
+        return [run for run in runs if name is None or self.get_instrument_name(run.job_id) == name]
+
+    def trigger_job(self, job_id: str):
+        """Run the job as soon as possible, unless it is paused
+
+        Args:
+            job_id (str): The job id
+        """
+        job = self.scheduler.get_job(job_id)
+        if job is not None and job.next_run_time is not None:
+            job.modify(next_run_time=datetime.now().astimezone())
+
+    def defer_job(self, job_id: str, delay: float):
+        """Run the job after some delay, unless it is paused or will run earlier anyway
+
+        Args:
+            job_id (str): The job id
+            delay (float): The number of seconds to wait
+        """
+        job = self.scheduler.get_job(job_id)
+        run_time = datetime.now().astimezone() + timedelta(seconds=delay)
+        if job is not None and job.next_run_time is not None and job.next_run_time > run_time:
+            job.modify(next_run_time=run_time)
+
+    def schedule_retry(self, job_id: str, files: List[Path], attempt: int, delay: float):
+        """Schedule a one-off job to upload again some files. A pending retry of the instrument is replaced,
+        its files being added to the ones to upload, with the lowest number of attempts.
+
+        Args:
+            job_id (str): The job id which upload failed
+            files (List[Path]): The files to upload
+            attempt (int): The number of failed attempts so far
+            delay (float): The number of seconds to wait before retrying
+        """
+        name = self.get_instrument_name(job_id)
+        retry_id = f"{name}:retry"
+        trigger = DateTrigger(
+            run_date=datetime.now().astimezone() + timedelta(seconds=delay))
+        paths = [str(file) for file in files]
+        with self.retry_lock:
+            pending = self.scheduler.get_job(retry_id)
+            if pending is not None:
+                paths = list(dict.fromkeys(pending.kwargs.get("files", []) + paths))
+                attempt = min(attempt, pending.kwargs.get("attempt", attempt))
+            self.scheduler.add_job(
+                retry_data, trigger, id=retry_id, name=name, kwargs={"job_id": retry_id, "files": paths, "attempt": attempt}, misfire_grace_time=None, replace_existing=True)
 
     def get_status(self) -> str:
         """Get the status of the scheduler
@@ -117,14 +319,15 @@ class SchedulerService:
         If an instrument name is provided, all jobs for this instrument will be added to the scheduler.
 
         Args:
-            name_or_id (str): Name of the intrument or job id in the format "<instrumentname>:<interval|cron>"
+            name_or_id (str): Name of the intrument or job id in the format "<instrumentname>:<interval|cron|watch>"
         """
         instrument = config_service.get_instrument_config(
             self.get_instrument_name(name_or_id))
         if instrument is None:
             return
+        kind = name_or_id.split(':')[1] if ':' in name_or_id else None
         trigger = None
-        if instrument.schedule.interval and not name_or_id.endswith(":cron"):
+        if instrument.schedule.interval and kind in (None, "interval"):
             if instrument.schedule.interval.unit == "minutes":
                 trigger = IntervalTrigger(
                     minutes=instrument.schedule.interval.value)
@@ -142,15 +345,37 @@ class SchedulerService:
                 if self.scheduler.get_job(job_id):
                     self.scheduler.remove_job(job_id)
                 self.scheduler.add_job(
-                    process_data, trigger, id=job_id, name=instrument.name, kwargs={"job_id": job_id}, replace_existing=True)
+                    process_data, trigger, id=job_id, name=instrument.name, kwargs={"job_id": job_id}, replace_existing=True, **self._get_job_options(instrument))
 
-        if instrument.schedule.cron and not name_or_id.endswith(":interval"):
+        if instrument.schedule.cron and kind in (None, "cron"):
             trigger = CronTrigger.from_crontab(instrument.schedule.cron)
             job_id = f"{instrument.name}:cron"
             if self.scheduler.get_job(job_id):
                 self.scheduler.remove_job(job_id)
             self.scheduler.add_job(
-                process_data, trigger, id=job_id, name=instrument.name, kwargs={"job_id": job_id}, replace_existing=True)
+                process_data, trigger, id=job_id, name=instrument.name, kwargs={"job_id": job_id}, replace_existing=True, **self._get_job_options(instrument))
+
+        if instrument.schedule.watch and kind in (None, "watch"):
+            # the folder events advance the next run time, the interval is a safety net for missed events
+            trigger = IntervalTrigger(seconds=instrument.schedule.watch.interval)
+            job_id = f"{instrument.name}:watch"
+            if self.scheduler.get_job(job_id):
+                self.scheduler.remove_job(job_id)
+            self._stop_watcher(job_id)
+            self.scheduler.add_job(
+                watch_data, trigger, id=job_id, name=instrument.name, kwargs={"job_id": job_id}, replace_existing=True, **self._get_job_options(instrument))
+            regex = (instrument.input.filter.regex if instrument.input.filter else None) or '.*'
+            stable = instrument.input.stable
+            markers = tuple(suffix for suffix in [stable.lock, stable.sentinel] if suffix) if stable else ()
+            watcher = FolderWatcher(config_service.get_input_path(instrument.input.path), regex,
+                                    instrument.schedule.watch, lambda: self.trigger_job(job_id), markers)
+            self.watchers[job_id] = watcher
+            watcher.start()
+        elif kind in (None, "watch"):
+            job_id = f"{instrument.name}:watch"
+            self._stop_watcher(job_id)
+            if self.scheduler.get_job(job_id):
+                self.scheduler.remove_job(job_id)
 
     def get_jobs(self, name: str = None) -> list:
         """Get the list of jobs registered in the scheduler
@@ -189,6 +414,143 @@ class SchedulerService:
         """
         return job_id.split(':')[0]
 
+    def get_executor(self) -> dict:
+        """Get the executor settings and usage
+
+        Returns:
+            dict: The executor pool size, the number of running jobs and the jobs waiting for a thread
+        """
+        return {
+            'pool_size': self.executor.max_workers,
+            'running': self.executor.get_active(),
+            'queue': self.executor.get_queue(),
+        }
+
+    def _make_scheduler(self) -> BackgroundScheduler:
+        settings = config_service.get_settings().scheduler
+        self.executor = PriorityExecutor(settings.pool_size, self._get_priority, settings.aging)
+        scheduler = BackgroundScheduler(
+            executors={'default': self.executor},
+            job_defaults={
+                'max_instances': settings.max_instances,
+                'coalesce': settings.coalesce,
+                'misfire_grace_time': settings.misfire_grace_time,
+            })
+        scheduler.add_listener(self._on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES |
+                               EVENT_JOB_MISSED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        return scheduler
+
+    def _get_priority(self, job) -> int:
+        """Get the priority of a job, the one of its instrument"""
+        instrument = config_service.get_instrument_config(
+            self.get_instrument_name(job.id))
+        return instrument.priority if instrument else 0
+
+    def _get_job_options(self, instrument: InstrumentConfig) -> dict:
+        """Get the instrument job settings, the ones not defined default to the system settings"""
+        settings = config_service.get_settings().scheduler
+        schedule = instrument.schedule
+        return {
+            'max_instances': schedule.max_instances if schedule.max_instances is not None else settings.max_instances,
+            'coalesce': schedule.coalesce if schedule.coalesce is not None else settings.coalesce,
+            'misfire_grace_time': schedule.misfire_grace_time if schedule.misfire_grace_time is not None else settings.misfire_grace_time,
+        }
+
+    def _is_live(self, run_job_id: str, run: Run) -> bool:
+        """Check whether an on-demand run is being run, or still waits in the scheduler or the executor"""
+        if run.status == RunStatus.running:
+            return True
+        if self.live_runs.get(run_job_id) != run.id:
+            return False
+        if self.status != "running":
+            # run by a thread of its own
+            return True
+        job = self.scheduler.get_job(run_job_id)
+        if job is not None:
+            return job.kwargs.get('run_id') == run.id
+        return self.executor.get_instances(run_job_id) > 0
+
+    def _cancel_run(self, run_job_id: str, error: str, run_id: str = None):
+        """Mark an on-demand run that will not be run as failed
+
+        Args:
+            run_job_id (str): The run job id, the instrument name postfixed by `:run`
+            error (str): Why the run is given up
+            run_id (str, optional): The run id. Defaults to the last run submitted.
+        """
+        with self.runs_lock:
+            run_id = run_id or self.live_runs.get(run_job_id)
+            if self.live_runs.get(run_job_id) == run_id:
+                self.live_runs.pop(run_job_id, None)
+            run = self.runs.get(run_id)
+            if run is not None and run.status == RunStatus.pending:
+                run.status = RunStatus.failure
+                run.error = error
+                run.finished = datetime.now().astimezone()
+
+    def _on_job_event(self, event):
+        """Count the job runs: submitted, skipped (max instances reached), missed (too late),
+        coalesced (due runs merged into one), executed and failed."""
+        if event.job_id.endswith(':run'):
+            if event.code == EVENT_JOB_MAX_INSTANCES:
+                job = self.scheduler.get_job(event.job_id)
+                self._cancel_run(event.job_id, "Skipped, a run is already in progress",
+                                 job.kwargs.get('run_id') if job else None)
+            elif event.code == EVENT_JOB_MISSED:
+                self._cancel_run(event.job_id, "Missed, not run in time")
+        name = self.get_instrument_name(event.job_id)
+        with self.stats_lock:
+            stats = self.stats.setdefault(event.job_id, {
+                'submitted': 0,
+                'skipped': 0,
+                'missed': 0,
+                'coalesced': 0,
+                'executed': 0,
+                'errors': 0,
+                'last_run_time': None,
+            })
+            if event.code == EVENT_JOB_MISSED:
+                stats['missed'] += 1
+                SCHEDULER_EVENTS.inc(instrument=name, event="missed")
+            elif event.code == EVENT_JOB_EXECUTED:
+                stats['executed'] += 1
+                SCHEDULER_EVENTS.inc(instrument=name, event="executed")
+            elif event.code == EVENT_JOB_ERROR:
+                stats['errors'] += 1
+                SCHEDULER_EVENTS.inc(instrument=name, event="error")
+            else:
+                if event.code == EVENT_JOB_MAX_INSTANCES:
+                    stats['skipped'] += 1
+                    SCHEDULER_EVENTS.inc(instrument=name, event="skipped")
+                else:
+                    stats['submitted'] += 1
+                    SCHEDULER_EVENTS.inc(instrument=name, event="submitted")
+                run_time = event.scheduled_run_times[-1]
+                coalesced = self._count_fire_times(
+                    event.job_id, stats['last_run_time'], run_time)
+                stats['coalesced'] += coalesced
+                if coalesced > 0:
+                    SCHEDULER_EVENTS.inc(
+                        coalesced, instrument=name, event="coalesced")
+                stats['last_run_time'] = run_time
+
+    def _count_fire_times(self, job_id: str, start: datetime, end: datetime) -> int:
+        """Count the fire times of a job trigger strictly between two run times, i.e. the runs that were coalesced"""
+        job = self.scheduler.get_job(job_id) if start is not None else None
+        if job is None or not job.coalesce:
+            return 0
+        count = 0
+        fire_time = job.trigger.get_next_fire_time(start, start)
+        while fire_time is not None and fire_time < end and count < 10000:
+            count += 1
+            fire_time = job.trigger.get_next_fire_time(fire_time, fire_time)
+        return count
+
+    def _stop_watcher(self, job_id: str):
+        watcher = self.watchers.pop(job_id, None)
+        if watcher:
+            watcher.stop()
+
     def _job_to_dict(self, job) -> dict:
         """Convert the job to a dictionary
 
@@ -206,10 +568,23 @@ class SchedulerService:
             # 'func': job.func.__name__,
             # 'args': job.args,
             # 'kwargs': job.kwargs,
-            # 'misfire_grace_time': job.misfire_grace_time,
-            # 'coalesce': job.coalesce,
-            # 'max_instances': job.max_instances
+            'misfire_grace_time': job.misfire_grace_time,
+            'coalesce': job.coalesce,
+            'max_instances': job.max_instances,
         }
+        job_dict['priority'] = self._get_priority(job)
+        job_dict['queue'] = None
+        for waiting in self.executor.get_queue():
+            if waiting['id'] == job.id:
+                job_dict['queue'] = {
+                    'position': waiting['position'],
+                    'waited': waiting['waited'],
+                }
+                break
+        with self.stats_lock:
+            stats = self.stats.get(job.id)
+            job_dict['runs'] = {key: str(value) if key == 'last_run_time' else value
+                                for key, value in stats.items()} if stats else {}
 
         # Add trigger-specific details
         trigger = job.trigger
@@ -220,7 +595,18 @@ class SchedulerService:
                 f.name: str(f) for f in trigger.fields}
         if hasattr(trigger, 'run_date'):  # For date triggers
             job_dict['trigger']['date'] = str(trigger.run_date)
+        if job.id in self.watchers:  # For watch jobs
+            job_dict['trigger']['watch'] = self.watchers[job.id].to_dict()
         return job_dict
 
 
 scheduler_service = SchedulerService()
+
+
+def _collect_executor_jobs() -> dict:
+    executor = scheduler_service.get_executor()
+    return {("running",): executor['running'], ("queued",): len(executor['queue'])}
+
+
+metrics_service.gauge("flaked_executor_jobs", "Number of jobs running, or queued waiting for a thread", ["state"],
+                      _collect_executor_jobs)
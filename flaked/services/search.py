@@ -0,0 +1,271 @@
+from typing import Dict, Iterator, List, Tuple
+from datetime import datetime
+import bisect
+import csv
+import io
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from .config import config_service
+
+# Number of log bytes between two checkpoints of the offset index
+INDEX_INTERVAL = 65536
+# Seconds of tolerance on the order of the log records, written by several threads
+ORDER_SLACK = 1
+# Columns of the CSV log records, the remaining ones are the arguments
+COLUMNS = ["timestamp", "level", "instrument", "job", "action", "message"]
+
+_RECORD_START = re.compile(
+    rb'^"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})"')
+
+
+def parse_timestamp(value: str) -> float:
+    """Parse the timestamp of a log record, written in local time by the CSV formatter.
+
+    Args:
+        value (str): The timestamp, e.g. `2025-01-01 12:00:00,000`
+
+    Returns:
+        float: The epoch seconds
+    """
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+
+
+def read_records(file, offset: int = 0) -> Iterator[Tuple[int, float, bytes]]:
+    """Read the log records of a file from an offset, a record spanning several lines when its message does.
+
+    Args:
+        file: The log file, opened in binary mode
+        offset (int, optional): The offset of a record start. Defaults to 0.
+
+    Yields:
+        Tuple[int, float, bytes]: The offset, the epoch seconds and the bytes of each record
+    """
+    file.seek(offset)
+    start, timestamp, lines = offset, None, []
+    for line in file:
+        match = _RECORD_START.match(line)
+        if match:
+            if lines and timestamp is not None:
+                yield start, timestamp, b''.join(lines)
+            start, timestamp, lines = offset, parse_timestamp(
+                match.group(1).decode()), []
+        lines.append(line)
+        offset += len(line)
+    if lines and timestamp is not None and lines[-1].endswith(b'\n'):
+        # a last record not terminated by a new line is still being written
+        yield start, timestamp, b''.join(lines)
+
+
+class LogIndex:
+    """Checkpoints (epoch seconds, offset) of the records of an instrument log files, by inode so that
+    an index follows its file when rotated, persisted across restarts.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Inode -> {'size', 'head', 'first', 'last', 'checkpoints'}, head being the first bytes of the file
+        self.files: Dict[str, dict] = {}
+        self.dirty = False
+
+    def load(self):
+        """Load the index from its file, if any."""
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path) as f:
+                self.files = json.loads(f.read())['files']
+        except Exception as e:
+            logging.warning(f"Ignoring invalid log index {self.path}: {e}")
+
+    def save(self):
+        """Write the index to its file, if modified since last saved."""
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'files': self.files}))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def update(self, file, inode: int) -> dict:
+        """Index the records appended to a log file since last indexed.
+
+        Args:
+            file: The log file, opened in binary mode
+            inode (int): The file inode
+
+        Returns:
+            dict: The file index
+        """
+        size = os.fstat(file.fileno()).st_size
+        file.seek(0)
+        head = file.read(25)
+        entry = self.files.get(str(inode))
+        if entry is None or entry['head'] != head.hex() or entry['size'] > size:
+            # new file, or the inode was reused
+            entry = {'size': 0, 'head': head.hex(), 'first': None,
+                     'last': None, 'checkpoints': []}
+            self.files[str(inode)] = entry
+            self.dirty = True
+        if entry['size'] == size:
+            return entry
+        checkpoints = entry['checkpoints']
+        last_offset = checkpoints[-1][1] if checkpoints else -INDEX_INTERVAL
+        for offset, timestamp, record in read_records(file, entry['size']):
+            if offset - last_offset >= INDEX_INTERVAL:
+                checkpoints.append([timestamp, offset])
+                last_offset = offset
+            if entry['first'] is None:
+                entry['first'] = timestamp
+            entry['last'] = timestamp
+            entry['size'] = offset + len(record)
+        self.dirty = True
+        return entry
+
+    def prune(self, inodes: List[str]):
+        """Forget the files that do not exist anymore."""
+        files = {inode: entry for inode, entry in self.files.items() if inode in inodes}
+        if len(files) != len(self.files):
+            self.files = files
+            self.dirty = True
+
+
+class SearchService:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes: Dict[str, LogIndex] = {}
+
+    def search(self, name: str, paths: List[Path], start: datetime = None, end: datetime = None, level: str = None,
+               job: str = None, action: str = None, offset: int = 0, limit: int = 100) -> dict:
+        """Search the log records of an instrument, the oldest first.
+
+        Args:
+            name (str): The instrument name
+            paths (List[Path]): The log files, the newest first
+            start (datetime, optional): The earliest record time. Defaults to None.
+            end (datetime, optional): The latest record time (excluded). Defaults to None.
+            level (str, optional): The record level. Defaults to None (all).
+            job (str, optional): The job id. Defaults to None (all).
+            action (str, optional): The action. Defaults to None (all).
+            offset (int, optional): The number of records to skip. Defaults to 0.
+            limit (int, optional): The max number of records. Defaults to 100.
+
+        Returns:
+            dict: The `total` number of records matching, the `offset`, the `limit` and the `records`
+        """
+        level = level.upper() if level else None
+        total = 0
+        records = []
+        for _, timestamp, data in self.iter_records(name, paths, start, end):
+            record = self._parse(data)
+            if (level and record['level'] != level) or (job and record['job'] != job) or \
+                    (action and record['action'] != action):
+                continue
+            if offset <= total < offset + limit:
+                record['timestamp'] = datetime.fromtimestamp(
+                    timestamp).astimezone().isoformat()
+                records.append(record)
+            total += 1
+        return {
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'records': records,
+        }
+
+    def iter_records(self, name: str, paths: List[Path], start: datetime = None, end: datetime = None) -> Iterator[Tuple[Path, float, bytes]]:
+        """Read the log records of an instrument in a time range, the oldest first. The files are seeked to
+        the last checkpoint before the start time, and read until the end time.
+
+        Args:
+            name (str): The instrument name
+            paths (List[Path]): The log files, the newest first
+            start (datetime, optional): The earliest record time. Defaults to None.
+            end (datetime, optional): The latest record time (excluded). Defaults to None.
+
+        Yields:
+            Tuple[Path, float, bytes]: The file, the epoch seconds and the bytes of each record
+        """
+        start_time = start.timestamp() if start else None
+        end_time = end.timestamp() if end else None
+        for path, file_offset in self._seek(name, list(reversed(paths)), start_time, end_time):
+            try:
+                with open(path, 'rb') as file:
+                    for _, timestamp, data in read_records(file, file_offset):
+                        if end_time is not None and timestamp >= end_time + ORDER_SLACK:
+                            break
+                        if (start_time is not None and timestamp < start_time) or \
+                                (end_time is not None and timestamp >= end_time):
+                            continue
+                        yield path, timestamp, data
+            except FileNotFoundError:
+                # rotated meanwhile
+                continue
+
+    def clear(self, name: str):
+        """Forget the log index of an instrument, and delete its file.
+
+        Args:
+            name (str): The instrument name
+        """
+        with self.lock:
+            index = self._get_index(name)
+            self.indexes.pop(name, None)
+            if index.path.exists():
+                index.path.unlink()
+
+    def _seek(self, name: str, paths: List[Path], start_time: float, end_time: float) -> List[Tuple[Path, int]]:
+        """Update the index of the log files, and get the offset where to start reading each file in range."""
+        seeks = []
+        with self.lock:
+            index = self._get_index(name)
+            inodes = []
+            for path in paths:
+                try:
+                    with open(path, 'rb') as file:
+                        inode = str(os.fstat(file.fileno()).st_ino)
+                        entry = index.update(file, inode)
+                except FileNotFoundError:
+                    continue
+                inodes.append(inode)
+                if entry['first'] is None:
+                    continue
+                if start_time is not None and entry['last'] < start_time - ORDER_SLACK:
+                    continue
+                if end_time is not None and entry['first'] >= end_time + ORDER_SLACK:
+                    continue
+                offset = 0
+                if start_time is not None:
+                    checkpoints = entry['checkpoints']
+                    position = bisect.bisect_left(
+                        [timestamp for timestamp, _ in checkpoints], start_time - ORDER_SLACK)
+                    if position > 0:
+                        offset = checkpoints[position - 1][1]
+                seeks.append((path, offset))
+            index.prune(inodes)
+            index.save()
+        return seeks
+
+    def _parse(self, data: bytes) -> dict:
+        row = next(csv.reader(io.StringIO(data.decode(errors='replace'))), [])
+        record = {column: row[i] if i < len(row) else None
+                  for i, column in enumerate(COLUMNS)}
+        record['arguments'] = row[len(COLUMNS):]
+        return record
+
+    def _get_index(self, name: str) -> LogIndex:
+        if name not in self.indexes:
+            index = LogIndex(
+                Path(config_service.get_settings().state) / f"{name}.logindex.json")
+            index.load()
+            self.indexes[name] = index
+        return self.indexes[name]
+
+
+search_service = SearchService()
@@ -1,60 +1,495 @@
-from typing import List
+from typing import List, Iterator
+from datetime import datetime
 from pathlib import Path
-import paramiko
+import hashlib
+import io
+import logging
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from .config import config_service
+from .pool import sftp_pool, PooledConnection
+from .ledger import new_digest, HASH_CHUNK_SIZE
+from .rate import InstrumentLimiter
+from .metrics import TRANSFER_SECONDS
+from ..models.domain import CompressConfig
+from ..models.upload import UploadResult, UploadState
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for the zstd compression
+    zstandard = None
+
+# Size of the blocks written to the remote files, the max SFTP request size
+CHUNK_SIZE = 32768
+# Size of the end of a partial remote file compared to the local file before resuming
+RESUME_CHECK_SIZE = 65536
+# Suffix of a bundle being uploaded, renamed once checked
+PARTIAL_SUFFIX = '.part'
+
+# Suffix appended to the remote file name, by compression format
+COMPRESS_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Global bound on the number of files being uploaded at once, shared by all instruments
+_slots_lock = threading.Lock()
+_slots = (0, None)
+
+
+def _get_slots(size: int) -> threading.BoundedSemaphore:
+    """Get the global upload slots, resized when the setting has changed."""
+    global _slots
+    with _slots_lock:
+        if _slots[0] != size:
+            _slots = (size, threading.BoundedSemaphore(max(1, size)))
+        return _slots[1]
+
+
+def _make_compressor(compress: CompressConfig):
+    """Get a streaming compressor, with `compress` and `flush` methods."""
+    if compress.format == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(
+                "The zstandard package is required for the zstd compression")
+        level = compress.level if compress.level is not None else 3
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    level = compress.level if compress.level is not None else 6
+    # gzip header and trailer, so that the remote file can be read with gunzip
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class _RemoteWriter:
+    """File-like object writing to a remote file in blocks, compressing on the way if required."""
+
+    def __init__(self, remote_file, result: UploadResult, compressor=None, limiter: InstrumentLimiter = None):
+        self.remote_file = remote_file
+        self.limiter = limiter
+        self.result = result
+        self.compressor = compressor
+        self.buffer = bytearray()
+        self.digest = new_digest()
+
+    def write(self, data: bytes) -> int:
+        self.result.size += len(data)
+        if self.compressor is not None:
+            start = time.thread_time()
+            compressed = self.compressor.compress(data)
+            self.result.cpu += time.thread_time() - start
+            self.buffer += compressed
+        else:
+            self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self._flush_buffer()
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            start = time.thread_time()
+            self.buffer += self.compressor.flush()
+            self.result.cpu += time.thread_time() - start
+        self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self.buffer:
+            self.digest.update(self.buffer)
+            if self.limiter:
+                self.limiter.consume(len(self.buffer))
+            self.remote_file.write(bytes(self.buffer))
+            self.result.sent += len(self.buffer)
+            self.buffer = bytearray()
+
+
+class _HashingReader:
+    """File-like object computing the checksum of what is read."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
 
 
 class UploadService:
 
-    def __init__(self):
-        self.sftp = config_service.get_config().settings.sftp
+    def __init__(self, limiter: InstrumentLimiter = None):
+        """
+        Args:
+            limiter (InstrumentLimiter, optional): Throttles the bytes sent. Defaults to None (no limit).
+        """
+        settings = config_service.get_config().settings
+        self.sftp = settings.sftp
+        self.upload_config = settings.upload
+        self.limiter = limiter
+
+    def upload_files(self, files: List[Path], remote_path: str, concurrency: int = None, compress: CompressConfig = None, partition: str = None, verify: str = None) -> List[UploadResult]:
+        """Upload files in the remote folder, possibly several at a time.
+
+        Each file is reported separately: a failing file does not prevent the others from being uploaded.
 
-    def upload_files(self, files: List[Path], remote_path: str) -> List[Path]:
-        uploaded = []
-        # Create an SSH client
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(
-            paramiko.AutoAddPolicy())  # Auto accept unknown host keys
+        Args:
+            files (List[Path]): The local files
+            remote_path (str): The remote folder, relative to the SFTP prefix
+            concurrency (int, optional): Max number of parallel uploads. Defaults to the system setting.
+            compress (CompressConfig, optional): Compress the files while uploading them. Defaults to None.
+            partition (str, optional): The remote subfolder pattern, formatted with the file modification date. Defaults to None.
+            verify (str, optional): Check the remote files after upload, by `size` or by `checksum`. Defaults to None.
 
-        # Connect to the SFTP server
-        client.connect(self.sftp.host, self.sftp.port,
-                       self.sftp.username, self.sftp.password)
+        Returns:
+            List[UploadResult]: The upload result of each file
+        """
+        return self.upload(self.make_results(files, remote_path, compress, partition), concurrency, compress, verify)
 
-        # Open an SFTP session
-        sftp = client.open_sftp()
+    def make_results(self, files: List[Path], remote_path: str, compress: CompressConfig = None, partition: str = None) -> List[UploadResult]:
+        """Prepare the upload of files in the remote folder.
 
-        # Ensure remote folder exists (create if necessary)
+        Args:
+            files (List[Path]): The local files
+            remote_path (str): The remote folder, relative to the SFTP prefix
+            compress (CompressConfig, optional): The compression, which suffixes the remote file names. Defaults to None.
+            partition (str, optional): The remote subfolder pattern, formatted with the file modification date. Defaults to None.
+
+        Returns:
+            List[UploadResult]: The pending upload of each file
+        """
         remote_folder = self.sftp.prefix + '/' + remote_path
-        self._mkdirs(sftp, remote_folder)
-        try:
-            sftp.stat(remote_folder)  # Check if remote folder exists
-        except FileNotFoundError:
-            sftp.mkdir(remote_folder)  # Create remote folder
-            print(f"Created remote folder: {remote_folder}")
+        suffix = COMPRESS_SUFFIXES[compress.format] if compress else ''
+        return [UploadResult(path=file, remote_path=self._get_partition(remote_folder, partition, file.stat().st_mtime if partition else None) + '/' + file.name + suffix,
+                             compression=compress.format if compress else None)
+                for file in files]
+
+    def make_bundle(self, files: List[Path], remote_path: str, name: str, compress: CompressConfig = None, partition: str = None) -> UploadResult:
+        """Prepare the upload of files packed in a single tar archive in the remote folder.
+
+        Args:
+            files (List[Path]): The local files
+            remote_path (str): The remote folder, relative to the SFTP prefix
+            name (str): The archive name prefix, completed by a timestamp
+            compress (CompressConfig, optional): The compression of the whole archive. Defaults to None.
+            partition (str, optional): The remote subfolder pattern, formatted with the current date. Defaults to None.
+
+        Returns:
+            UploadResult: The pending upload of the archive, with the files as members
+        """
+        now = datetime.now()
+        remote_folder = self._get_partition(
+            self.sftp.prefix + '/' + remote_path, partition, now.timestamp())
+        bundle_name = f"{name}_{now:%Y%m%dT%H%M%S%f}.tar"
+        if compress:
+            bundle_name += COMPRESS_SUFFIXES[compress.format]
+        return UploadResult(path=Path(bundle_name), remote_path=remote_folder + '/' + bundle_name,
+                            compression=compress.format if compress else None, members=files)
 
-        # Upload all files from the local folder
+    def _get_partition(self, remote_folder: str, partition: str, timestamp: float) -> str:
+        """Append the date subfolders to the remote folder, if partitioned."""
+        if not partition:
+            return remote_folder
+        return remote_folder + '/' + datetime.fromtimestamp(timestamp).strftime(partition).strip('/')
+
+    def upload(self, results: List[UploadResult], concurrency: int = None, compress: CompressConfig = None, verify: str = None) -> List[UploadResult]:
+        """Upload the files that are not done yet, i.e. pending or failed in a previous attempt.
+
+        Args:
+            results (List[UploadResult]): The files to upload, with their state
+            concurrency (int, optional): Max number of parallel uploads. Defaults to the system setting.
+            compress (CompressConfig, optional): Compress the files while uploading them. Defaults to None.
+            verify (str, optional): Check the remote files after upload, by `size` or by `checksum`. Defaults to None.
+
+        Returns:
+            List[UploadResult]: The same results, updated
+        """
+        todo = [result for result in results if not result.success]
+        if len(todo) == 0:
+            return results
+        for result in todo:
+            result.state = UploadState.pending
+            result.error = None
+            result.verified = False
+
+        # Ensure remote folders exist (create if necessary)
         try:
-            for file in files:
-                remote_file_path = remote_folder + '/' + file.name
-                print(f"Uploading {file} to {remote_file_path}...")
-                sftp.put(str(file), remote_file_path)
-                print(f"Uploaded: {file} → {remote_path}")
-                uploaded.append(file)
-        finally:
-            # Close connections
-            sftp.close()
-            client.close()
-        return uploaded
-
-    def _mkdirs(self, sftp, remote_folder):
-        """ Recursively create directories on the remote SFTP server """
-        dirs = remote_folder.strip("/").split("/")
-        current_path = ""
-
-        for dir in dirs:
-            current_path += f"/{dir}"
+            with sftp_pool.lease(self.sftp) as conn:
+                for remote_folder in sorted(set(result.remote_path.rsplit('/', 1)[0] for result in todo)):
+                    self._mkdirs(conn, remote_folder)
+        except Exception as e:
+            for result in todo:
+                result.state = UploadState.failed
+                result.error = str(e)
+            raise
+
+        # Several connections to the SFTP server, one per worker, each pulling files from the same queue
+        workers = concurrency if concurrency else self.upload_config.concurrency
+        workers = max(1, min(workers, len(todo), self.sftp.pool.max_size))
+        pending = iter(todo)
+        lock = threading.Lock()
+        errors = []
+        if workers == 1:
             try:
-                sftp.stat(current_path)  # Check if directory exists
+                self._upload_worker(pending, lock, compress, verify)
+            except Exception as e:
+                errors.append(e)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as executor:
+                futures = [executor.submit(self._upload_worker, pending, lock, compress, verify)
+                           for _ in range(workers)]
+            errors = [future.exception() for future in futures if future.exception()]
+        for error in errors:
+            logging.error(f"Upload worker failed: {error}")
+        for result in todo:
+            if result.state != UploadState.done:
+                result.state = UploadState.failed
+                if not result.error:
+                    # left by a failed worker, or never taken as all the workers failed
+                    result.error = str(errors[0]) if errors else "Not uploaded"
+        return results
+
+    def _upload_worker(self, pending: Iterator[UploadResult], lock: threading.Lock, compress: CompressConfig = None, verify: str = None):
+        """Upload files from the shared queue until it is empty, on a single leased connection."""
+        slots = _get_slots(self.upload_config.max_concurrency)
+        with sftp_pool.lease(self.sftp) as conn:
+            while True:
+                with lock:
+                    result = next(pending, None)
+                if result is None:
+                    return
+                with slots:
+                    result.state = UploadState.in_flight
+                    result.attempts += 1
+                    start = time.perf_counter()
+                    try:
+                        print(f"Uploading {result.path} to {result.remote_path}...")
+                        if result.members:
+                            self._upload_bundle(
+                                conn.sftp, result, compress, verify)
+                        elif compress:
+                            self._transfer_compressed(
+                                conn.sftp, result, compress)
+                        else:
+                            self._transfer(conn.sftp, result)
+                        if verify and not result.members:
+                            self._verify(conn.sftp, result, verify)
+                        print(f"Uploaded: {result.path} → {result.remote_path}")
+                        result.state = UploadState.done
+                        TRANSFER_SECONDS.observe(
+                            time.perf_counter() - start, outcome="success")
+                    except Exception as e:
+                        result.state = UploadState.failed
+                        result.error = str(e)
+                        TRANSFER_SECONDS.observe(
+                            time.perf_counter() - start, outcome="failure")
+                        # the remote folder may have been removed meanwhile
+                        conn.clear_dirs()
+                if not conn.is_active():
+                    # connection lost, leave the remaining files to the other workers
+                    raise ConnectionError(
+                        f"Connection lost while uploading {result.path}")
+
+    def _transfer(self, sftp, result: UploadResult):
+        """Write the local file to the remote, resuming from the remote size when a large file was partially uploaded."""
+        stat = result.path.stat()
+        result.size = stat.st_size
+        result.mtime = stat.st_mtime_ns
+        result.offset = 0
+        resume_size = self.upload_config.resume_size
+        if resume_size > 0 and result.size > resume_size:
+            try:
+                remote_size = sftp.stat(result.remote_path).st_size
+                if 0 < remote_size < result.size and self._is_prefix(sftp, result, remote_size):
+                    result.offset = remote_size
             except FileNotFoundError:
-                sftp.mkdir(current_path)  # Create if it doesn't exist
-                print(f"Created remote directory: {current_path}")
+                pass
+        with open(result.path, 'rb') as local_file:
+            # 'r+' writes at offset without truncating, 'w' (re)starts from scratch
+            with sftp.open(result.remote_path, 'r+' if result.offset > 0 else 'w') as remote_file:
+                remote_file.set_pipelined(True)
+                digest = new_digest()
+                if result.offset > 0:
+                    # the part already uploaded is only read locally, for the digest
+                    remaining = result.offset
+                    while remaining > 0:
+                        chunk = local_file.read(min(HASH_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        remaining -= len(chunk)
+                    remote_file.seek(result.offset)
+                while True:
+                    chunk = local_file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    self._throttle(len(chunk))
+                    remote_file.write(chunk)
+                    result.sent += len(chunk)
+        result.digest = digest.hexdigest()
+        result.remote_digest = result.digest
+
+    def _is_prefix(self, sftp, result: UploadResult, remote_size: int) -> bool:
+        """Check that a smaller remote file is a partial upload of the local file, and not another file
+        left under the same name, by comparing their last block before the remote size."""
+        size = min(RESUME_CHECK_SIZE, remote_size)
+        with sftp.open(result.remote_path, 'r') as remote_file:
+            remote_file.seek(remote_size - size)
+            remote_block = remote_file.read(size)
+        with open(result.path, 'rb') as local_file:
+            local_file.seek(remote_size - size)
+            local_block = local_file.read(size)
+        if remote_block == local_block:
+            return True
+        logging.warning(
+            f"Remote file {result.remote_path} differs from {result.path}, uploading it again")
+        return False
+
+    def _transfer_compressed(self, sftp, result: UploadResult, compress: CompressConfig):
+        """Compress the local file while writing it to the remote, without a temporary copy.
+        A compressed upload cannot be resumed, it always starts from scratch."""
+        stat = result.path.stat()
+        result.size = stat.st_size
+        result.mtime = stat.st_mtime_ns
+        result.offset = 0
+        result.compressed = 0
+        compressor = _make_compressor(compress)
+        digest = new_digest()
+        remote_digest = new_digest()
+        cpu = 0
+        with open(result.path, 'rb') as local_file:
+            with sftp.open(result.remote_path, 'w') as remote_file:
+                remote_file.set_pipelined(True)
+                while True:
+                    chunk = local_file.read(CHUNK_SIZE)
+                    digest.update(chunk)
+                    start = time.thread_time()
+                    data = compressor.compress(chunk) if chunk else compressor.flush()
+                    cpu += time.thread_time() - start
+                    if data:
+                        remote_digest.update(data)
+                        self._throttle(len(data))
+                        remote_file.write(data)
+                        result.sent += len(data)
+                        result.compressed += len(data)
+                    if not chunk:
+                        break
+        result.cpu += cpu
+        result.digest = digest.hexdigest()
+        result.remote_digest = remote_digest.hexdigest()
+
+    def _upload_bundle(self, sftp, result: UploadResult, compress: CompressConfig = None, verify: str = None):
+        """Write a bundle under a temporary name, renamed once checked, so that a failed upload never
+        leaves a truncated archive under the final name."""
+        remote_path = result.remote_path
+        result.remote_path = remote_path + PARTIAL_SUFFIX
+        try:
+            self._transfer_bundle(sftp, result, compress)
+            # a bundle is always checked, as its content is not known beforehand
+            self._verify(sftp, result, verify or 'size')
+            sftp.posix_rename(result.remote_path, remote_path)
+        except Exception:
+            try:
+                sftp.remove(result.remote_path)
+            except (IOError, OSError):
+                # not written, or the connection is lost: overwritten by the retry
+                pass
+            raise
+        finally:
+            result.remote_path = remote_path
+
+    def _transfer_bundle(self, sftp, result: UploadResult, compress: CompressConfig = None):
+        """Stream a tar archive of the member files to the remote, with a manifest of their checksums
+        (`sha256sum -c` format) as last entry."""
+        result.size = 0
+        result.offset = 0
+        result.compressed = 0 if compress else None
+        checksums = []
+        with sftp.open(result.remote_path, 'w') as remote_file:
+            remote_file.set_pipelined(True)
+            writer = _RemoteWriter(
+                remote_file, result, _make_compressor(compress) if compress else None, self.limiter)
+            sent = result.sent
+            # stream mode, the archive is written sequentially and never read back
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for member in result.members:
+                    with open(member, 'rb') as local_file:
+                        info = tar.gettarinfo(
+                            arcname=member.name, fileobj=local_file)
+                        reader = _HashingReader(local_file)
+                        tar.addfile(info, reader)
+                    checksums.append(f"{reader.hash.hexdigest()}  {member.name}\n")
+                manifest = "".join(checksums).encode()
+                info = tarfile.TarInfo("MANIFEST.sha256")
+                info.size = len(manifest)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(manifest))
+            writer.close()
+            written = result.sent - sent
+        if compress:
+            result.compressed = written
+        result.remote_digest = writer.digest.hexdigest()
+
+    def _throttle(self, size: int):
+        if self.limiter:
+            self.limiter.consume(size)
+
+    def _verify(self, sftp, result: UploadResult, verify: str):
+        """Check that the remote file has the size, and possibly the checksum, of what was uploaded.
+        The checksum is computed by reading the remote file back, as SFTP servers seldom compute one.
+
+        Raises:
+            IOError: If the remote file differs
+        """
+        expected = result.compressed if result.compressed is not None else result.size
+        remote_size = sftp.stat(result.remote_path).st_size
+        if remote_size != expected:
+            raise IOError(
+                f"Verification failed, {result.remote_path} has {remote_size} bytes instead of {expected}")
+        if verify == 'checksum':
+            digest = new_digest()
+            with sftp.open(result.remote_path, 'rb') as remote_file:
+                remote_file.prefetch(remote_size)
+                while True:
+                    chunk = remote_file.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            if digest.hexdigest() != result.remote_digest:
+                raise IOError(
+                    f"Verification failed, {result.remote_path} checksum differs")
+        result.verified = True
+
+    def _mkdirs(self, conn: PooledConnection, remote_folder: str):
+        """Create the remote folder and its parents if they do not exist.
+
+        The folders known to exist on the connection are not checked again, and the deepest folder is
+        checked first: an existing folder then costs no round trip, a new partition only the missing levels.
+        """
+        ttl = self.sftp.pool.dir_ttl
+        root = '/' if remote_folder.startswith('/') else ''
+        dirs = remote_folder.strip('/').split('/')
+        paths = [root + '/'.join(dirs[:i + 1]) for i in range(len(dirs))]
+        if ttl > 0 and conn.has_dir(paths[-1], ttl):
+            return
+        try:
+            conn.sftp.stat(paths[-1])
+            for path in paths:
+                conn.add_dir(path)
+            return
+        except FileNotFoundError:
+            pass
+        for path in paths[:-1]:
+            if ttl > 0 and conn.has_dir(path, ttl):
+                continue
+            self._mkdir(conn, path)
+        self._mkdir(conn, paths[-1])
+
+    def _mkdir(self, conn: PooledConnection, path: str):
+        try:
+            conn.sftp.stat(path)  # Check if directory exists
+        except FileNotFoundError:
+            conn.sftp.mkdir(path)  # Create if it doesn't exist
+            print(f"Created remote directory: {path}")
+        conn.add_dir(path)
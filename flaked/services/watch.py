@@ -0,0 +1,211 @@
+from typing import Callable, Dict, Tuple
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from ..models.domain import WatchConfig
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+# Bursts of events are coalesced, but a run is not delayed more than this number of debounce periods
+MAX_DEBOUNCES = 10
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library(
+            "c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+class FolderWatcher:
+    """Watches an input folder for new files, using inotify on Linux or polling otherwise,
+    and calls back once per burst of events.
+    """
+
+    def __init__(self, path: Path, regex: str, config: WatchConfig, callback: Callable[[], None], markers: Tuple[str, ...] = ()):
+        """
+        Args:
+            path (Path): The folder to watch
+            regex (str): The pattern of the data file names
+            config (WatchConfig): The watch settings
+            callback (Callable): Called once per burst of events
+            markers (Tuple[str, ...], optional): The suffixes of the lock and sentinel files of the data files, which
+            creation or deletion may make a data file ready. Defaults to none.
+        """
+        self.path = path
+        self.pattern = re.compile(regex)
+        self.markers = tuple(markers)
+        self.config = config
+        self.callback = callback
+        self.stopped = threading.Event()
+        # set when files changed since the job last started
+        self.pending = threading.Event()
+        self.mode = "inotify" if _libc is not None else "polling"
+        self.events = 0
+        self.triggers = 0
+        self.thread = threading.Thread(
+            target=self._run, name=f"watch-{path.name}", daemon=True)
+
+    def start(self):
+        """Start watching, in a background thread."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        self.stopped.set()
+
+    def to_dict(self) -> dict:
+        """Convert the watcher to a dictionary
+
+        Returns:
+            dict: The watched path, the watch mode and counters
+        """
+        return {
+            'path': str(self.path),
+            'mode': self.mode,
+            'events': self.events,
+            'triggers': self.triggers,
+        }
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.mode == "inotify":
+                    self._watch_inotify()
+                else:
+                    self._watch_polling()
+            except Exception as e:
+                logging.error(
+                    f"Watching {self.path} failed: {e}", exc_info=True)
+            # folder missing or removed, or watch failure: try again later
+            self.stopped.wait(self.config.poll)
+
+    def _watch_inotify(self):
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+            if _libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                errno = ctypes.get_errno()
+                if not self.path.exists():
+                    return
+                raise OSError(errno, f"inotify_add_watch failed on {self.path}")
+            logging.info(f"Watching {self.path} with inotify")
+            deadline = None
+            first = None
+            while not self.stopped.is_set():
+                timeout = 1 if deadline is None else max(
+                    0, min(1, deadline - time.monotonic()))
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if readable:
+                    matched, gone = self._read_events(fd)
+                    if matched:
+                        now = time.monotonic()
+                        first = first if first is not None else now
+                        deadline = min(now + self.config.debounce,
+                                       first + self.config.debounce * MAX_DEBOUNCES)
+                    if gone:
+                        return
+                if deadline is not None and time.monotonic() >= deadline:
+                    deadline = None
+                    first = None
+                    self._trigger()
+        finally:
+            os.close(fd)
+
+    def _read_events(self, fd: int) -> Tuple[bool, bool]:
+        """Drain the pending inotify events.
+
+        Returns:
+            Tuple[bool, bool]: Whether a matching file changed, whether the folder is gone
+        """
+        matched = False
+        gone = False
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return matched, gone
+        offset = 0
+        while offset + IN_EVENT_HEADER.size <= len(data):
+            _, mask, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                gone = True
+            elif mask & IN_Q_OVERFLOW:
+                # events were lost, assume something relevant happened
+                matched = True
+            elif mask & IN_ISDIR:
+                continue
+            elif self._is_marker(name) or (not mask & IN_DELETE and self.pattern.match(name)):
+                # deleting a data file is not worth a run, deleting its lock is
+                self.events += 1
+                matched = True
+        return matched, gone
+
+    def _watch_polling(self):
+        if not self.path.is_dir():
+            return
+        logging.info(f"Watching {self.path} by polling")
+        snapshot = self._snapshot()
+        while not self.stopped.wait(self.config.poll):
+            if not self.path.is_dir():
+                return
+            current = self._snapshot()
+            # new or modified files only, deletions are not worth a run unless of a marker
+            if any(snapshot.get(name) != value for name, value in current.items()) or \
+                    any(name not in current for name in snapshot if self._is_marker(name)):
+                self.events += 1
+                self._trigger()
+            snapshot = current
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if (self.pattern.match(entry.name) or self._is_marker(entry.name)) and entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _is_marker(self, name: str) -> bool:
+        """Check whether a file is the lock or sentinel file of a data file"""
+        return any(name.endswith(marker) and self.pattern.match(name[:-len(marker)])
+                   for marker in self.markers)
+
+    def _trigger(self):
+        self.triggers += 1
+        self.pending.set()
+        try:
+            self.callback()
+        except Exception as e:
+            logging.error(f"Triggering job for {self.path} failed: {e}")
@@ -3,6 +3,10 @@ from fastapi import APIRouter
 from ..services.config import config_service
 from ..services.scheduler import scheduler_service
 from ..services.log import log_service
+from ..services.pool import sftp_pool
+from ..services.scan import scan_service
+from ..services.ledger import ledger_service
+from ..services.search import search_service
 from ..models.domain import Config, SystemConfig, InstrumentConfig
 import os
 cwd = os.getcwd()
@@ -18,6 +22,8 @@ async def reload() -> Config:
     """
     scheduler_service.stop()
     config_service.load_config()
+    # drop the connections opened with the previous settings
+    sftp_pool.close_all()
     scheduler_service.start()
     return config_service.get_config()
 
@@ -79,8 +85,11 @@ async def get_instrument_config(name: str) -> InstrumentConfig:
     # remove all jobs associated with this instrument
     for job in scheduler_service.get_jobs(name):
         scheduler_service.stop_job(job["id"])
-    # clear the cached logger for this instrument
+    # clear the cached logger, file index, upload ledger and log index for this instrument
     log_service.clear(name)
+    scan_service.clear(name)
+    ledger_service.clear(name)
+    search_service.clear(name)
     # delete the instrument configuration
     config_service.delete_instrument_config(name)
     return config
@@ -1,11 +1,15 @@
-from collections import deque
-from fastapi import APIRouter, BackgroundTasks
-from fastapi.responses import StreamingResponse, FileResponse
-from pathlib import Path
-from zipfile import ZipFile
-import os
+from typing import List
+import asyncio
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from ..services.config import config_service
-from ..services.log import log_service
+from ..services.log import log_service, log_broker, DroppedLines
+from ..services.search import search_service
+
+# Seconds between two keepalive comments sent to a follower when there is no log line
+KEEPALIVE = 15
 
 router = APIRouter()
 
@@ -16,7 +20,7 @@ async def get_instrument_logs(name: str, tail: int = 100) -> StreamingResponse:
 
     Args:
         name (str): The instrument name
-        tail (int, optional): The number of lines to tail. Defaults to 100. All lines are returned if tail is not positive.
+        tail (int, optional): The number of lines to tail, spanning the rotated files if needed. Defaults to 100. All lines of the current file are returned if tail is not positive.
 
     Returns:
         StreamingResponse: The instrument logs stream
@@ -25,45 +29,171 @@ async def get_instrument_logs(name: str, tail: int = 100) -> StreamingResponse:
         with open(file_path, "rb") as file:
             yield from file
 
-    def tail_file(file_path: str, lines: int = 10):
-        """Yield the last `lines` lines of a file."""
-        try:
-            with open(file_path, "rb") as file:
-                # Keep only the last `lines` lines
-                last_lines = deque(file, maxlen=lines)
-            for line in last_lines:
-                yield line  # Stream each line
-        except FileNotFoundError:
-            yield b"File not found\n"
+    instrument = config_service.get_instrument_config(name)
+    logger = log_service.for_instrument(instrument)
+    file_path = logger.get_log_path()
+    if not file_path.exists():
+        return StreamingResponse(iter(["File not found\n"]), status_code=404, media_type="text/plain")
+    if tail <= 0:
+        return StreamingResponse(file_stream(str(file_path)), media_type="text/plain")
+    # the files are read in a thread, not to block the event loop
+    lines = await run_in_threadpool(logger.tail, tail)
+    return StreamingResponse(iter(lines), media_type="text/plain")
+
+
+@router.get("/instrument/{name}/query")
+async def query_instrument_logs(
+    name: str,
+    start: datetime = Query(None, description="Earliest time of the log records"),
+    end: datetime = Query(None, description="Latest time of the log records, excluded"),
+    level: str = Query(None, description="Level of the log records, e.g. ERROR"),
+    job: str = Query(None, description="Job identifier of the log records"),
+    action: str = Query(None, description="Action of the log records, e.g. UPLOAD_FILES"),
+    offset: int = Query(0, ge=0, description="Number of log records to skip"),
+    limit: int = Query(100, ge=1, le=1000, description="Max number of log records")
+) -> dict:
+    """Query the instrument log records, the oldest first, across the rotated log files
+
+    Args:
+        name (str): The instrument name
+        start (datetime, optional): Earliest time of the log records
+        end (datetime, optional): Latest time of the log records, excluded
+        level (str, optional): Level of the log records
+        job (str, optional): Job identifier of the log records
+        action (str, optional): Action of the log records
+        offset (int, optional): Number of log records to skip
+        limit (int, optional): Max number of log records
+
+    Raises:
+        HTTPException: If the instrument is not found
+
+    Returns:
+        dict: The `total` number of log records matching, the `offset`, the `limit` and the page of `records`
+    """
+    instrument = config_service.get_instrument_config(name)
+    if instrument is None:
+        raise HTTPException(status_code=404, detail="Instrument not found.")
+    paths = log_service.for_instrument(instrument).get_log_paths()
+    # the files are read in a thread, not to block the event loop
+    return await run_in_threadpool(search_service.search, name, paths, start, end, level, job, action, offset, limit)
+
+
+@router.get("/instrument/{name}/follow")
+async def follow_instrument_logs(request: Request, name: str, tail: int = 0) -> StreamingResponse:
+    """Follow the instrument logs, as server-sent events: one `data` event per log line, as it is written
+
+    When the client does not keep up, the lines that do not fit in its queue are dropped, and a `dropped`
+    event gives their number.
+
+    Args:
+        name (str): The instrument name
+        tail (int, optional): The number of past lines to send first. Defaults to 0.
 
+    Returns:
+        StreamingResponse: The instrument logs event stream
+    """
     instrument = config_service.get_instrument_config(name)
-    file_path = log_service.for_instrument(instrument).get_log_path()
+    if instrument is None:
+        return StreamingResponse(iter(["Instrument not found\n"]), status_code=404, media_type="text/plain")
+    logger = log_service.for_instrument(instrument)
+    # subscribed before tailing, so that no line is missed in between,
+    # the lines published meanwhile but already in the tail being skipped
+    subscription = log_broker.subscribe(name)
     try:
-        return StreamingResponse(tail_file(str(file_path), tail) if tail > 0 else file_stream(str(file_path)), media_type="text/plain")
-    except FileNotFoundError:
-        return StreamingResponse(iter(["File not found"]), status_code=404, media_type="text/plain")
+        lines = []
+        if tail > 0:
+            subscription.after = logger.get_position()
+            lines = await run_in_threadpool(logger.tail, tail, subscription.after)
+    except BaseException:
+        log_broker.unsubscribe(subscription)
+        raise
+
+    async def event_stream():
+        try:
+            for line in lines:
+                yield _format_event(line.decode(errors="replace").rstrip("\r\n"))
+            while not await request.is_disconnected():
+                try:
+                    line = await subscription.get(KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if isinstance(line, DroppedLines):
+                    yield _format_event(str(line.count), "dropped")
+                else:
+                    yield _format_event(line)
+        finally:
+            log_broker.unsubscribe(subscription)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _format_event(data: str, event: str = None) -> str:
+    """Format a server-sent event, a multi-line data being sent as several `data` fields"""
+    fields = [f"event: {event}"] if event else []
+    fields.extend(f"data: {line}" for line in data.splitlines() or [""])
+    return "\n".join(fields) + "\n\n"
 
 
 @router.get("/instrument/{name}/files")
-async def get_instrument_log_files(name: str, background_tasks: BackgroundTasks) -> FileResponse:
-    """Get the instrument logs files as a zip
+async def get_instrument_log_files(
+    name: str,
+    start: datetime = Query(None, description="Earliest time of the log records"),
+    end: datetime = Query(None, description="Latest time of the log records, excluded"),
+    compression: int = Query(None, ge=0, le=9, description="Compression level, from 0 (no compression) to 9")
+) -> StreamingResponse:
+    """Get the instrument logs files as a zip, streamed as it is built
 
     Args:
         name (str): The instrument name
+        start (datetime, optional): Earliest time of the log records to keep
+        end (datetime, optional): Latest time of the log records to keep, excluded
+        compression (int, optional): Compression level, from 0 (no compression) to 9
+
+    Raises:
+        HTTPException: If the instrument is not found
 
     Returns:
-        StreamingResponse: The instrument logs stream
+        StreamingResponse: The zip archive stream
     """
     instrument = config_service.get_instrument_config(name)
-    log_files = log_service.for_instrument(instrument).get_log_paths()
-    # make a zip file from the log files
-    # with tempfile.NamedTemporaryFile() as tmp:
-    #    zip_file = Path(tmp.name)
-    zip_file = Path(f"{name}.zip")
-    with ZipFile(zip_file, "w") as zip:
-        for file in log_files:
-            zip.write(file, file.name)
-    background_tasks.add_task(os.unlink, zip_file)
-    response = FileResponse(
-        zip_file, media_type="application/zip", filename=f"{name}.zip", background=background_tasks)
-    return response
+    if instrument is None:
+        raise HTTPException(status_code=404, detail="Instrument not found.")
+    return _zip_response(log_service.zip_logs([instrument], start, end, compression), f"{name}.zip")
+
+
+@router.get("/files")
+async def get_log_files(
+    name: List[str] = Query(None, description="Names of the instruments, all if none"),
+    start: datetime = Query(None, description="Earliest time of the log records"),
+    end: datetime = Query(None, description="Latest time of the log records, excluded"),
+    compression: int = Query(None, ge=0, le=9, description="Compression level, from 0 (no compression) to 9")
+) -> StreamingResponse:
+    """Get the logs files of several instruments as a zip, one folder per instrument, streamed as it is built
+
+    Args:
+        name (List[str], optional): Names of the instruments, all if none
+        start (datetime, optional): Earliest time of the log records to keep
+        end (datetime, optional): Latest time of the log records to keep, excluded
+        compression (int, optional): Compression level, from 0 (no compression) to 9
+
+    Raises:
+        HTTPException: If an instrument is not found
+
+    Returns:
+        StreamingResponse: The zip archive stream
+    """
+    if name:
+        instruments = [config_service.get_instrument_config(instrument_name) for instrument_name in name]
+        if None in instruments:
+            raise HTTPException(status_code=404, detail="Instrument not found.")
+    else:
+        instruments = config_service.get_config().instruments
+    return _zip_response(log_service.zip_logs(instruments, start, end, compression, folders=True), "logs.zip")
+
+
+def _zip_response(stream, filename: str) -> StreamingResponse:
+    # the archive is built in a thread, block by block, as the response is sent
+    return StreamingResponse(stream, media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
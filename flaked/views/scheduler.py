@@ -1,7 +1,13 @@
+from typing import List
+from datetime import datetime
 from fastapi import APIRouter, Query, HTTPException
+from starlette.concurrency import run_in_threadpool
 from ..services.scheduler import scheduler_service
 from ..services.config import config_service
-from ..models.query import Status, Action
+from ..services.retry import breaker_service
+from ..services.scan import scan_service
+from ..services.history import history_service
+from ..models.query import Status, Action, Run
 
 router = APIRouter()
 
@@ -40,6 +46,39 @@ async def set_status(
     return Status(status=scheduler_service.get_status())
 
 
+@router.get("/executor")
+async def get_executor() -> dict:
+    """Get the scheduler executor settings and usage
+
+    Returns:
+        dict: The number of threads running the jobs, and the number of jobs running
+    """
+    return scheduler_service.get_executor()
+
+
+@router.get("/breakers")
+async def get_breakers() -> list:
+    """Get the circuit breakers of the SFTP endpoints
+
+    Returns:
+        list: The state of each breaker: closed (uploads allowed), open (uploads suspended) or half_open (one upload allowed to probe the endpoint)
+    """
+    return breaker_service.get_breakers()
+
+
+@router.get("/scans")
+async def get_scans(name: str = None) -> dict:
+    """Get the statistics of the last input folder scan of the instruments
+
+    Args:
+        name (str, optional): The name of the instrument to filter by (optional)
+
+    Returns:
+        dict: The scan duration and number of entries examined, by instrument name
+    """
+    return scan_service.get_stats(name)
+
+
 @router.get("/jobs")
 async def get_jobs(name: str = None) -> list:
     """Get the scheduler jobs
@@ -100,11 +139,97 @@ async def get_job_status(job_id: str) -> Status:
 @router.post("/job/{job_id}")
 async def run_job(
     job_id: str,
-) -> Status:
+) -> Run:
+    """Run a job now, in the background
+
+    Args:
+        job_id (str): The job identifier (instrument name)
+
+    Raises:
+        HTTPException: If the instrument is not found
+
+    Returns:
+        Run: The run to poll, which may be an already pending or running one for the same instrument
+    """
     if config_service.get_instrument_config(scheduler_service.get_instrument_name(job_id)) is None:
         raise HTTPException(status_code=404, detail="Instrument not found.")
-    scheduler_service.run_job(job_id)
-    return await get_job_status(job_id)
+    return scheduler_service.submit_run(job_id)
+
+
+@router.get("/job/{job_id}/runs")
+async def get_job_runs(
+    job_id: str,
+    start: datetime = Query(None, description="Earliest start time of the runs"),
+    end: datetime = Query(None, description="Latest start time of the runs, excluded"),
+    offset: int = Query(0, ge=0, description="Number of runs to skip"),
+    limit: int = Query(50, ge=1, le=1000, description="Max number of runs")
+) -> dict:
+    """Get the run history of a job, the most recent first
+
+    Args:
+        job_id (str): The job identifier, or the instrument name for all its jobs
+        start (datetime, optional): Earliest start time of the runs
+        end (datetime, optional): Latest start time of the runs, excluded
+        offset (int, optional): Number of runs to skip
+        limit (int, optional): Max number of runs
+
+    Returns:
+        dict: The `total` number of runs, the `offset`, the `limit` and the page of `runs`
+    """
+    return await run_in_threadpool(history_service.get_runs, scheduler_service.get_instrument_name(job_id),
+                                   job_id if ':' in job_id else None, start, end, offset, limit)
+
+
+@router.get("/job/{job_id}/runs/daily")
+async def get_job_runs_daily(
+    job_id: str,
+    start: datetime = Query(None, description="Earliest start time of the runs"),
+    end: datetime = Query(None, description="Latest start time of the runs, excluded")
+) -> list:
+    """Get the daily totals of the run history of a job, the most recent day first
+
+    Args:
+        job_id (str): The job identifier, or the instrument name for all its jobs
+        start (datetime, optional): Earliest start time of the runs
+        end (datetime, optional): Latest start time of the runs, excluded
+
+    Returns:
+        list: The number of runs and failures, the durations, the files and bytes of each day
+    """
+    return await run_in_threadpool(history_service.get_summary, scheduler_service.get_instrument_name(job_id),
+                                   job_id if ':' in job_id else None, start, end)
+
+
+@router.get("/runs")
+async def get_runs(name: str = None) -> List[Run]:
+    """Get the on-demand runs, the most recent first
+
+    Args:
+        name (str, optional): The name of the instrument to filter by (optional)
+
+    Returns:
+        List[Run]: The runs
+    """
+    return scheduler_service.get_runs(name)
+
+
+@router.get("/run/{run_id}")
+async def get_run(run_id: str) -> Run:
+    """Get an on-demand run
+
+    Args:
+        run_id (str): The run identifier
+
+    Raises:
+        HTTPException: If the run is not found
+
+    Returns:
+        Run: The run status and result
+    """
+    run = scheduler_service.get_run(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found.")
+    return run
 
 
 @router.put("/job/{job_id}/status")
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from ..services.pool import sftp_pool
+from ..services.rate import rate_service
+
+router = APIRouter()
+
+
+@router.get("/pool")
+async def get_pool() -> dict:
+    """Get the SFTP connection pool statistics
+
+    Returns:
+        dict: The pool hit/miss counters and the connections per endpoint
+    """
+    return sftp_pool.get_stats()
+
+
+@router.get("/rates")
+async def get_rates() -> dict:
+    """Get the upload rate limits and the transfer accounting
+
+    Returns:
+        dict: The global limit and throughput, and for each instrument its cap, priority, bytes sent, seconds throttled and throughput
+    """
+    return rate_service.get_stats()
@@ -0,0 +1,44 @@
+import sys
+from flaked.services.command import run_command, TRUNCATED
+
+
+def test_run_command_streams_large_output():
+    out = []
+    err = []
+    # more than a pipe buffer on both streams, which would block a process read only at exit
+    script = "import sys\nfor i in range(20000):\n    print('line', i)\n    print('error', i, file=sys.stderr)"
+    stats = run_command([sys.executable, "-c", script],
+                        out.append, err.append, timeout=30, max_output=1000)
+    assert stats['returncode'] == 0
+    assert not stats['timed_out']
+    assert stats['truncated']
+    assert stats['stdout'] > 100000
+    assert out[0] == "line 0"
+    assert out[-1] == TRUNCATED
+    assert sum(len(line) + 1 for line in out[:-1]) <= 1000
+    assert err[-1] == TRUNCATED
+
+
+def test_run_command_timeout():
+    out = []
+    stats = run_command([sys.executable, "-c", "import time\nprint('started', flush=True)\ntime.sleep(30)"],
+                        out.append, out.append, timeout=1)
+    assert stats['timed_out']
+    assert stats['returncode'] != 0
+    assert stats['duration'] < 10
+    assert out == ["started"]
+
+
+def test_run_command_failing_callback():
+    err = []
+
+    def on_stdout(line: str):
+        raise ValueError(line)
+    # the output keeps being drained, so the process does not block on a full pipe
+    script = "import sys\nfor i in range(20000):\n    print('line', i)\nprint('done', file=sys.stderr)"
+    stats = run_command([sys.executable, "-c", script],
+                        on_stdout, err.append, timeout=30)
+    assert stats['returncode'] == 0
+    assert not stats['timed_out']
+    assert stats['stdout'] > 100000
+    assert err == ["done"]
@@ -1,5 +1,9 @@
-import yaml
+import importlib.util
 import os
+import pytest
+import yaml
+from pydantic import ValidationError
+from flaked.models.domain import CompressConfig
 
 
 def test_config():
@@ -16,3 +20,19 @@ def test_config():
     assert app['name'] == 'instrument2'
     assert app['schedule']['cron'] == '0 0 * * *'
     assert app['input']['path'] == 'instrument2/data'
+
+
+def test_compress_config():
+    assert CompressConfig(format='gzip', level=9).level == 9
+    assert CompressConfig().level is None
+    with pytest.raises(ValidationError, match="from 1 to 9"):
+        CompressConfig(format='gzip', level=15)
+    with pytest.raises(ValidationError, match="from 1 to 9"):
+        CompressConfig(level=0)
+    if importlib.util.find_spec('zstandard') is None:
+        with pytest.raises(ValidationError, match="zstandard"):
+            CompressConfig(format='zstd')
+    else:
+        assert CompressConfig(format='zstd', level=22).level == 22
+        with pytest.raises(ValidationError, match="from 1 to 22"):
+            CompressConfig(format='zstd', level=23)
@@ -0,0 +1,102 @@
+import threading
+import time
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.schedulers.background import BackgroundScheduler
+from flaked.services.executor import PriorityExecutor
+
+
+def test_priority_executor():
+    priorities = {'busy': 0, 'low1': 0, 'low2': 0, 'high': 10}
+    executor = PriorityExecutor(
+        1, lambda job: priorities[job.id], aging=3600)
+    scheduler = BackgroundScheduler(executors={'default': executor})
+    scheduler.start()
+    release = threading.Event()
+    done = []
+    try:
+        scheduler.add_job(release.wait, id='busy', kwargs={'timeout': 10})
+        time.sleep(0.2)
+        for job_id in ['low1', 'low2', 'high']:
+            scheduler.add_job(done.append, id=job_id, args=[job_id])
+            time.sleep(0.05)
+        deadline = time.monotonic() + 5
+        while len(executor.get_queue()) < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        queue = executor.get_queue()
+        assert [entry['id'] for entry in queue] == ['high', 'low1', 'low2']
+        assert queue[0]['position'] == 1 and queue[2]['waited'] > 0
+        assert executor.get_active() == 1
+        release.set()
+        while len(done) < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert done == ['high', 'low1', 'low2']
+    finally:
+        release.set()
+        scheduler.shutdown()
+
+
+def test_priority_executor_shutdown():
+    executor = PriorityExecutor(1)
+    scheduler = BackgroundScheduler(executors={'default': executor})
+    missed = []
+    scheduler.add_listener(lambda event: missed.append(event.job_id), EVENT_JOB_MISSED)
+    scheduler.start()
+    release = threading.Event()
+    try:
+        scheduler.add_job(release.wait, id='busy', kwargs={'timeout': 10})
+        time.sleep(0.2)
+        for job_id in ['waiting1', 'waiting2']:
+            scheduler.add_job(print, id=job_id)
+        deadline = time.monotonic() + 5
+        while len(executor.get_queue()) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        scheduler.shutdown(wait=False)
+        # the waiting jobs are reported, and not counted as running anymore
+        assert sorted(missed) == ['waiting1', 'waiting2']
+        assert executor.get_queue() == []
+        assert set(executor._instances) == {'busy'}
+    finally:
+        release.set()
+
+
+def test_priority_executor_saturated():
+    executor = PriorityExecutor(1, lambda job: 0 if job.id == 'low' else 10, aging=0.1)
+    scheduler = BackgroundScheduler(executors={'default': executor})
+    scheduler.start()
+    done = []
+    try:
+        # a stream of high priority jobs, keeping the only thread busy for longer than the grace time
+        scheduler.add_job(time.sleep, id='high0', args=[0.1])
+        scheduler.add_job(done.append, id='low', args=['low'], misfire_grace_time=1)
+        deadline = time.monotonic() + 5
+        i = 1
+        while 'low' not in done and time.monotonic() < deadline:
+            if len(executor.get_queue()) < 3:
+                scheduler.add_job(time.sleep, id=f"high{i}", args=[0.1])
+                i += 1
+            time.sleep(0.02)
+        # aged enough to pass the high priority jobs, without being missed meanwhile
+        assert done == ['low']
+        assert i > 10
+    finally:
+        scheduler.shutdown(wait=False)
+
+
+class FakeJob:
+
+    def __init__(self, id: str, priority: int):
+        self.id = id
+        self.priority = priority
+        self.misfire_grace_time = None
+
+
+def test_priority_executor_aging(monkeypatch):
+    now = [100]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    executor = PriorityExecutor(1, lambda job: job.priority, aging=1)
+    executor._do_submit_job(FakeJob('old', 0), [])
+    now[0] = 105
+    executor._do_submit_job(FakeJob('new', 3), [])
+    executor._do_submit_job(FakeJob('urgent', 10), [])
+    # waiting 5 seconds is worth 5 priority points
+    assert [entry['id'] for entry in executor.get_queue()] == ['urgent', 'old', 'new']
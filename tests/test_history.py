@@ -0,0 +1,55 @@
+import sqlite3
+import time
+from datetime import datetime
+from flaked.services.config import config_service
+from flaked.services.history import HistoryService
+
+
+def make_run(job_id: str, started: float, outcome: str = "success") -> dict:
+    return {
+        'instrument': job_id.split(':')[0],
+        'job_id': job_id,
+        'started': started,
+        'duration': 1.5,
+        'outcome': outcome,
+        'files': 3,
+        'uploaded': 2,
+        'moved': 2,
+        'bytes': 2048,
+        'sent': 1024,
+        'stages': {'scan': 0.1, 'upload': 1.2, 'move': 0.2},
+    }
+
+
+def test_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    monkeypatch.setattr(config_service.get_settings(), 'history_days', 30)
+    now = time.time()
+    service = HistoryService()
+    # expired, removed by the first prune
+    service.record(make_run('instrument1:cron', now - 40 * 86400))
+    service.record(make_run('instrument1:cron', now - 100))
+    service.record(make_run('instrument1:retry', now - 50, "failure"))
+    service.record(make_run('instrument1:cron', now))
+    service.record(make_run('instrument2:cron', now))
+    assert sqlite3.connect(tmp_path / 'state' / 'history.db').execute(
+        "PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    page = service.get_runs('instrument1', limit=2)
+    assert page['total'] == 3
+    assert [run['job_id'] for run in page['runs']] == [
+        'instrument1:cron', 'instrument1:retry']
+    assert page['runs'][0]['stages'] == {'scan': 0.1, 'upload': 1.2, 'move': 0.2}
+    assert page['runs'][1]['outcome'] == 'failure'
+    assert service.get_runs('instrument1', offset=2)['runs'][0]['started'] == datetime.fromtimestamp(
+        now - 100).astimezone().isoformat()
+    assert service.get_runs('instrument1', 'instrument1:cron')['total'] == 2
+    assert service.get_runs('instrument1', start=datetime.fromtimestamp(now - 60),
+                            end=datetime.fromtimestamp(now - 10))['total'] == 1
+
+    days = service.get_summary('instrument1')
+    assert sum(day['runs'] for day in days) == 3
+    assert sum(day['failures'] for day in days) == 1
+    assert sum(day['bytes'] for day in days) == 3 * 2048
+    service.close()
@@ -0,0 +1,178 @@
+import os
+import time
+from pathlib import Path
+import pytest
+from flaked.services import job
+from flaked.services.config import config_service
+from flaked.services.log import log_service
+from flaked.services.retry import BreakerService
+from flaked.services.scheduler import scheduler_service
+from flaked.models.domain import (Config, SystemConfig, SFTPConfig, LogsConfig, InstrumentConfig, ScheduleConfig,
+                                  InputConfig, OutputConfig, StableConfig, PipelineConfig, BreakerConfig)
+from flaked.models.upload import UploadResult, UploadState
+
+
+class FakeUploadService:
+    """Uploads nothing, fails the files which name is in `failing`, and records the calls."""
+    failing = []
+    calls = []
+
+    def __init__(self, limiter=None):
+        pass
+
+    def make_results(self, files, remote_path, compress=None, partition=None):
+        return [UploadResult(path=file, remote_path=f"{remote_path}/{file.name}") for file in files]
+
+    def upload(self, results, concurrency=None, compress=None, verify=None):
+        results = [result for result in results if not result.success]
+        FakeUploadService.calls.append([result.path.name for result in results])
+        for result in results:
+            # moved only once uploaded
+            assert result.path.exists()
+            result.size = result.path.stat().st_size
+            result.state = UploadState.failed if result.path.name in self.failing else UploadState.done
+        return results
+
+
+class FakeLedgerService:
+    """Every file was already uploaded."""
+
+    def skip_uploaded(self, name, results, workers=4):
+        for result in results:
+            result.state = UploadState.done
+            result.duplicate = True
+        return len(results)
+
+    def record(self, name, results, retention, workers=4):
+        pass
+
+
+@pytest.fixture
+def instrument(tmp_path, monkeypatch):
+    config = Config(
+        settings=SystemConfig(sftp=SFTPConfig(host='localhost', username='test', password='test'),
+                              logs=LogsConfig(path=str(tmp_path / 'logs')), state=str(tmp_path / 'state'),
+                              attempts=3),
+        instruments=[InstrumentConfig(name='jobtest', schedule=ScheduleConfig(),
+                                      input=InputConfig(path=str(tmp_path / 'input')),
+                                      output=OutputConfig(path=str(tmp_path / 'output')))])
+    monkeypatch.setattr(config_service, 'config', config)
+    monkeypatch.setattr(job, 'UploadService', FakeUploadService)
+    monkeypatch.setattr(job, 'breaker_service', BreakerService())
+    monkeypatch.setattr(FakeUploadService, 'failing', [])
+    monkeypatch.setattr(FakeUploadService, 'calls', [])
+    (tmp_path / 'input').mkdir()
+    yield config.instruments[0]
+    log_service.clear('jobtest')
+
+
+def make_files(folder: Path, count: int):
+    for i in range(count):
+        file = folder / f"file{i:02d}.csv"
+        file.write_text("data")
+        os.utime(file, ns=(i * 1_000_000_000, i * 1_000_000_000))
+
+
+def test_process_retry(instrument, tmp_path):
+    make_files(tmp_path / 'input', 3)
+    FakeUploadService.failing = ['file01.csv']
+    retries = []
+    processor = job.JobProcessor(
+        'jobtest:cron', on_retry=lambda *args: retries.append(args))
+    processor.process()
+    assert processor.result == {'files': 3, 'uploaded': 2, 'moved': 2}
+    assert sorted(file.name for file in (tmp_path / 'output').iterdir()) == ['file00.csv', 'file02.csv']
+    # the failed file is handed back to the scheduler, for a first retry
+    assert len(retries) == 1
+    job_id, files, attempt, delay = retries[0]
+    assert (job_id, files, attempt) == ('jobtest:cron', [tmp_path / 'input' / 'file01.csv'], 1)
+    assert delay > 0
+
+    # last attempt: given up
+    retries.clear()
+    job.JobProcessor('jobtest:retry', attempt=2, on_retry=lambda *args: retries.append(args)).retry(files)
+    assert retries == []
+
+
+def test_read_input_files_unstable(instrument, tmp_path):
+    source = tmp_path / 'input'
+    make_files(source, 4)
+    # a lock held, a sentinel present and a sentinel missing, none of the markers is unstable
+    (source / 'file00.csv.lock').write_text("")
+    (source / 'file00.csv.done').write_text("")
+    (source / 'file01.csv.done').write_text("")
+    (source / 'file02.csv.done').write_text("")
+    for marker in source.glob('*.done'):
+        os.utime(marker, ns=(0, 0))
+    os.utime(source / 'file00.csv.lock', ns=(0, 0))
+    instrument.input.stable = StableConfig(quiet=10, lock='.lock', sentinel='.done')
+    processor = job.JobProcessor('jobtest:watch')
+    processor.instrument = instrument
+    processor.logger = log_service.for_instrument(instrument)
+    files = processor.read_input_files()
+    assert sorted(file.name for file in files) == ['file01.csv', 'file02.csv']
+    # locked, and without sentinel
+    assert processor.unstable == 2
+
+
+def test_schedule_retry_merge():
+    scheduler_service.schedule_retry('jobtest:cron', [Path('a.csv'), Path('b.csv')], 2, 3600)
+    scheduler_service.schedule_retry('jobtest:retry', [Path('b.csv'), Path('c.csv')], 1, 3600)
+    try:
+        kwargs = scheduler_service.scheduler.get_job('jobtest:retry').kwargs
+        assert kwargs['files'] == ['a.csv', 'b.csv', 'c.csv']
+        assert kwargs['attempt'] == 1
+    finally:
+        scheduler_service.scheduler.remove_job('jobtest:retry')
+
+
+def test_run_pipeline(instrument, tmp_path):
+    make_files(tmp_path / 'input', 7)
+    FakeUploadService.failing = ['file05.csv']
+    instrument.pipeline = PipelineConfig(batch=2, queue=1)
+    processor = job.JobProcessor('jobtest:cron', on_retry=lambda *args: None)
+    processor.process()
+    # the oldest files first, stopped at the first batch not fully uploaded
+    assert FakeUploadService.calls == [['file00.csv', 'file01.csv'], ['file02.csv', 'file03.csv'],
+                                       ['file04.csv', 'file05.csv']]
+    assert sorted(file.name for file in (tmp_path / 'output').iterdir()) == [
+        'file00.csv', 'file01.csv', 'file02.csv', 'file03.csv', 'file04.csv']
+    assert sorted(file.name for file in (tmp_path / 'input').iterdir()) == ['file05.csv', 'file06.csv']
+    assert processor.result['moved'] == 5
+
+
+def test_run_pipeline_overlap(instrument, tmp_path, monkeypatch):
+    make_files(tmp_path / 'input', 6)
+    instrument.pipeline = PipelineConfig(batch=2, queue=1)
+    overlapped = []
+    move_files = job.JobProcessor.move_files
+
+    def slow_move_files(self, files):
+        if not overlapped:
+            # the next batch is uploaded while the first one is being moved
+            deadline = time.monotonic() + 5
+            while len(FakeUploadService.calls) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            overlapped.append(len(FakeUploadService.calls) >= 2)
+        move_files(self, files)
+    monkeypatch.setattr(job.JobProcessor, 'move_files', slow_move_files)
+    processor = job.JobProcessor('jobtest:cron', on_retry=lambda *args: None)
+    processor.process()
+    assert overlapped == [True]
+    assert processor.result == {'files': 6, 'uploaded': 6, 'moved': 6}
+
+
+def test_upload_duplicates_breaker(instrument, tmp_path, monkeypatch):
+    make_files(tmp_path / 'input', 2)
+    instrument.output.dedup = True
+    monkeypatch.setattr(job, 'ledger_service', FakeLedgerService())
+    settings = config_service.get_settings()
+    monkeypatch.setattr(settings, 'breaker', BreakerConfig(threshold=1, reset=0))
+    breaker = job.breaker_service.for_endpoint(settings.sftp, settings.breaker)
+    breaker.record_failure()
+    processor = job.JobProcessor('jobtest:cron', on_retry=lambda *args: None)
+    processor.process()
+    assert processor.result == {'files': 2, 'uploaded': 2, 'moved': 2}
+    # nothing was sent: the endpoint is still to be probed
+    assert breaker.to_dict()['state'] == "half_open"
+    assert breaker.allow()
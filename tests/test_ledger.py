@@ -0,0 +1,40 @@
+import os
+from pathlib import Path
+from flaked.services.config import config_service
+from flaked.services.ledger import LedgerService, hash_file
+from flaked.models.upload import UploadResult, UploadState
+
+
+def make_result(file: Path) -> UploadResult:
+    return UploadResult(path=file, remote_path='data/instrument1/' + file.name)
+
+
+def test_ledger(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    files = []
+    for i in range(3):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text(f"data{i}")
+        files.append(file)
+
+    # as uploaded
+    results = [make_result(file) for file in files]
+    for result in results:
+        stat = result.path.stat()
+        result.state = UploadState.done
+        result.size = stat.st_size
+        result.mtime = stat.st_mtime_ns
+    results[1].digest = hash_file(files[1])
+    service = LedgerService()
+    service.record('instrument1', results)
+    assert (tmp_path / 'state' / 'instrument1.ledger.json').exists()
+
+    # same file, re-emitted file with same content, modified file
+    os.utime(files[1], ns=(0, 0))
+    files[2].write_text("other")
+    results = [make_result(file) for file in files]
+    assert LedgerService().skip_uploaded('instrument1', results) == 2
+    assert [result.state for result in results] == [
+        UploadState.done, UploadState.done, UploadState.pending]
+    assert results[0].duplicate and not results[2].duplicate
@@ -0,0 +1,121 @@
+import asyncio
+import io
+import os
+import threading
+import time
+import zipfile
+from flaked.models.domain import (Config, SystemConfig, SFTPConfig, LogsConfig, InstrumentConfig, ScheduleConfig,
+                                  InputConfig, OutputConfig)
+from flaked.services import log
+from flaked.services.config import config_service
+from flaked.services.log import log_broker, log_service, tail_file, tail_files, zip_stream
+
+
+def test_tail_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(log, 'TAIL_BLOCK_SIZE', 16)
+    current = tmp_path / 'instrument1.log'
+    rotated = tmp_path / 'instrument1.log.1'
+    rotated.write_bytes(b''.join(f"old line {i}\n".encode() for i in range(10)))
+    current.write_bytes(b''.join(f"new line {i}\n".encode() for i in range(5)))
+
+    assert tail_file(current, 2) == [b"new line 3\n", b"new line 4\n"]
+    assert tail_file(current, 100) == [f"new line {i}\n".encode() for i in range(5)]
+    # spans the rotated file, the oldest line first
+    assert tail_files([current, rotated, tmp_path / 'instrument1.log.2'], 7) == [
+        b"old line 8\n", b"old line 9\n"] + [f"new line {i}\n".encode() for i in range(5)]
+
+    # last line being written
+    current.write_bytes(b"line 0\nline 1\nline 2")
+    assert tail_file(current, 2) == [b"line 1\n", b"line 2"]
+
+
+def test_log_broker():
+    async def follow():
+        broker = log.LogBroker()
+        fast = broker.subscribe('instrument1', 10)
+        slow = broker.subscribe('instrument1', 2)
+        other = broker.subscribe('instrument2')
+        # published from the logging threads
+        thread = threading.Thread(target=lambda: [broker.publish(
+            'instrument1', f"line {i}") for i in range(5)])
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0)
+        assert [await fast.get(1) for _ in range(5)] == [f"line {i}" for i in range(5)]
+        assert [await slow.get(1) for _ in range(2)] == ["line 0", "line 1"]
+        # the drops are reported where they happened, after the lines queued before
+        broker.publish('instrument1', "line 5")
+        await asyncio.sleep(0)
+        dropped = await slow.get(1)
+        assert isinstance(dropped, log.DroppedLines) and dropped.count == 3
+        assert await slow.get(1) == "line 5"
+        assert other.queue.empty()
+        broker.unsubscribe(fast)
+        broker.unsubscribe(slow)
+        assert broker.count('instrument1') == 0
+
+    asyncio.run(follow())
+
+
+def test_zip_stream():
+    data = os.urandom(200000)
+    members = [('a.log', 1735732800, iter([data[:100000], data[100000:]])),
+               ('b/b.log', 1735732800, iter([b"line\n" * 1000]))]
+    chunks = list(zip_stream(members, 9))
+    assert len(chunks) > 1
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+        assert archive.namelist() == ['a.log', 'b/b.log']
+        assert archive.read('a.log') == data
+        assert archive.read('b/b.log') == b"line\n" * 1000
+        assert archive.getinfo('a.log').date_time == time.localtime(1735732800)[:6]
+
+
+def test_zip_stream_compression():
+    data = b"".join(f"line {i}, value {i * 7 % 1000}\n".encode() for i in range(20000))
+
+    def archive(compression):
+        return b''.join(zip_stream([('a.log', 1735732800, iter([data]))], compression))
+    stored = archive(0)
+    with zipfile.ZipFile(io.BytesIO(stored)) as stored_archive:
+        assert stored_archive.getinfo('a.log').compress_type == zipfile.ZIP_STORED
+        assert stored_archive.read('a.log') == data
+    # the level is applied to each entry
+    fastest = archive(1)
+    best = archive(9)
+    assert len(best) < len(fastest) < len(stored)
+    with zipfile.ZipFile(io.BytesIO(best)) as best_archive:
+        assert best_archive.getinfo('a.log').compress_type == zipfile.ZIP_DEFLATED
+        assert best_archive.read('a.log') == data
+
+
+def test_follow_tail(tmp_path, monkeypatch):
+    config = Config(
+        settings=SystemConfig(sftp=SFTPConfig(host='localhost', username='test', password='test'),
+                              logs=LogsConfig(path=str(tmp_path / 'logs'))),
+        instruments=[InstrumentConfig(name='followtest', schedule=ScheduleConfig(),
+                                      input=InputConfig(path=str(tmp_path / 'input')),
+                                      output=OutputConfig(path=str(tmp_path / 'output')))])
+    monkeypatch.setattr(config_service, 'config', config)
+    logger = log_service.for_instrument(config.instruments[0])
+
+    async def follow():
+        subscription = log_broker.subscribe('followtest')
+        # written after the subscription, before the tail
+        logger.info("line 0")
+        logger.info("line 1")
+        subscription.after = logger.get_position()
+        logger.info("line 2")
+        logger.handlers[0].doRollover()
+        logger.info("line 3")
+        lines = logger.tail(10, subscription.after)
+        followed = [await subscription.get(1) for _ in range(2)]
+        log_broker.unsubscribe(subscription)
+        return lines, followed
+
+    try:
+        lines, followed = asyncio.run(follow())
+    finally:
+        log_service.clear('followtest')
+    # each line sent once, from the tail or from the broker
+    assert [line.decode().rstrip().split(',')[-1] for line in lines] == ['"line 0"', '"line 1"']
+    assert [line.split(',')[-1] for line in followed] == ['"line 2"', '"line 3"']
@@ -0,0 +1,28 @@
+from flaked.services.metrics import MetricsService
+
+
+def test_metrics_render():
+    service = MetricsService()
+    counter = service.counter("test_total", "A counter", ["instrument"])
+    counter.inc(instrument="instrument1")
+    counter.inc(2, instrument='in"strument2')
+    histogram = service.histogram(
+        "test_seconds", "A histogram", ["stage"], buckets=(0.1, 1))
+    histogram.observe(0.05, stage="scan")
+    histogram.observe(0.5, stage="scan")
+    histogram.observe(5, stage="scan")
+    service.gauge("test_jobs", "A gauge", ["state"],
+                  lambda: {("queued",): 3})
+
+    lines = service.render().splitlines()
+    assert "# TYPE test_total counter" in lines
+    assert 'test_total{instrument="instrument1"} 1' in lines
+    assert 'test_total{instrument="in\\"strument2"} 2' in lines
+    assert 'test_seconds_bucket{stage="scan",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="scan",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="scan",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="scan"} 5.55' in lines
+    assert 'test_seconds_count{stage="scan"} 3' in lines
+    assert 'test_jobs{state="queued"} 3' in lines
+    # registered once
+    assert service.counter("test_total", "A counter", ["instrument"]) is counter
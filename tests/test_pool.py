@@ -0,0 +1,106 @@
+import threading
+import time
+from flaked.models.domain import SFTPConfig, PoolConfig
+from flaked.services.pool import SFTPPool
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.sftp = None
+        self.last_used = 0
+        self.active = True
+        self.closed = False
+
+    def is_active(self):
+        return self.active
+
+    def is_healthy(self):
+        return self.active
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool():
+    pool = SFTPPool()
+    pool._connect = lambda sftp_config: FakeConnection()
+    return pool
+
+
+def test_pool_reuse():
+    config = SFTPConfig(host='localhost', username='test', password='test')
+    pool = make_pool()
+    with pool.lease(config) as conn1:
+        pass
+    with pool.lease(config) as conn2:
+        pass
+    assert conn1 is conn2
+    stats = pool.get_stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+    assert stats['endpoints']['test@localhost:22'] == {'idle': 1, 'leased': 0}
+
+
+def test_pool_discard_on_error():
+    config = SFTPConfig(host='localhost', username='test', password='test')
+    pool = make_pool()
+    try:
+        with pool.lease(config) as conn1:
+            raise IOError("broken")
+    except IOError:
+        pass
+    assert conn1.closed
+    with pool.lease(config) as conn2:
+        assert conn2 is not conn1
+    assert pool.get_stats()['discarded'] == 1
+
+
+def test_pool_max_size():
+    config = SFTPConfig(host='localhost', username='test', password='test',
+                        pool=PoolConfig(max_size=1, timeout=0))
+    pool = make_pool()
+    conn = pool.acquire(config)
+    try:
+        pool.acquire(config)
+        assert False
+    except TimeoutError:
+        pass
+    pool.release(config, conn)
+    assert pool.acquire(config) is conn
+
+
+class SlowClosingConnection(FakeConnection):
+
+    def __init__(self):
+        super().__init__()
+        self.closing = threading.Event()
+        self.release = threading.Event()
+
+    def close(self):
+        self.closing.set()
+        self.release.wait(5)
+        super().close()
+
+
+def test_pool_evict_out_of_lock():
+    config = SFTPConfig(host='localhost', username='test', password='test',
+                        pool=PoolConfig(idle_timeout=1))
+    pool = make_pool()
+    expired = SlowClosingConnection()
+    expired.last_used = time.monotonic() - 10
+    pool.idle[pool._get_key(config)] = [expired]
+    thread = threading.Thread(target=pool.acquire, args=[config])
+    thread.start()
+    try:
+        assert expired.closing.wait(5)
+        # the pool is usable while the expired connection is being closed
+        stats = threading.Thread(target=pool.get_stats)
+        stats.start()
+        stats.join(1)
+        assert not stats.is_alive()
+        assert pool.get_stats()['evictions'] == 1
+    finally:
+        expired.release.set()
+        thread.join()
+    assert expired.closed
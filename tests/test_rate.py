@@ -0,0 +1,34 @@
+import threading
+import time
+from flaked.services.rate import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100000, 10000)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.consume(10000)
+    # the first chunk is taken from the full bucket, the others at the rate
+    assert 0.8 <= time.monotonic() - start < 1.5
+
+
+def test_token_bucket_priority():
+    bucket = TokenBucket(100000, 10000)
+    bucket.consume(50000)  # in debt for half a second
+    served = []
+
+    def consume(name, priority):
+        bucket.consume(10000, priority)
+        served.append(name)
+
+    threads = [threading.Thread(target=consume, args=(f"low{i}", 0)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    thread = threading.Thread(target=consume, args=("high", 10))
+    thread.start()
+    threads.append(thread)
+    for thread in threads:
+        thread.join()
+    # the high priority waiter overtakes the low priority ones still waiting
+    assert served.index("high") <= 1
@@ -0,0 +1,52 @@
+from flaked.models.domain import SFTPConfig, BreakerConfig
+from flaked.services.retry import BreakerService, CircuitBreaker, get_backoff
+
+
+def test_backoff():
+    for _ in range(100):
+        assert 2.5 <= get_backoff(1, 5, 300) <= 5
+        assert 10 <= get_backoff(3, 5, 300) <= 20
+        assert 150 <= get_backoff(10, 5, 300) <= 300
+
+
+def test_breaker():
+    breaker = CircuitBreaker("test", BreakerConfig(threshold=2, reset=0))
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.to_dict()['state'] == "closed"
+    breaker.record_failure()
+    assert breaker.to_dict()['state'] == "open"
+    # reset delay elapsed: a single probe is allowed
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.to_dict()['state'] == "open"
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.to_dict()['state'] == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_open():
+    breaker = CircuitBreaker("test", BreakerConfig(threshold=1, reset=60))
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert 0 < breaker.get_remaining() <= 60
+
+
+def test_breaker_service():
+    service = BreakerService()
+    config = SFTPConfig(host='localhost', username='test', password='test')
+    breaker = service.for_endpoint(config, BreakerConfig())
+    assert service.for_endpoint(config, BreakerConfig()) is breaker
+    assert service.get_breakers()[0]['endpoint'] == "test@localhost:22"
+
+
+def test_breaker_release():
+    breaker = CircuitBreaker("test", BreakerConfig(threshold=1, reset=0))
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    # the probe was interrupted before its outcome was recorded
+    breaker.release()
+    assert breaker.allow()
@@ -0,0 +1,103 @@
+import os
+from flaked.services.config import config_service
+from flaked.services import scan
+from flaked.services.scan import ScanService, filter_stable, select_files
+
+
+def make_files(folder, count: int):
+    folder.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        file = folder / f"file{i}.csv"
+        file.write_text("data")
+        os.utime(file, ns=(i * 1_000_000_000, i * 1_000_000_000))
+    # as if the folder was last modified long ago
+    os.utime(folder, ns=(0, 0))
+
+
+def test_scan(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    source = tmp_path / 'data'
+    make_files(source, 5)
+    (source / 'other.txt').write_text("data")
+    os.utime(source, ns=(0, 0))
+
+    service = ScanService()
+    entries = service.scan('instrument1', source, r'.*\.csv')
+    assert sorted(entries.keys()) == [f"file{i}.csv" for i in range(5)]
+    assert entries['file3.csv']['mtime'] == 3_000_000_000
+    stats = service.get_stats('instrument1')['instrument1']
+    assert stats['full_scan'] and stats['examined'] == 6 and stats['stated'] == 5
+
+    # folder unchanged, nothing examined
+    assert service.scan('instrument1', source, r'.*\.csv') == entries
+    stats = service.get_stats('instrument1')['instrument1']
+    assert not stats['full_scan'] and stats['examined'] == 0
+
+    # the index survives a restart, only the new file is stat'ed
+    (source / 'file0.csv').unlink()
+    (source / 'file9.csv').write_text("data")
+    os.utime(source, ns=(1, 1))
+    service = ScanService()
+    entries = service.scan('instrument1', source, r'.*\.csv')
+    assert sorted(entries.keys()) == [f"file{i}.csv" for i in [1, 2, 3, 4, 9]]
+    stats = service.get_stats('instrument1')['instrument1']
+    assert stats['full_scan'] and stats['stated'] == 1
+
+
+def test_select_files():
+    entries = {f"file{i}.csv": {'mtime': i} for i in [3, 1, 4, 0, 2]}
+    assert sorted(select_files(entries)) == sorted(entries.keys())
+    assert sorted(select_files(entries, skip=2)) == [
+        'file0.csv', 'file1.csv', 'file2.csv']
+    assert select_files(entries, skip=2, max_files=2) == [
+        'file0.csv', 'file1.csv']
+    assert select_files(entries, skip=5) == []
+
+
+def test_scan_stable(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    source = tmp_path / 'data'
+    make_files(source, 3)
+    # being written
+    (source / 'file3.csv').write_text("data")
+    service = ScanService()
+    entries = service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    assert sorted(filter_stable(entries, 10).keys()) == [
+        'file0.csv', 'file1.csv', 'file2.csv']
+
+    # still growing, although its mtime was set back
+    (source / 'file3.csv').write_text("more data")
+    os.utime(source / 'file3.csv', ns=(0, 0))
+    os.utime(source, ns=(0, 0))
+    entries = service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    assert entries['file3.csv']['size'] == 9
+    assert 'file3.csv' not in filter_stable(entries, 10)
+    assert 'file3.csv' in filter_stable(entries, 0)
+
+
+def test_scan_unchanged(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    source = tmp_path / 'data'
+    make_files(source, 5)
+    service = ScanService()
+    service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    stats = []
+    stat = os.stat
+    monkeypatch.setattr(scan.os, 'stat', lambda path, *args, **kwargs: stats.append(path) or stat(path, *args, **kwargs))
+    # only the folder is stat'ed, its files are stable
+    service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    assert stats == [source]
+
+    # a recent file is stat'ed again until stable
+    (source / 'file5.csv').write_text("data")
+    os.utime(source, ns=(1, 1))
+    service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    stats.clear()
+    service.scan('instrument1', source, r'.*\.csv', quiet=10)
+    assert stats == [source, source / 'file5.csv']
+    stats.clear()
+    service.scan('instrument1', source, r'.*\.csv')
+    assert stats == [source]
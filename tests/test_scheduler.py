@@ -0,0 +1,119 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from apscheduler.events import (JobExecutionEvent, JobSubmissionEvent, EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES,
+                                EVENT_JOB_MISSED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR)
+from apscheduler.triggers.interval import IntervalTrigger
+from flaked.services.config import config_service
+from flaked.services import scheduler
+from flaked.services.scheduler import scheduler_service
+from flaked.models.domain import InstrumentConfig, ScheduleConfig, InputConfig, OutputConfig, SchedulerConfig
+from flaked.models.query import Run, RunStatus
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_job_options(monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(), 'scheduler', SchedulerConfig(
+        max_instances=2, coalesce=False, misfire_grace_time=30))
+    instrument = InstrumentConfig(name='optionstest', schedule=ScheduleConfig(coalesce=True),
+                                  input=InputConfig(path='input'), output=OutputConfig(path='output'))
+    # the options not defined by the instrument default to the system settings
+    assert scheduler_service._get_job_options(instrument) == {
+        'max_instances': 2, 'coalesce': True, 'misfire_grace_time': 30}
+    instrument.schedule.max_instances = 1
+    instrument.schedule.misfire_grace_time = 0
+    assert scheduler_service._get_job_options(instrument) == {
+        'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 0}
+
+
+def test_job_counters():
+    job_id = 'counterstest:interval'
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    scheduler_service.scheduler.add_job(print, IntervalTrigger(minutes=1, start_date=start), id=job_id,
+                                        name='counterstest', coalesce=True, next_run_time=None)
+    try:
+        def at(minutes: int) -> datetime:
+            return start + timedelta(minutes=minutes)
+
+        scheduler_service._on_job_event(JobSubmissionEvent(EVENT_JOB_SUBMITTED, job_id, 'default', [at(0)]))
+        scheduler_service._on_job_event(JobExecutionEvent(EVENT_JOB_EXECUTED, job_id, 'default', at(0)))
+        # the runs of minutes 1 to 3 were merged into the one of minute 4
+        scheduler_service._on_job_event(JobSubmissionEvent(EVENT_JOB_SUBMITTED, job_id, 'default', [at(4)]))
+        scheduler_service._on_job_event(JobExecutionEvent(EVENT_JOB_ERROR, job_id, 'default', at(4)))
+        scheduler_service._on_job_event(JobSubmissionEvent(EVENT_JOB_MAX_INSTANCES, job_id, 'default', [at(5)]))
+        scheduler_service._on_job_event(JobExecutionEvent(EVENT_JOB_MISSED, job_id, 'default', at(6)))
+        runs = scheduler_service.get_job(job_id)['runs']
+        assert runs == {
+            'submitted': 2,
+            'skipped': 1,
+            'missed': 1,
+            'coalesced': 3,
+            'executed': 1,
+            'errors': 1,
+            'last_run_time': str(at(5)),
+        }
+    finally:
+        scheduler_service.scheduler.remove_job(job_id)
+        scheduler_service.stats.pop(job_id, None)
+
+
+def test_submit_run(monkeypatch):
+    release = threading.Event()
+
+    def process_data(job_id):
+        release.wait(10)
+        return SimpleNamespace(result={'files': 1, 'uploaded': 1, 'moved': 1})
+    monkeypatch.setattr(scheduler, 'process_data', process_data)
+    scheduler_service.scheduler.add_job(print, id='runtest:cron', name='runtest', next_run_time=None)
+    try:
+        run = scheduler_service.submit_run('runtest:cron')
+        assert run.status in (RunStatus.pending, RunStatus.running)
+        # the run in progress is returned again
+        assert wait_for(lambda: run.status == RunStatus.running)
+        assert scheduler_service.submit_run('runtest:cron') is run
+        release.set()
+        assert wait_for(lambda: scheduler_service.get_run(run.id).finished is not None)
+        assert run.status == RunStatus.success
+        assert run.result == {'files': 1, 'uploaded': 1, 'moved': 1}
+        # a new run once the previous one is done
+        other = scheduler_service.submit_run('runtest:cron')
+        assert other.id != run.id
+        assert wait_for(lambda: other.status == RunStatus.success)
+    finally:
+        release.set()
+        scheduler_service.scheduler.remove_job('runtest:cron')
+        scheduler_service.stats.pop('runtest:run', None)
+
+
+def test_submit_run_lost(monkeypatch):
+    monkeypatch.setattr(scheduler, 'process_data', lambda job_id: SimpleNamespace(result={}))
+    scheduler_service.scheduler.add_job(print, id='losttest:cron', name='losttest', next_run_time=None)
+    try:
+        # dropped by the executor
+        missed = Run(id='missed', job_id='losttest:cron', submitted=datetime.now().astimezone())
+        with scheduler_service.runs_lock:
+            scheduler_service.runs[missed.id] = missed
+            scheduler_service.live_runs['losttest:run'] = missed.id
+        scheduler_service._on_job_event(JobExecutionEvent(
+            EVENT_JOB_MISSED, 'losttest:run', 'default', datetime.now(timezone.utc)))
+        assert missed.status == RunStatus.failure and missed.finished is not None
+
+        # left pending, although neither scheduled nor queued
+        lost = Run(id='lost', job_id='losttest:cron', submitted=datetime.now().astimezone())
+        with scheduler_service.runs_lock:
+            scheduler_service.runs[lost.id] = lost
+            scheduler_service.live_runs['losttest:run'] = lost.id
+        run = scheduler_service.submit_run('losttest:cron')
+        assert run.id != lost.id
+        assert lost.status == RunStatus.failure
+        assert wait_for(lambda: run.status == RunStatus.success)
+    finally:
+        scheduler_service.scheduler.remove_job('losttest:cron')
+        scheduler_service.stats.pop('losttest:run', None)
@@ -0,0 +1,50 @@
+import csv
+import io
+import os
+from datetime import datetime
+from flaked.services import search
+from flaked.services.config import config_service
+from flaked.services.search import SearchService
+
+
+def write_records(path, hours, action="UPLOAD_FILES"):
+    stream = io.StringIO()
+    writer = csv.writer(stream, quoting=csv.QUOTE_ALL)
+    for hour in hours:
+        level = "ERROR" if hour % 2 else "INFO"
+        writer.writerow([f"2025-01-01 {hour:02d}:00:00,000", level, "instrument1",
+                         "instrument1:cron", action, f"Message\nat {hour}", str(hour)])
+    with open(path, 'a', newline='') as f:
+        f.write(stream.getvalue())
+
+
+def test_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_service.get_settings(),
+                        'state', str(tmp_path / 'state'))
+    monkeypatch.setattr(search, 'INDEX_INTERVAL', 200)
+    current = tmp_path / 'instrument1.log'
+    rotated = tmp_path / 'instrument1.log.1'
+    write_records(rotated, range(0, 12))
+    write_records(current, range(12, 20), "MOVE_FILES")
+    paths = [current, rotated]
+
+    result = SearchService().search('instrument1', paths, datetime(2025, 1, 1, 10), datetime(2025, 1, 1, 14))
+    assert result['total'] == 4
+    assert [record['arguments'] for record in result['records']] == [['10'], ['11'], ['12'], ['13']]
+    assert result['records'][0]['message'] == "Message\nat 10"
+    assert (tmp_path / 'state' / 'instrument1.logindex.json').exists()
+
+    # from the persisted index, the current file being appended
+    write_records(current, range(20, 24), "MOVE_FILES")
+    result = SearchService().search('instrument1', paths, start=datetime(2025, 1, 1, 15), level="error",
+                                    action="MOVE_FILES", offset=1, limit=2)
+    assert result['total'] == 5
+    assert [record['arguments'] for record in result['records']] == [['17'], ['19']]
+    assert result['records'][0]['timestamp'] == datetime(2025, 1, 1, 17).astimezone().isoformat()
+
+    # rotated: the index follows the inode
+    os.replace(rotated, tmp_path / 'instrument1.log.2')
+    os.replace(current, rotated)
+    write_records(current, range(0, 1))
+    assert SearchService().search('instrument1', [current, rotated, tmp_path / 'instrument1.log.2'],
+                                  job="instrument1:cron")['total'] == 25
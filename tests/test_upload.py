@@ -0,0 +1,284 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+from pathlib import Path
+from flaked.services.pool import sftp_pool, PooledConnection
+from flaked.services.upload import UploadService
+from flaked.models.upload import UploadState
+from flaked.models.domain import CompressConfig
+
+
+class FakeStat:
+
+    def __init__(self, size: int):
+        self.st_size = size
+
+
+class FakeRemoteFile(io.BytesIO):
+
+    def __init__(self, sftp, path: str, mode: str):
+        super().__init__(sftp.files.get(path, b'') if 'r' in mode else b'')
+        self.sftp = sftp
+        self.path = path
+
+    def set_pipelined(self, pipelined: bool):
+        pass
+
+    def prefetch(self, size: int = None):
+        pass
+
+    def close(self):
+        content = self.getvalue()
+        if Path(self.path).name in self.sftp.corrupting and content:
+            # same size, different content
+            content = bytes([content[0] ^ 0xFF]) + content[1:]
+        self.sftp.files[self.path] = content
+        super().close()
+
+
+class FakeSFTP:
+
+    def __init__(self, failing: list = []):
+        self.failing = failing
+        self.corrupting = []
+        self.files = {}
+        self.stats = []
+
+    def stat(self, path):
+        self.stats.append(path)
+        if path in self.files:
+            return FakeStat(len(self.files[path]))
+        if '.' in path:
+            raise FileNotFoundError(path)
+        return FakeStat(0)
+
+    def open(self, path, mode):
+        if Path(path).name in self.failing:
+            raise IOError("Permission denied")
+        return FakeRemoteFile(self, path, mode)
+
+    def posix_rename(self, path, new_path):
+        self.files[new_path] = self.files.pop(path)
+
+    def remove(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        del self.files[path]
+
+
+class FakeConnection(PooledConnection):
+
+    def __init__(self, sftp: FakeSFTP):
+        super().__init__(None, sftp)
+        self.last_used = 0
+
+    def is_active(self):
+        return True
+
+    def is_healthy(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def test_upload_files(tmp_path, monkeypatch):
+    sftp = FakeSFTP(failing=['file3.csv'])
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    files = []
+    for i in range(10):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text("data")
+        files.append(file)
+
+    service = UploadService()
+    results = service.upload_files(files, 'instrument1', concurrency=3)
+    assert [result.path for result in results] == files
+    assert [result.path.name for result in results if not result.success] == [
+        'file3.csv']
+    assert len(sftp.files) == 9
+    assert sftp.files['data/instrument1/file0.csv'] == b'data'
+
+    # only the failed file is retried
+    sftp.failing = []
+    service.upload(results)
+    assert all(result.state == UploadState.done for result in results)
+    assert [result.attempts for result in results] == [1, 1, 1, 2, 1, 1, 1, 1, 1, 1]
+    sftp_pool.close_all()
+
+
+class DroppedConnection(FakeConnection):
+    """Lost once a file was uploaded."""
+
+    def is_active(self):
+        return len(self.sftp.files) == 0
+
+
+def test_upload_workers_failed(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    connections = []
+
+    def connect(sftp_config):
+        if connections:
+            raise IOError("Authentication failed")
+        connections.append(DroppedConnection(sftp))
+        return connections[0]
+    monkeypatch.setattr(sftp_pool, '_connect', connect)
+    files = []
+    for i in range(3):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text("data")
+        files.append(file)
+
+    service = UploadService()
+    results = service.upload_files(files, 'instrument1', concurrency=2)
+    assert [result.success for result in results] == [True, False, False]
+    # the files left behind get the reason why the workers failed
+    for result in results[1:]:
+        assert result.error == "Authentication failed" or result.error.startswith("Connection lost")
+    sftp_pool.close_all()
+
+
+def test_upload_resume(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    file = tmp_path / "large.csv"
+    content = bytes(range(256)) * 8192
+    file.write_bytes(content)
+    sftp.files['data/instrument1/large.csv'] = content[:100000]
+
+    results = UploadService().upload_files([file], 'instrument1')
+    assert results[0].success
+    assert results[0].offset == 100000
+    assert results[0].sent == len(content) - 100000
+    assert sftp.files['data/instrument1/large.csv'] == content
+
+    # another file left under the same name is not resumed
+    sftp.files['data/instrument1/large.csv'] = bytes(100000)
+    results = UploadService().upload_files([file], 'instrument1')
+    assert results[0].success
+    assert results[0].offset == 0
+    assert sftp.files['data/instrument1/large.csv'] == content
+    sftp_pool.close_all()
+
+
+def test_upload_compressed(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    file = tmp_path / "data.csv"
+    content = b"timestamp,value\n" + b"".join(
+        f"2024-01-01T00:00:{i % 60:02},{i % 7}\n".encode() for i in range(50000))
+    file.write_bytes(content)
+
+    results = UploadService().upload_files(
+        [file], 'instrument1', compress=CompressConfig(format='gzip'))
+    assert results[0].success
+    assert results[0].remote_path == 'data/instrument1/data.csv.gz'
+    assert results[0].size == len(content)
+    assert results[0].sent == results[0].compressed < len(content) / 5
+    assert gzip.decompress(sftp.files['data/instrument1/data.csv.gz']) == content
+    sftp_pool.close_all()
+
+
+def test_upload_bundle(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    files = []
+    for i in range(20):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text(f"value,{i}\n")
+        files.append(file)
+
+    service = UploadService()
+    compress = CompressConfig(format='gzip')
+    bundle = service.make_bundle(files, 'instrument1', 'instrument1', compress)
+    service.upload([bundle], compress=compress)
+    assert bundle.success
+    assert bundle.remote_path.endswith('.tar.gz')
+    assert bundle.members == files
+    with tarfile.open(fileobj=io.BytesIO(sftp.files[bundle.remote_path])) as tar:
+        names = tar.getnames()
+        manifest = tar.extractfile('MANIFEST.sha256').read().decode()
+        assert tar.extractfile('file3.csv').read() == b"value,3\n"
+    assert names == [file.name for file in files] + ['MANIFEST.sha256']
+    checksum = hashlib.sha256(b"value,3\n").hexdigest()
+    assert f"{checksum}  file3.csv" in manifest.splitlines()
+    sftp_pool.close_all()
+
+
+def test_upload_bundle_failed(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    file = tmp_path / "file0.csv"
+    file.write_text("data")
+
+    service = UploadService()
+    bundle = service.make_bundle([file], 'instrument1', 'instrument1')
+    sftp.corrupting = [Path(bundle.remote_path).name + '.part']
+    service.upload([bundle], verify='checksum')
+    # no partial archive left on the remote
+    assert not bundle.success
+    assert sftp.files == {}
+
+    sftp.corrupting = []
+    service.upload([bundle], verify='checksum')
+    assert bundle.success
+    assert list(sftp.files.keys()) == [bundle.remote_path]
+    sftp_pool.close_all()
+
+
+def test_upload_partitioned(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    files = []
+    for i in range(3):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text("data")
+        os.utime(file, (1699963200 + i * 86400, 1699963200 + i * 86400))
+        files.append(file)
+
+    service = UploadService()
+    results = service.upload_files(files, 'instrument1', partition='%Y/%m/%d')
+    assert all(result.success for result in results)
+    assert results[0].remote_path == 'data/instrument1/2023/11/14/file0.csv'
+    assert results[2].remote_path == 'data/instrument1/2023/11/16/file2.csv'
+
+    # the remote folders are known to exist on the pooled connection
+    sftp.stats = []
+    service.upload_files(files, 'instrument1', partition='%Y/%m/%d')
+    assert not [path for path in sftp.stats if not path.endswith('.csv')]
+    sftp_pool.close_all()
+
+
+def test_upload_verify(tmp_path, monkeypatch):
+    sftp = FakeSFTP()
+    sftp.corrupting = ['file1.csv']
+    monkeypatch.setattr(sftp_pool, '_connect',
+                        lambda sftp_config: FakeConnection(sftp))
+    files = []
+    for i in range(3):
+        file = tmp_path / f"file{i}.csv"
+        file.write_text("data")
+        files.append(file)
+
+    service = UploadService()
+    results = service.upload_files(files, 'instrument1', verify='size')
+    assert all(result.success and result.verified for result in results)
+
+    results = service.upload_files(files, 'instrument1', verify='checksum')
+    assert [result.success for result in results] == [True, False, True]
+    assert 'checksum' in results[1].error
+
+    sftp.corrupting = []
+    service.upload(results, verify='checksum')
+    assert all(result.success for result in results)
+    assert sftp.files['data/instrument1/file1.csv'] == b'data'
+    sftp_pool.close_all()
@@ -0,0 +1,54 @@
+import time
+from flaked.models.domain import WatchConfig
+from flaked.services.watch import FolderWatcher
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_watch(tmp_path):
+    calls = []
+    watcher = FolderWatcher(tmp_path, r'.*\.csv', WatchConfig(
+        debounce=0.2, poll=1), lambda: calls.append(time.monotonic()))
+    watcher.start()
+    try:
+        time.sleep(0.2)
+        # a burst of files results in a single trigger
+        for i in range(5):
+            (tmp_path / f"file{i}.csv").write_text("data")
+        assert wait_for(lambda: len(calls) > 0)
+        assert watcher.pending.is_set()
+        time.sleep(1.5)
+        assert len(calls) == 1
+        # not matching files are ignored
+        (tmp_path / "file.txt").write_text("data")
+        time.sleep(1.5)
+        assert len(calls) == 1
+    finally:
+        watcher.stop()
+
+
+def test_watch_markers(tmp_path):
+    calls = []
+    (tmp_path / "file0.csv").write_text("data")
+    (tmp_path / "file0.csv.lock").write_text("")
+    watcher = FolderWatcher(tmp_path, r'.*\.csv$', WatchConfig(
+        debounce=0.2, poll=1), lambda: calls.append(time.monotonic()), ('.lock', '.done'))
+    watcher.start()
+    try:
+        time.sleep(0.2)
+        # the lock of a data file is released, although not matching the data file pattern
+        (tmp_path / "file0.csv.lock").unlink()
+        assert wait_for(lambda: len(calls) == 1)
+        (tmp_path / "file0.csv.done").write_text("")
+        assert wait_for(lambda: len(calls) == 2)
+        # a data file removed is not worth a run
+        (tmp_path / "file0.csv").unlink()
+        time.sleep(1.5)
+        assert len(calls) == 2
+    finally:
+        watcher.stop()